@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+
+"""Place workers on CPUs and see how busy each CPU was"""
+
+import sys
+if not (sys.version_info.major == 3 and sys.version_info.minor >= 5):
+    sys.exit("Please use Python 3.5 or higher for this module: " + __name__)
+
+
+#   Load standard modules
+import os
+import glob
+import math
+import logging
+import multiprocessing
+from typing import Dict, List, Optional, Set, Tuple
+
+PLACEMENTS = ('none', 'core', 'node') # type: Tuple[str]
+
+_CGROUP_V2 = '/sys/fs/cgroup/cpu.max' # type: str
+_CGROUP_V1 = ('/sys/fs/cgroup/cpu/cpu.cfs_quota_us', '/sys/fs/cgroup/cpu/cpu.cfs_period_us') # type: Tuple[str, str]
+_NODE_CPUS = '/sys/devices/system/node/node*/cpulist' # type: str
+_PROC_STAT = '/proc/stat' # type: str
+#   Columns of /proc/stat that count a CPU as idle: idle and iowait
+_IDLE_COLUMNS = (3, 4) # type: Tuple[int, int]
+
+
+def parse_cpus(spec: str) -> Tuple[int]:
+    """Turn a CPU list such as '0-3,8,10-11' into a sorted tuple of CPUs"""
+    cpus = set() # type: Set[int]
+    for piece in filter(None, spec.replace(' ', '').split(',')): # type: str
+        first, _, last = piece.partition('-') # type: str, str, str
+        try:
+            first, last = int(first), int(last or first) # type: int, int
+        except ValueError:
+            raise ValueError("Cannot read CPU list '%s'" % spec)
+        if first > last:
+            raise ValueError("Cannot read CPU range '%s'" % piece)
+        cpus.update(range(first, last + 1))
+    if not cpus:
+        raise ValueError("CPU list '%s' is empty" % spec)
+    return tuple(sorted(cpus))
+
+
+def available_cpus() -> Tuple[int]:
+    """CPUs this process may run on"""
+    try:
+        return tuple(sorted(os.sched_getaffinity(0)))
+    except AttributeError:
+        return tuple(range(multiprocessing.cpu_count()))
+
+
+def cgroup_quota() -> Optional[float]:
+    """How many CPUs' worth of time this process's cgroup may use, None if there's no quota"""
+    try:
+        with open(_CGROUP_V2, 'r') as qfile:
+            quota, period = qfile.read().split()[:2] # type: str, str
+        if quota == 'max':
+            return None
+        return int(quota) / int(period)
+    except (OSError, ValueError):
+        pass
+    try:
+        with open(_CGROUP_V1[0], 'r') as qfile, open(_CGROUP_V1[1], 'r') as pfile:
+            quota, period = int(qfile.read()), int(pfile.read()) # type: int, int
+        return quota / period if quota > 0 and period > 0 else None
+    except (OSError, ValueError):
+        return None
+
+
+def default_workers(cpus: Optional[Tuple[int]]=None) -> int:
+    """How many workers to run when not told: one per usable CPU, within any cgroup quota"""
+    workers = len(cpus or available_cpus()) # type: int
+    quota = cgroup_quota() # type: Optional[float]
+    if quota is not None:
+        workers = min(workers, max(math.ceil(quota), 1))
+    return max(workers, 1)
+
+
+def numa_nodes() -> Dict[int, Tuple[int]]:
+    """CPUs on each NUMA node, or every CPU on node 0 if the topology isn't known"""
+    nodes = dict() # type: Dict[int, Tuple[int]]
+    for cpulist in sorted(glob.glob(_NODE_CPUS)): # type: str
+        node = int(os.path.basename(os.path.dirname(cpulist))[len('node'):]) # type: int
+        try:
+            with open(cpulist, 'r') as cfile:
+                nodes[node] = parse_cpus(spec=cfile.read().strip())
+        except (OSError, ValueError):
+            continue
+    return nodes or {0: tuple(range(multiprocessing.cpu_count()))}
+
+
+def plan_placement(cpus: Tuple[int], workers: int, placement: str=PLACEMENTS[1]) -> Tuple[Tuple[int]]:
+    """Give each worker a set of CPUs to run on
+    With 'core', workers take one CPU each, filling one NUMA node before the next so
+    neighbouring workers share a socket; with 'node', each worker may run anywhere on
+    the node its turn lands on, and workers are dealt out to nodes in turn
+    cpus [Tuple[int]]       CPUs the run may use
+    workers [int]           Number of workers to place
+    placement [str]='core'  One of 'core' or 'node'
+    """
+    if placement not in PLACEMENTS[1:]:
+        raise ValueError("'placement' must be one of '%s'" % "', '".join(PLACEMENTS[1:]))
+    allowed = set(cpus) # type: Set[int]
+    nodes = [ # type: List[Tuple[int]]
+        tuple(cpu for cpu in node_cpus if cpu in allowed)
+        for _, node_cpus in sorted(numa_nodes().items())
+    ]
+    nodes = [node for node in nodes if node] or [tuple(cpus)]
+    if placement == 'node':
+        return tuple(nodes[worker % len(nodes)] for worker in range(workers))
+    ordered = [cpu for node in nodes for cpu in node] # type: List[int]
+    return tuple((ordered[worker % len(ordered)],) for worker in range(workers))
+
+
+def pin(cpus: Tuple[int]) -> bool:
+    """Pin this process to a set of CPUs, returns whether it could"""
+    try:
+        os.sched_setaffinity(0, cpus)
+    except (AttributeError, OSError) as error:
+        logging.warning("Cannot pin to CPUs %s: %s", ','.join(map(str, cpus)), error)
+        return False
+    return True
+
+
+def _cpu_times() -> Dict[int, Tuple[int, int]]:
+    times = dict() # type: Dict[int, Tuple[int, int]]
+    try:
+        with open(_PROC_STAT, 'r') as sfile:
+            for line in sfile: # type: str
+                if not line.startswith('cpu') or line.startswith('cpu '):
+                    continue
+                fields = line.split() # type: List[str]
+                ticks = [int(field) for field in fields[1:]] # type: List[int]
+                idle = sum(ticks[column] for column in _IDLE_COLUMNS if column < len(ticks)) # type: int
+                times[int(fields[0][len('cpu'):])] = (sum(ticks), idle)
+    except (OSError, ValueError):
+        pass
+    return times
+
+
+class CoreUsage(object):
+
+    """How busy each CPU was between two points in a run, from /proc/stat"""
+
+    def __init__(self, cpus: Optional[Tuple[int]]=None) -> None:
+        """
+    cpus [Tuple[int]]=None  CPUs to watch; if None, every CPU this process may use
+    """
+        self._cpus = tuple(cpus or available_cpus()) # type: Tuple[int]
+        self._start = _cpu_times() # type: Dict[int, Tuple[int, int]]
+
+    def utilization(self) -> Dict[int, float]:
+        """Fraction of time each CPU was busy since this was made; empty without /proc/stat"""
+        end = _cpu_times() # type: Dict[int, Tuple[int, int]]
+        busy = dict() # type: Dict[int, float]
+        for cpu in self._cpus: # type: int
+            if cpu not in self._start or cpu not in end:
+                continue
+            total = end[cpu][0] - self._start[cpu][0] # type: int
+            idle = end[cpu][1] - self._start[cpu][1] # type: int
+            busy[cpu] = (total - idle) / total if total > 0 else 0.0
+        return busy
+
+    def log(self) -> None:
+        """Log how busy the watched CPUs were, each one at debug level"""
+        busy = self.utilization() # type: Dict[int, float]
+        if not busy:
+            return
+        logging.info(
+            "CPU utilization over %s CPUs: %s%% mean, %s%% to %s%%",
+            len(busy),
+            round(100 * sum(busy.values()) / len(busy), 1),
+            round(100 * min(busy.values()), 1),
+            round(100 * max(busy.values()), 1)
+        )
+        for cpu, fraction in sorted(busy.items()): # type: int, float
+            logging.debug("CPU %s: %s%% busy", cpu, round(100 * fraction, 1))
@@ -9,7 +9,13 @@ if not (sys.version_info.major == 3 and sys.version_info.minor >= 5):
 
 #   Load standard modules
 import argparse
-import multiprocessing
+from typing import Set, Tuple
+
+#   Load custom modules
+from barcseek.affinity import PLACEMENTS, available_cpus, parse_cpus
+from barcseek.executors import EXECUTORS
+from barcseek.partition import VERIFIERS, OUTPUT_FORMATS, ORIENTATIONS
+from barcseek.quality import PHRED_OFFSETS
 
 _HELP_WRAP = 60 # type: int
 _ERROR_DEFAULT = 1 # type: int
@@ -23,17 +29,47 @@ _VERBOSITY_LEVELS = ( # type: Tuple[str]
     'critical'
 )
 
+def _non_negative_int(value: str) -> int:
+    try:
+        value = int(value) # type: int
+    except ValueError:
+        raise argparse.ArgumentTypeError("Must pass an integer value")
+    if value < 0:
+        raise argparse.ArgumentTypeError("Must pass a non-negative value")
+    return value
+
+
 def _num_cores(value: str) -> int:
     try:
         value = int(value) # type: int
     except ValueError:
         raise argparse.ArgumentTypeError("Must pass an integer value")
+    if value < 1:
+        raise argparse.ArgumentTypeError("Must pass a positive value")
+    available = len(available_cpus()) # type: int
+    if value > available:
+        raise argparse.ArgumentTypeError("Cannot have more jobs (%s) than cores available (%s)" % (value, available))
+    return value
+
+
+def _cpu_list(value: str) -> Tuple[int]:
+    try:
+        cpus = parse_cpus(spec=value) # type: Tuple[int]
+    except ValueError as error:
+        raise argparse.ArgumentTypeError(str(error))
+    unavailable = set(cpus).difference(available_cpus()) # type: Set[int]
+    if unavailable:
+        raise argparse.ArgumentTypeError("CPUs %s are not available" % ','.join(map(str, sorted(unavailable))))
+    return cpus
+
+
+def _positive_int(value: str) -> int:
     try:
-        assert value < multiprocessing.cpu_count()
-    except AssertionError:
-        raise argparse.ArgumentTypeError("Cannot have more jobs (%s) than cores available (%s)" % (value, multiprocessing.cpu_count()))
-    except NotImplementedError:
-        pass
+        value = int(value) # type: int
+    except ValueError:
+        raise argparse.ArgumentTypeError("Must pass an integer value")
+    if value < 1:
+        raise argparse.ArgumentTypeError("Must pass a positive integer")
     return value
 
 
@@ -76,6 +112,53 @@ def set_args() -> argparse.ArgumentParser:
         metavar='num jobs',
         help="Run %(prog)s in parallel; if passed, can optionally specify the number of jobs to run at once"
     )
+    parser.add_argument( # Executor backend
+        '--executor',
+        dest='executor',
+        type=str.lower,
+        choices=EXECUTORS,
+        default=None,
+        required=False,
+        metavar='executor',
+        help="Choose where chunks are run from '%s'; defaults to 'serial' for one job and 'process' otherwise" % "', '".join(EXECUTORS)
+    )
+    parser.add_argument( # Dask scheduler address
+        '--scheduler',
+        dest='scheduler',
+        type=str,
+        default=None,
+        required=False,
+        metavar='address',
+        help="Address of a running dask scheduler for the 'dask' executor; if not passed, a local cluster is started"
+    )
+    parser.add_argument( # CPUs to run on
+        '--cpus',
+        dest='cpus',
+        type=_cpu_list,
+        default=None,
+        required=False,
+        metavar='CPU list',
+        help="Only run on these CPUs, such as '0-15' or '0-7,16-23'; without a job count, one job is run per CPU, within any cgroup CPU quota"
+    )
+    parser.add_argument( # Worker placement
+        '--pin',
+        dest='pin',
+        type=str.lower,
+        choices=PLACEMENTS,
+        default=PLACEMENTS[0],
+        required=False,
+        metavar='placement',
+        help="Pin 'process' workers to one CPU each ('core'), filling one NUMA node before the next, or to the CPUs of one NUMA node each ('node'); defaults to '%s'" % PLACEMENTS[0]
+    )
+    parser.add_argument( # CPUs for the main process
+        '--writer-cpus',
+        dest='writer_cpus',
+        type=_cpu_list,
+        default=None,
+        required=False,
+        metavar='CPU list',
+        help="Pin the main process, which collects and writes outputs, to these CPUs; workers are placed on the rest"
+    )
     parser.add_argument( # Output directory
         '-o',
         '--output-directory',
@@ -86,6 +169,159 @@ def set_args() -> argparse.ArgumentParser:
         metavar='output directory',
         help="Choose where all output files are to be stored; defaults to '%s'" % _OUTDIR_DEFAULT
     )
+    parser.add_argument( # Resume a previous run
+        '--resume',
+        dest='resume',
+        action='store_true',
+        required=False,
+        help="Resume an interrupted run from the checkpoint in the output directory, skipping chunks that are already done"
+    )
+    parser.add_argument( # Chunk size
+        '-l',
+        '--chunk-size',
+        dest='chunk_size',
+        type=_positive_int,
+        default=None,
+        required=False,
+        metavar='CHUNK SIZE',
+        help="Hand workers a fixed number of reads at once; if not passed, chunks are sized from measured throughput"
+    )
+    parser.add_argument( # Progress interval
+        '--progress-interval',
+        dest='progress_interval',
+        type=float,
+        default=30.0,
+        required=False,
+        metavar='SECONDS',
+        help="Report progress, throughput, and match rate every SECONDS seconds; pass 0 to only report at the end. Defaults to 30"
+    )
+    parser.add_argument( # Status file
+        '--status-file',
+        dest='status_file',
+        type=str,
+        default=None,
+        required=False,
+        metavar='STATUS FILE',
+        help="Also write every progress report to STATUS FILE as one JSON object per line"
+    )
+    parser.add_argument( # Run stats
+        '--stats',
+        dest='stats',
+        type=str.lower,
+        nargs='*',
+        choices=('pdf', 'png', 'svg'),
+        default=None,
+        required=False,
+        metavar='FORMAT',
+        help="Write summary tables and plots of reads, edit distances, and UMI counts per sample to the output directory, in one or more of 'pdf', 'png', and 'svg'; defaults to 'pdf' if no format is given. Needs matplotlib"
+    )
+    parser.add_argument( # Bare '+' lines
+        '--bare-plus',
+        dest='bare_plus',
+        action='store_true',
+        required=False,
+        help="Write a bare '+' line in output FASTQ files rather than repeating the read ID"
+    )
+    parser.add_argument( # Output format
+        '--output-format',
+        dest='output_format',
+        type=str.lower,
+        choices=OUTPUT_FORMATS,
+        default=OUTPUT_FORMATS[0],
+        required=False,
+        metavar='FORMAT',
+        help="Write reads as separate forward and reverse 'fastq' files, one 'interleaved' FASTQ file, or one unaligned 'bam' file per sample; choose from '%s', defaults to '%s'" % ("', '".join(OUTPUT_FORMATS), OUTPUT_FORMATS[0])
+    )
+    parser.add_argument( # Stream outputs into commands
+        '--sink-command',
+        dest='sink_command',
+        type=str,
+        default=None,
+        required=False,
+        metavar='COMMAND',
+        help="Stream every output into COMMAND as it is demultiplexed rather than writing it to disk; '{output}', '{sample}', and '{read}' are replaced by the output name, sample, and 'fwd' or 'rev'"
+    )
+    parser.add_argument( # Stream outputs into named pipes
+        '--fifo',
+        dest='fifo',
+        action='store_true',
+        required=False,
+        help="Stream every output into a named pipe at its output name, creating the pipe if needed; nothing is written until each pipe is opened for reading"
+    )
+    parser.add_argument( # Sink spill limit
+        '--sink-spill',
+        dest='sink_spill',
+        type=_positive_int,
+        default=256,
+        required=False,
+        metavar='MB',
+        help="Stop if a --sink-command or --fifo output falls more than MB megabytes behind; new chunks are held back while any output is behind, and only chunks already running spill to a temporary file meanwhile, defaults to 256"
+    )
+    parser.add_argument( # Spill runs
+        '--spill',
+        dest='spill',
+        action='store_true',
+        required=False,
+        help="Have each chunk write one spill file holding every sample rather than a file per sample, then write each output once at the end; keeps open files and memory bounded with thousands of samples"
+    )
+    parser.add_argument( # Open file limit
+        '--max-open-files',
+        dest='max_open_files',
+        type=_positive_int,
+        default=None,
+        required=False,
+        metavar='FILES',
+        help="With --spill, have at most FILES spill files open at once while writing outputs, combining them in passes if there are more; defaults to the system's limit"
+    )
+    parser.add_argument( # Merge buffer
+        '--merge-buffer',
+        dest='merge_buffer',
+        type=_positive_int,
+        default=16,
+        required=False,
+        metavar='MB',
+        help="With --spill, copy at most MB megabytes at a time while writing outputs, defaults to 16"
+    )
+    parser.add_argument( # Assignment log
+        '--assignment-log',
+        dest='assignment_log',
+        action='store_true',
+        default=False,
+        required=False,
+        help="Also write the sample, edit distance, and UMI of every read to a compact columnar log, 'assignments.bsa', in the output directory"
+    )
+    parser.add_argument( # Memory budget
+        '--max-memory',
+        dest='max_memory',
+        type=_positive_int,
+        default=None,
+        required=False,
+        metavar='MB',
+        help="Keep the whole run, workers included, within MB megabytes: chunk sizes, copy buffers, and the match cache are sized to fit, and new chunks are held back as memory nears the budget. Writes queued for --sink-command or --fifo outputs and the --index correction table aren't sized to fit, but count toward holding chunks back; defaults to no limit"
+    )
+    parser.add_argument( # Dry run
+        '--dry-run',
+        dest='dry_run',
+        action='store_true',
+        required=False,
+        help="Only check the sample sheet against a sample of reads: report the best barcode offset and orientation and the expected assignment rate, then stop"
+    )
+    parser.add_argument( # Sample size
+        '--sample',
+        dest='sample',
+        type=_positive_int,
+        default=10000,
+        required=False,
+        metavar='N',
+        help="Check N reads from each lane in a dry run, or from the first lane with --orientation auto, defaults to 10000"
+    )
+    parser.add_argument( # Reservoir sampling
+        '--reservoir',
+        dest='reservoir',
+        action='store_true',
+        required=False,
+        help="Sample reads evenly from the whole lane rather than taking the first N"
+    )
     #   Input arguments
     inputs = parser.add_argument_group(
         title='input arguments',
@@ -96,20 +332,52 @@ def set_args() -> argparse.ArgumentParser:
         '--forward-fastq',
         dest='forward',
         type=str,
+        nargs='+',
         default=None,
         required=True,
         metavar='FORWARD FASTQ',
-        help="Provide a filepath for the forward/single FASTQ file"
+        help="Provide filepaths or glob patterns for the forward/single FASTQ file of each lane; unaligned BAM files are read as is, paired or not"
     )
     inputs.add_argument( # Reverse FASTQ
         '-r',
         '--reverse-fastq',
         dest='reverse',
         type=str,
+        nargs='+',
         default=None,
         required=False,
         metavar='REVERSE FASTQ',
-        help="Provide a filepath for the optional reverse FASTQ file"
+        help="Provide filepaths or glob patterns for the optional reverse FASTQ file of each lane, in the same order as the forward files"
+    )
+    inputs.add_argument( # Interleaved input
+        '--interleaved',
+        dest='interleaved',
+        action='store_true',
+        required=False,
+        help="The forward FASTQ files hold both reads of each pair, one after the other"
+    )
+    inputs.add_argument( # Reorder window for pairs
+        '--pair-window',
+        dest='pair_window',
+        type=_non_negative_int,
+        default=0,
+        required=False,
+        metavar='READS',
+        help="Let a read be up to READS reads out of step with its mate; read IDs are compared without '/1', '/2', or comments. Defaults to 0"
+    )
+    inputs.add_argument( # Unpaired reads
+        '--skip-unpaired',
+        dest='skip_unpaired',
+        action='store_true',
+        required=False,
+        help="Leave out and count reads whose mate can't be found rather than stopping"
+    )
+    inputs.add_argument( # Merge lanes
+        '--merge-lanes',
+        dest='merge',
+        action='store_true',
+        required=False,
+        help="Write every lane into one set of outputs per sample"
     )
     inputs.add_argument( # Sample sheet
         '-s',
@@ -145,4 +413,125 @@ def set_args() -> argparse.ArgumentParser:
         metavar='ERROR',
         help="This is how many mismatches in the barcode we allowed before rejecting, defaults to %s" % _ERROR_DEFAULT
     )
+    barcodes.add_argument( # Seed prefilter
+        '--prefilter',
+        dest='prefilter',
+        action='store_true',
+        required=False,
+        help="Find candidate samples for each read with a seed prefilter before running any patterns; useful for many samples or barcodes at varying positions"
+    )
+    barcodes.add_argument( # Whitelist index
+        '--index',
+        dest='index',
+        action='store_true',
+        required=False,
+        help="Look barcodes up in a sorted whitelist index rather than trying every sample; for large sheets of plain, fixed-length barcodes, allowing at most one mismatch"
+    )
+    barcodes.add_argument( # Fuzzy matching verifier
+        '--verifier',
+        dest='verifier',
+        type=str.lower,
+        choices=VERIFIERS,
+        default=VERIFIERS[0],
+        required=False,
+        metavar='verifier',
+        help="Choose how fuzzy barcode matches are found from '%s'; 'myers' uses bit-vector edit distance, defaults to '%s'" % ("', '".join(VERIFIERS), VERIFIERS[0])
+    )
+    barcodes.add_argument( # Search window
+        '--search-window',
+        dest='search_window',
+        type=_positive_int,
+        default=None,
+        required=False,
+        metavar='BASES',
+        help="Only search the first BASES bases of each read for barcodes; if not passed, search the whole read"
+    )
+    barcodes.add_argument( # Match cache
+        '--match-cache',
+        dest='match_cache',
+        type=_non_negative_int,
+        default=0,
+        required=False,
+        metavar='MB',
+        help="Spend up to MB megabytes per worker caching match results by searched sequence, so libraries with few distinct barcode windows skip most searches; works best with --search-window, defaults to 0 (no cache)"
+    )
+    barcodes.add_argument( # Read structures
+        '--read-structure',
+        dest='read_structure',
+        type=str,
+        nargs='+',
+        default=None,
+        required=False,
+        metavar='STRUCTURE',
+        help="Read structures for the forward and optionally the reverse read, such as '8B10M8B+T' for a barcode, UMI, barcode, and template; segments are sample Barcodes, Molecular barcodes, Template, or Skipped bases, with '+' for whatever length is left. The first sample sheet barcode column is read from the forward read and the second from the reverse, so each structure covers one column; for two barcodes in one read, describe both in one structure and write them in one column. Overrides a '#read_structure' line in the sample sheet"
+    )
+    barcodes.add_argument( # Barcode orientation
+        '--orientation',
+        dest='orientation',
+        type=str.lower,
+        choices=ORIENTATIONS,
+        default=ORIENTATIONS[0],
+        required=False,
+        metavar='orientation',
+        help="Choose from '%s'; 'auto' checks --sample reads with each barcode slot as written and reverse complemented, then uses the best for the whole run, defaults to '%s'" % ("', '".join(ORIENTATIONS), ORIENTATIONS[0])
+    )
+    quality = parser.add_argument_group(
+        title='quality options',
+        description="Trim and filter reads by quality before demultiplexing; reads that fail go to 'undetermined'"
+    )
+    quality.add_argument( # Barcode window
+        '--barcode-window',
+        dest='barcode_window',
+        type=_positive_int,
+        default=None,
+        required=False,
+        metavar='BASES',
+        help="Only check quality over the first BASES bases of each read, where the barcodes are; if not passed, check the whole read"
+    )
+    quality.add_argument( # Minimum mean quality
+        '--min-mean-quality',
+        dest='min_mean_quality',
+        type=float,
+        default=None,
+        required=False,
+        metavar='QUALITY',
+        help="Send reads whose mean quality in the barcode window is below QUALITY to 'undetermined'"
+    )
+    quality.add_argument( # Minimum base quality
+        '--min-base-quality',
+        dest='min_base_quality',
+        type=_non_negative_int,
+        default=None,
+        required=False,
+        metavar='QUALITY',
+        help="Send reads with any base below QUALITY in the barcode window to 'undetermined'"
+    )
+    quality.add_argument( # Tail trimming
+        '--trim-tail-quality',
+        dest='tail_quality',
+        type=_non_negative_int,
+        default=None,
+        required=False,
+        metavar='QUALITY',
+        help="Trim bases below QUALITY from the end of every read"
+    )
+    quality.add_argument( # Minimum length
+        '--min-length',
+        dest='min_length',
+        type=_positive_int,
+        default=1,
+        required=False,
+        metavar='LENGTH',
+        help="Send reads shorter than LENGTH after trimming to 'undetermined' when any quality option is used, defaults to 1"
+    )
+    quality.add_argument( # Phred offset
+        '--phred-offset',
+        dest='phred_offset',
+        type=int,
+        choices=PHRED_OFFSETS,
+        default=PHRED_OFFSETS[0],
+        required=False,
+        metavar='OFFSET',
+        help="Phred offset of the quality scores, choose from %s; defaults to %s" % (', '.join(map(str, PHRED_OFFSETS)), PHRED_OFFSETS[0])
+    )
     return parser
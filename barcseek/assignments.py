@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+
+"""A columnar log of where every read was assigned"""
+
+import sys
+if not (sys.version_info.major == 3 and sys.version_info.minor >= 5):
+    sys.exit("Please use Python 3.5 or higher for this module: " + __name__)
+
+
+#   Load standard modules
+import os
+import json
+import struct
+import logging
+import collections
+from typing import Any, Dict, Iterator, List, Optional, Sequence, Set, Tuple
+
+#   Load installed modules
+try:
+    import numpy
+except ImportError as error:
+    sys.exit("Please install " + error.name)
+
+
+LOG_NAME = 'assignments.bsa' # type: str
+COLUMNS = ('lane', 'index', 'sample', 'distance', 'umi') # type: Tuple[str]
+#   Distance given to reads that weren't assigned to a sample
+NO_DISTANCE = -1 # type: int
+
+_MAGIC = b'BSASSIGN' # type: bytes
+_VERSION = 2 # type: int
+#   Magic, format version, and the length of the JSON metadata that follows
+_HEADER = struct.Struct('<8sHI') # type: struct.Struct
+#   Every row group starts with its lane, the index of its first read, how many rows it holds, how wide
+#   its UMIs are, and whether it stores each read's offset from the first read; version 1 had no offsets
+_GROUP = struct.Struct('<HQIHB') # type: struct.Struct
+_GROUP_V1 = struct.Struct('<HQIH') # type: struct.Struct
+_DISTANCE_TYPE = numpy.dtype('<i1') # type: numpy.dtype
+_OFFSET_TYPE = numpy.dtype('<u4') # type: numpy.dtype
+
+#   One chunk's columns: the category of each read by position in the log's categories,
+#   its total edit distance (-1 if unassigned), its UMI (empty if it has none, None if no read has one),
+#   and its offset from the chunk's first read (None if the reads follow each other with none left out)
+Columns = collections.namedtuple('Columns', ('sample', 'distance', 'umi', 'offset'))
+
+#   A row group as read back: every column, with the lane and read index filled in for every row
+RowGroup = collections.namedtuple('RowGroup', COLUMNS)
+
+
+def _sample_type(categories: int) -> numpy.dtype:
+    return numpy.dtype('<u2' if categories <= numpy.iinfo(numpy.uint16).max else '<u4')
+
+
+def make_columns(assignments: Any, categories: Sequence[str], positions: Optional[numpy.ndarray]=None) -> Columns:
+    """Turn a batch's assignments into compact columns
+    assignments [partition.Assignments]     The results of 'Matcher.match_batch'
+    categories [Sequence[str]]              Every category, in the order the log was opened with
+    positions [numpy.ndarray]=None          Where each read was in the chunk, such as 'batch.ReadBatch.rows'
+                                            when pairing left reads out; None if every read is there in order
+    """
+    lookup = {category: code for code, category in enumerate(categories)} # type: Dict[str, int]
+    rows = len(assignments.samples) # type: int
+    sample = numpy.fromiter((lookup[name] for name in assignments.samples), dtype=_sample_type(categories=len(categories)), count=rows) # type: numpy.ndarray
+    distance = numpy.fromiter( # type: numpy.ndarray
+        (NO_DISTANCE if value is None else value for value in assignments.distances),
+        dtype=_DISTANCE_TYPE,
+        count=rows
+    )
+    if any(assignments.umis):
+        umi = numpy.array([value or '' for value in assignments.umis], dtype='S') # type: Optional[numpy.ndarray]
+    else:
+        umi = None # type: Optional[numpy.ndarray]
+    if positions is not None and not numpy.array_equal(positions, numpy.arange(rows)):
+        offset = positions.astype(_OFFSET_TYPE) # type: Optional[numpy.ndarray]
+    else:
+        offset = None # type: Optional[numpy.ndarray]
+    return Columns(sample=sample, distance=distance, umi=umi, offset=offset)
+
+
+class AssignmentLog(object):
+
+    """Append chunks of assignments to a log file, one row group per chunk
+    A log starts with JSON metadata naming every category, then holds row groups in
+    whatever order chunks finish; each group's columns are stored one after another,
+    so a reader can skip the columns it doesn't need
+    """
+
+    def __init__(self, filename: str, categories: Sequence[str], lanes: Sequence[str]=()) -> None:
+        """
+    filename [str]                  Where to write the log; an existing log is appended to
+    categories [Sequence[str]]      Every category reads can be assigned to
+    lanes [Sequence[str]]=()        Forward input of each lane, for reference
+    """
+        self._filename = filename # type: str
+        self._categories = tuple(categories) # type: Tuple[str]
+        self._sample_type = _sample_type(categories=len(self._categories)) # type: numpy.dtype
+        self._groups = 0 # type: int
+        if not os.path.exists(filename) or not os.path.getsize(filename):
+            metadata = json.dumps({ # type: bytes
+                'categories': self._categories,
+                'lanes': list(lanes),
+                'sample_type': self._sample_type.str
+            }).encode()
+            with open(filename, 'wb') as lfile:
+                lfile.write(_HEADER.pack(_MAGIC, _VERSION, len(metadata)))
+                lfile.write(metadata)
+
+    def append(self, lane: int, first: int, columns: Columns) -> int:
+        """Write one chunk's columns and sync them to disk, returns the bytes written
+        lane [int]          Which lane the chunk comes from
+        first [int]         Index in its lane of the chunk's first read
+        columns [Columns]   The chunk's columns, from 'make_columns'
+        """
+        rows = len(columns.sample) # type: int
+        umi, offset = columns.umi, columns.offset # type: Optional[numpy.ndarray], Optional[numpy.ndarray]
+        if any(column is not None and len(column) != rows for column in (columns.distance, umi, offset)):
+            raise ValueError("Every column must have one entry per read")
+        width = umi.dtype.itemsize if umi is not None else 0 # type: int
+        data = b''.join(( # type: bytes
+            _GROUP.pack(lane, first, rows, width, offset is not None),
+            columns.sample.astype(self._sample_type, copy=False).tobytes(),
+            columns.distance.astype(_DISTANCE_TYPE, copy=False).tobytes(),
+            umi.tobytes() if umi is not None else b'',
+            offset.astype(_OFFSET_TYPE, copy=False).tobytes() if offset is not None else b''
+        ))
+        with open(self._filename, 'ab') as lfile:
+            lfile.write(data)
+            lfile.flush()
+            os.fsync(lfile.fileno())
+        self._groups += 1
+        return len(data)
+
+    def _get_filename(self) -> str:
+        return self._filename
+
+    def _get_groups(self) -> int:
+        return self._groups
+
+    filename = property(fget=_get_filename, doc='Where the log is written')
+    groups = property(fget=_get_groups, doc='Number of row groups written by this log')
+
+
+class AssignmentReader(object):
+
+    """Read an assignment log back, a row group or a column at a time
+    >>> reader = AssignmentReader('output/assignments.bsa')
+    >>> columns = reader.read(columns=('sample', 'distance'))
+    >>> reader.categories[columns['sample'][0]]
+    """
+
+    def __init__(self, filename: str) -> None:
+        """
+    filename [str]  The assignment log to read
+    """
+        self._filename = filename # type: str
+        with open(filename, 'rb') as lfile:
+            magic, version, length = _HEADER.unpack(lfile.read(_HEADER.size)) # type: bytes, int, int
+            if magic != _MAGIC:
+                raise ValueError(logging.error("%s is not an assignment log", filename))
+            if version > _VERSION:
+                raise ValueError(logging.error("Assignment log %s is version %s, newer than this reader", filename, version))
+            metadata = json.loads(lfile.read(length).decode()) # type: Dict[str, Any]
+            self._start = lfile.tell() # type: int
+        self._group = _GROUP if version >= 2 else _GROUP_V1 # type: struct.Struct
+        self._categories = tuple(metadata['categories']) # type: Tuple[str]
+        self._lanes = tuple(metadata.get('lanes', ())) # type: Tuple[str]
+        self._sample_type = numpy.dtype(metadata['sample_type']) # type: numpy.dtype
+
+    def _group_sizes(self, rows: int, width: int, offsets: bool) -> Tuple[int, int, int, int]:
+        return rows * self._sample_type.itemsize, rows * _DISTANCE_TYPE.itemsize, rows * width, rows * _OFFSET_TYPE.itemsize * offsets
+
+    def groups(self, columns: Sequence[str]=COLUMNS) -> Iterator[RowGroup]:
+        """Iterate over row groups in the order they were written, reading only the columns asked for
+        columns [Sequence[str]]     Columns to read, from 'lane', 'index', 'sample', 'distance', and 'umi';
+                                    the rest are None
+        """
+        unknown = set(columns).difference(COLUMNS) # type: Set[str]
+        if unknown:
+            raise ValueError("Unknown columns: %s" % ', '.join(sorted(unknown)))
+        with open(self._filename, 'rb') as lfile:
+            lfile.seek(self._start)
+            while True:
+                header = lfile.read(self._group.size) # type: bytes
+                if not header:
+                    break
+                if len(header) < self._group.size:
+                    raise ValueError(logging.error("Assignment log %s ends partway through a row group", self._filename))
+                fields = self._group.unpack(header) # type: Tuple[int, ...]
+                lane, first, rows, width = fields[:4] # type: int, int, int, int
+                #   Version 1 groups never hold offsets
+                offsets = len(fields) > 4 and bool(fields[4]) # type: bool
+                values = dict() # type: Dict[str, Optional[numpy.ndarray]]
+                for name, size, dtype in zip( # type: str, int, numpy.dtype
+                        ('sample', 'distance', 'umi', 'index'),
+                        self._group_sizes(rows=rows, width=width, offsets=offsets),
+                        (self._sample_type, _DISTANCE_TYPE, numpy.dtype('S%s' % max(width, 1)), _OFFSET_TYPE)
+                ):
+                    if name not in columns:
+                        lfile.seek(size, os.SEEK_CUR)
+                        values[name] = None
+                        continue
+                    if name == 'umi' and not width:
+                        values[name] = numpy.zeros(rows, dtype='S1')
+                        continue
+                    if name == 'index' and not offsets:
+                        values[name] = numpy.arange(first, first + rows, dtype='<u8')
+                        continue
+                    data = lfile.read(size) # type: bytes
+                    if len(data) < size:
+                        raise ValueError(logging.error("Assignment log %s ends partway through a row group", self._filename))
+                    values[name] = numpy.frombuffer(data, dtype=dtype)
+                if offsets and values['index'] is not None:
+                    values['index'] = values['index'].astype('<u8') + first
+                yield RowGroup(
+                    lane=numpy.full(rows, lane, dtype='<u2') if 'lane' in columns else None,
+                    index=values['index'],
+                    sample=values['sample'],
+                    distance=values['distance'],
+                    umi=values['umi']
+                )
+
+    def read(self, columns: Sequence[str]=COLUMNS) -> Dict[str, numpy.ndarray]:
+        """Read whole columns, one entry per read in the order row groups were written
+        columns [Sequence[str]]     Columns to read, from 'lane', 'index', 'sample', 'distance', and 'umi'
+        """
+        pieces = {name: list() for name in columns} # type: Dict[str, List[numpy.ndarray]]
+        for group in self.groups(columns=columns): # type: RowGroup
+            for name in columns: # type: str
+                pieces[name].append(getattr(group, name))
+        return {name: numpy.concatenate(arrays) if arrays else numpy.zeros(0) for name, arrays in pieces.items()}
+
+    def counts(self) -> Dict[str, int]:
+        """Number of reads in each category, reading only the sample column"""
+        totals = numpy.zeros(len(self._categories), dtype='<u8') # type: numpy.ndarray
+        for group in self.groups(columns=('sample',)): # type: RowGroup
+            totals += numpy.bincount(group.sample, minlength=len(self._categories)).astype('<u8')
+        return {category: int(total) for category, total in zip(self._categories, totals)}
+
+    def _get_categories(self) -> Tuple[str]:
+        return self._categories
+
+    def _get_lanes(self) -> Tuple[str]:
+        return self._lanes
+
+    categories = property(fget=_get_categories, doc='Category names, indexed by the sample column')
+    lanes = property(fget=_get_lanes, doc='Forward input of each lane, indexed by the lane column')
@@ -0,0 +1,418 @@
+#!/usr/bin/env python3
+
+"""Read and write unaligned BAM files without any external tools"""
+
+import sys
+if not (sys.version_info.major == 3 and sys.version_info.minor >= 5):
+    sys.exit("Please use Python 3.5 or higher for this module: " + __name__)
+
+
+#   Load standard modules
+import os
+import zlib
+import struct
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterator, List, Optional, Tuple
+
+#   Load custom modules
+import barcseek.batch as batch
+
+#   Load installed modules
+try:
+    import numpy
+except ImportError as error:
+    sys.exit("Please install " + error.name)
+
+
+#   The empty block that ends every BGZF file
+EOF = bytes.fromhex('1f8b08040000000000ff0600424302001b0003000000000000000000') # type: bytes
+_BLOCK_DATA = 0xff00 # type: int
+#   Blocks to inflate per thread at a time
+_BATCH_BLOCKS = 16 # type: int
+_HEADER = struct.Struct('<4BI2BH') # type: struct.Struct
+_SUBFIELD = struct.Struct('<2BH') # type: struct.Struct
+_FOOTER = struct.Struct('<2I') # type: struct.Struct
+_MAGIC = b'BAM\x01' # type: bytes
+_INT = struct.Struct('<i') # type: struct.Struct
+_HEADER_TEXT = '@HD\tVN:1.6\tSO:unsorted\tGO:query\n@PG\tID:barcseek\tPN:barcseek\n' # type: str
+
+#   Flags for unmapped reads
+UNMAPPED = 0x4 # type: int
+PAIRED = 0x1 | UNMAPPED | 0x8 # type: int
+FIRST = 0x40 # type: int
+SECOND = 0x80 # type: int
+
+#   The fixed-size start of every alignment record, including its length
+_FIXED = numpy.dtype([ # type: numpy.dtype
+    ('block_size', '<i4'),
+    ('ref_id', '<i4'),
+    ('pos', '<i4'),
+    ('l_read_name', 'u1'),
+    ('mapq', 'u1'),
+    ('bin', '<u2'),
+    ('n_cigar_op', '<u2'),
+    ('flag', '<u2'),
+    ('l_seq', '<i4'),
+    ('next_ref_id', '<i4'),
+    ('next_pos', '<i4'),
+    ('tlen', '<i4')
+])
+_UNMAPPED_BIN = 4680 # type: int
+
+#   Four bits per base
+_BASES = numpy.frombuffer(b'=ACMGRSVTWYHKDBN', dtype=numpy.uint8) # type: numpy.ndarray
+_CODES = numpy.full(256, 15, dtype=numpy.uint8) # type: numpy.ndarray
+for _code, _base in enumerate(_BASES.tolist()): # type: int, int
+    _CODES[_base] = _CODES[ord(chr(_base).lower())] = _code
+
+
+def is_bam(filename: str) -> bool:
+    """Does a file look like a BAM file by name?"""
+    return os.path.splitext(filename)[-1].lower() == '.bam'
+
+
+def _block_size(extra: bytes) -> Optional[int]:
+    """Find the size of a BGZF block in the extra field of its gzip header, None if it isn't there"""
+    position = 0 # type: int
+    while position + _SUBFIELD.size <= len(extra):
+        first, second, length = _SUBFIELD.unpack_from(extra, position) # type: int, int, int
+        if (first, second) == (ord('B'), ord('C')):
+            return struct.unpack_from('<H', extra, position + _SUBFIELD.size)[0]
+        position += _SUBFIELD.size + length
+    return None
+
+
+def is_bgzf(filename: str) -> bool:
+    """Is a file BGZF-compressed? Judged from the header of its first block"""
+    try:
+        with open(filename, 'rb') as bfile:
+            header = bfile.read(_HEADER.size) # type: bytes
+            if len(header) < _HEADER.size or header[:4] != b'\x1f\x8b\x08\x04':
+                return False
+            return _block_size(extra=bfile.read(_HEADER.unpack(header)[-1])) is not None
+    except OSError:
+        return False
+
+
+def compress(data: bytes, level: int=6) -> bytes:
+    """Compress data into BGZF blocks, without the end-of-file block
+    data [bytes]    The data to compress
+    level [int]=6   zlib compression level
+    """
+    blocks = list() # type: List[bytes]
+    for start in range(0, len(data), _BLOCK_DATA): # type: int
+        piece = data[start:start + _BLOCK_DATA] # type: bytes
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15) # type: zlib.Compress
+        deflated = compressor.compress(piece) + compressor.flush() # type: bytes
+        size = len(deflated) + 25 # type: int
+        blocks.append(
+            _HEADER.pack(0x1f, 0x8b, 8, 4, 0, 0, 0xff, 6) +
+            _SUBFIELD.pack(ord('B'), ord('C'), 2) + struct.pack('<H', size) +
+            deflated +
+            _FOOTER.pack(zlib.crc32(piece) & 0xffffffff, len(piece))
+        )
+    return b''.join(blocks)
+
+
+class BgzfReader(object):
+
+    """Read the uncompressed stream of a BGZF file by virtual offset
+    A virtual offset is the start of a compressed block shifted left by
+    sixteen bits plus a position within that block's data, so any record
+    can be reached without decompressing anything before its block
+    """
+
+    def __init__(self, filename: str) -> None:
+        self._handle = open(filename, 'rb')
+        self._start = 0 # type: int
+        self._next = 0 # type: int
+        self._data = b'' # type: bytes
+        self._position = 0 # type: int
+
+    def __enter__(self) -> 'BgzfReader':
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self._handle.close()
+
+    def _raw(self, start: int) -> Optional[Tuple[bytes, int, int]]:
+        """Read the block starting at 'start' without inflating it
+        Returns its deflated data, its uncompressed size, and where the next block starts; None if there isn't one
+        """
+        self._handle.seek(start)
+        header = self._handle.read(_HEADER.size) # type: bytes
+        if not header:
+            return None
+        if len(header) < _HEADER.size or header[:4] != b'\x1f\x8b\x08\x04':
+            raise ValueError("Not a BGZF file")
+        extra = self._handle.read(_HEADER.unpack(header)[-1]) # type: bytes
+        size = _block_size(extra=extra) # type: Optional[int]
+        if size is None:
+            raise ValueError("Not a BGZF file")
+        rest = self._handle.read(size + 1 - len(header) - len(extra)) # type: bytes
+        return rest[:-_FOOTER.size], _FOOTER.unpack_from(rest, len(rest) - _FOOTER.size)[1], start + size + 1
+
+    @staticmethod
+    def _inflate(start: int, raw: bytes, size: int) -> bytes:
+        data = zlib.decompress(raw, -15) # type: bytes
+        if len(data) != size:
+            raise ValueError("Truncated BGZF block at %s" % start)
+        return data
+
+    def _load(self, start: int) -> bool:
+        """Load the block starting at 'start', False if there isn't one"""
+        block = self._raw(start=start) # type: Optional[Tuple[bytes, int, int]]
+        self._start, self._data, self._position = start, b'', 0
+        if block is None:
+            self._next = start
+            return False
+        raw, size, self._next = block
+        self._data = self._inflate(start=start, raw=raw, size=size)
+        return True
+
+    def tell(self) -> int:
+        """The virtual offset of the next byte to be read"""
+        while self._position >= len(self._data) and self._load(self._next):
+            pass
+        return self._start << 16 | self._position
+
+    def seek(self, offset: int) -> None:
+        """Move to a virtual offset"""
+        self._load(offset >> 16)
+        self._position = offset & 0xffff
+
+    def read(self, size: int) -> bytes:
+        """Read 'size' bytes, fewer at the end of the file"""
+        pieces = list() # type: List[bytes]
+        while size > 0:
+            if self._position >= len(self._data) and not self._load(self._next):
+                break
+            piece = self._data[self._position:self._position + size] # type: bytes
+            self._position += len(piece)
+            size -= len(piece)
+            pieces.append(piece)
+        return b''.join(pieces)
+
+    def blocks(self, threads: int=1) -> Iterator[Tuple[int, bytes]]:
+        """Iterate over every block from the start of the file as (where the block starts, its uncompressed data)
+        Blocks stand on their own, so with several threads a batch of them is inflated at once,
+        zlib letting go of the GIL while it works; blocks still come in file order
+        threads [int]=1     How many threads inflate blocks
+        """
+        if threads <= 1:
+            loaded = self._load(0) # type: bool
+            while loaded:
+                yield self._start, self._data
+                loaded = self._load(self._next)
+            return
+        start = 0 # type: int
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            while True:
+                batch = list() # type: List[Tuple[int, bytes, int]]
+                while len(batch) < threads * _BATCH_BLOCKS:
+                    block = self._raw(start=start) # type: Optional[Tuple[bytes, int, int]]
+                    if block is None:
+                        break
+                    batch.append((start, block[0], block[1]))
+                    start = block[2]
+                if not batch:
+                    return
+                yield from zip((first for first, _, _ in batch), pool.map(lambda block: self._inflate(*block), batch))
+
+    def read_to(self, offset: int) -> bytes:
+        """Read everything up to a virtual offset"""
+        pieces = list() # type: List[bytes]
+        while self.tell() < offset and self._data:
+            if self._start == offset >> 16:
+                stop = offset & 0xffff # type: int
+            else:
+                stop = len(self._data)
+            pieces.append(self._data[self._position:stop])
+            self._position = stop
+        return b''.join(pieces)
+
+
+def _skip_header(reader: BgzfReader) -> None:
+    if reader.read(len(_MAGIC)) != _MAGIC:
+        raise ValueError("Not a BAM file")
+    reader.read(_INT.unpack(reader.read(_INT.size))[0])
+    for _ in range(_INT.unpack(reader.read(_INT.size))[0]):
+        reader.read(_INT.unpack(reader.read(_INT.size))[0] + _INT.size)
+
+
+def header() -> bytes:
+    """A BGZF-compressed header for an unaligned BAM file with no references"""
+    text = _HEADER_TEXT.encode('ascii') # type: bytes
+    return compress(_MAGIC + _INT.pack(len(text)) + text + _INT.pack(0))
+
+
+def is_paired(filename: str) -> bool:
+    """Are the reads in a BAM file paired? Judged from its first record"""
+    with BgzfReader(filename) as reader:
+        _skip_header(reader=reader)
+        record = reader.read(_FIXED.itemsize) # type: bytes
+    if len(record) < _FIXED.itemsize:
+        return False
+    return bool(numpy.frombuffer(record, dtype=_FIXED)['flag'][0] & 0x1)
+
+
+def index_records(filename: str, step: int) -> Tuple[int]:
+    """Find the virtual offset of every 'step'-th read in a BAM file
+    For paired files, a read is both records of a pair. The last offset is the end of the file
+    filename [str]  The BAM file to index
+    step [int]      The number of reads between offsets
+    """
+    if step < 1:
+        raise ValueError("'step' must be a positive integer")
+    paired = is_paired(filename=filename) # type: bool
+    records_per_step = step * (2 if paired else 1) # type: int
+    with BgzfReader(filename) as reader:
+        _skip_header(reader=reader)
+        offsets = [reader.tell()] # type: List[int]
+        count = 0 # type: int
+        while True:
+            size = reader.read(_INT.size) # type: bytes
+            if not size:
+                break
+            if len(reader.read(_INT.unpack(size)[0])) != _INT.unpack(size)[0]:
+                raise ValueError("%s has a truncated record" % filename)
+            count += 1
+            if not count % records_per_step:
+                offsets.append(reader.tell())
+        end = reader.tell() # type: int
+    if count % records_per_step:
+        offsets.append(end)
+    if paired and count % 2:
+        raise ValueError("%s has an unpaired record" % filename)
+    return tuple(offsets)
+
+
+def read_range(filename: str, span: Tuple[int, int]) -> bytes:
+    """Read the records between two virtual offsets"""
+    start, end = span # type: int, int
+    with BgzfReader(filename) as reader:
+        reader.seek(start)
+        return reader.read_to(end)
+
+
+def _positions(starts: numpy.ndarray, lengths: numpy.ndarray) -> numpy.ndarray:
+    """Every position within a series of (start, length) spans, in order"""
+    offsets = numpy.cumsum(lengths) - lengths # type: numpy.ndarray
+    return numpy.repeat(starts - offsets, lengths) + numpy.arange(int(lengths.sum()), dtype=numpy.int64)
+
+
+def _little(raw: numpy.ndarray, positions: numpy.ndarray, width: int) -> numpy.ndarray:
+    """Read little-endian unsigned integers at several positions"""
+    value = numpy.zeros(len(positions), dtype=numpy.int64) # type: numpy.ndarray
+    for byte in reversed(range(width)): # type: int
+        value = value << 8 | raw[positions + byte]
+    return value
+
+
+def decode(data: bytes, paired: bool=False, offset: int=33) -> bytes:
+    """Turn BAM records into FASTQ records, with pairs next to each other
+    Read names lose nothing but what BAM can't hold; tags are not kept
+    data [bytes]        Whole BAM records
+    paired [bool]=False Check that records come in first/second pairs
+    offset [int]=33     Phred offset for the quality scores written
+    """
+    starts = list() # type: List[int]
+    position = 0 # type: int
+    while position < len(data):
+        starts.append(position)
+        position += _INT.unpack_from(data, position)[0] + _INT.size
+    if position != len(data):
+        raise ValueError("Truncated BAM record")
+    if not starts:
+        return b''
+    raw = numpy.frombuffer(data, dtype=numpy.uint8) # type: numpy.ndarray
+    records = numpy.array(starts, dtype=numpy.int64) # type: numpy.ndarray
+    name_lengths = raw[records + 12].astype(numpy.int64) - 1 # type: numpy.ndarray
+    flags = _little(raw=raw, positions=records + 18, width=2) # type: numpy.ndarray
+    lengths = _little(raw=raw, positions=records + 20, width=4) # type: numpy.ndarray
+    name_starts = records + _FIXED.itemsize # type: numpy.ndarray
+    sequence_starts = name_starts + name_lengths + 1 + 4 * _little(raw=raw, positions=records + 16, width=2) # type: numpy.ndarray
+    packed_lengths = (lengths + 1) // 2 # type: numpy.ndarray
+    if paired:
+        if len(records) % 2:
+            raise ValueError("Paired BAM records must come in pairs")
+        if numpy.any(flags[0::2] & FIRST == 0) or numpy.any(flags[1::2] & SECOND == 0):
+            raise ValueError("Paired BAM records must be first and second reads next to each other")
+    #   Unpack two bases per byte, then drop the padding after odd-length sequences
+    packed = raw[_positions(starts=sequence_starts, lengths=packed_lengths)] # type: numpy.ndarray
+    nibbles = numpy.empty(2 * len(packed), dtype=numpy.uint8) # type: numpy.ndarray
+    nibbles[0::2], nibbles[1::2] = packed >> 4, packed & 15
+    sequences = _BASES[nibbles[_positions(starts=2 * (numpy.cumsum(packed_lengths) - packed_lengths), lengths=lengths)]] # type: numpy.ndarray
+    qualities = raw[_positions(starts=sequence_starts + packed_lengths, lengths=lengths)] # type: numpy.ndarray
+    #   Missing quality scores are stored as 0xff
+    qualities = numpy.where(qualities == 0xff, 0, qualities).astype(numpy.uint8) + numpy.uint8(offset)
+    #   Lay out '@name\nSEQ\n+\nQUAL\n' for every record
+    sizes = name_lengths + 2 * lengths + 6 # type: numpy.ndarray
+    fastq_starts = numpy.cumsum(sizes) - sizes # type: numpy.ndarray
+    out = numpy.empty(int(sizes.sum()), dtype=numpy.uint8) # type: numpy.ndarray
+    out[fastq_starts] = ord('@')
+    out[_positions(starts=fastq_starts + 1, lengths=name_lengths)] = raw[_positions(starts=name_starts, lengths=name_lengths)]
+    sequence_out = fastq_starts + name_lengths + 2 # type: numpy.ndarray
+    out[sequence_out - 1] = ord('\n')
+    out[_positions(starts=sequence_out, lengths=lengths)] = sequences
+    out[sequence_out + lengths] = ord('\n')
+    out[sequence_out + lengths + 1] = ord('+')
+    out[sequence_out + lengths + 2] = ord('\n')
+    out[_positions(starts=sequence_out + lengths + 3, lengths=lengths)] = qualities
+    out[fastq_starts + sizes - 1] = ord('\n')
+    return out.tobytes()
+
+
+def encode(data: bytes, paired: bool=False, offset: int=33) -> bytes:
+    """Turn FASTQ records into unmapped BAM records
+    Read names are cut at the first whitespace, as BAM names can't hold any
+    data [bytes]        Whole FASTQ records; if paired, first and second reads alternate
+    paired [bool]=False Flag records as first and second reads of pairs
+    offset [int]=33     Phred offset of the quality scores
+    """
+    if not data:
+        return b''
+    records = batch.Records.parse(data=data) # type: batch.Records
+    raw = numpy.frombuffer(data, dtype=numpy.uint8) # type: numpy.ndarray
+    name_starts, name_ends = records.names # type: numpy.ndarray, numpy.ndarray
+    name_starts, name_ends = name_starts.astype(numpy.int64), name_ends.astype(numpy.int64)
+    spaces = numpy.flatnonzero((raw == ord(' ')) | (raw == ord('\t'))) # type: numpy.ndarray
+    if len(spaces):
+        following = numpy.searchsorted(spaces, name_starts) # type: numpy.ndarray
+        name_ends = numpy.minimum(name_ends, numpy.append(spaces, len(raw))[following])
+    name_lengths = name_ends - name_starts # type: numpy.ndarray
+    sequence_starts, sequence_ends = (column.astype(numpy.int64) for column in records.sequences) # type: numpy.ndarray, numpy.ndarray
+    quality_starts = records.qualities[0].astype(numpy.int64) # type: numpy.ndarray
+    lengths = sequence_ends - sequence_starts # type: numpy.ndarray
+    packed_lengths = (lengths + 1) // 2 # type: numpy.ndarray
+    if paired:
+        if len(records) % 2:
+            raise ValueError("Paired FASTQ records must come in pairs")
+        flags = numpy.tile(numpy.array((PAIRED | FIRST, PAIRED | SECOND), dtype=numpy.uint16), len(records) // 2) # type: numpy.ndarray
+    else:
+        flags = numpy.full(len(records), UNMAPPED, dtype=numpy.uint16)
+    fixed = numpy.zeros(len(records), dtype=_FIXED) # type: numpy.ndarray
+    fixed['block_size'] = _FIXED.itemsize - _INT.size + name_lengths + 1 + packed_lengths + lengths
+    fixed['ref_id'] = fixed['pos'] = fixed['next_ref_id'] = fixed['next_pos'] = -1
+    fixed['l_read_name'] = name_lengths + 1
+    fixed['bin'] = _UNMAPPED_BIN
+    fixed['flag'] = flags
+    fixed['l_seq'] = lengths
+    #   Pack two bases per byte, padding odd-length sequences
+    nibbles = numpy.zeros(int(2 * packed_lengths.sum()), dtype=numpy.uint8) # type: numpy.ndarray
+    nibbles[_positions(starts=2 * (numpy.cumsum(packed_lengths) - packed_lengths), lengths=lengths)] = _CODES[raw[_positions(starts=sequence_starts, lengths=lengths)]]
+    packed = nibbles[0::2] << 4 | nibbles[1::2] # type: numpy.ndarray
+    #   Lay out the fixed fields, NUL-terminated name, packed sequence, and quality scores of every record
+    sizes = fixed['block_size'].astype(numpy.int64) + _INT.size # type: numpy.ndarray
+    record_starts = numpy.cumsum(sizes) - sizes # type: numpy.ndarray
+    out = numpy.zeros(int(sizes.sum()), dtype=numpy.uint8) # type: numpy.ndarray
+    out[_positions(starts=record_starts, lengths=numpy.full(len(records), _FIXED.itemsize, dtype=numpy.int64))] = fixed.view(numpy.uint8)
+    name_out = record_starts + _FIXED.itemsize # type: numpy.ndarray
+    out[_positions(starts=name_out, lengths=name_lengths)] = raw[_positions(starts=name_starts, lengths=name_lengths)]
+    sequence_out = name_out + name_lengths + 1 # type: numpy.ndarray
+    out[_positions(starts=sequence_out, lengths=packed_lengths)] = packed
+    out[_positions(starts=sequence_out + packed_lengths, lengths=lengths)] = raw[_positions(starts=quality_starts, lengths=lengths)] - numpy.uint8(offset)
+    return out.tobytes()
@@ -10,7 +10,9 @@ if not (sys.version_info.major == 3 and sys.version_info.minor >= 5):
 #   Load standard modules
 import time
 import logging
-from typing import Dict, Tuple
+import itertools
+from multiprocessing.pool import Pool
+from typing import Any, Dict, List, Optional, Sequence, Set, Tuple
 from collections import Counter
 
 #   Load custom modules
@@ -24,49 +26,147 @@ except ImportError as error:
     sys.exit("Please install " + error.name)
 
 
+#   Below this many barcodes, starting worker processes costs more than the checks save
+_PARALLEL_MINIMUM = 50000 # type: int
+#   Slices per worker, so a slow slice doesn't hold up the rest
+_SLICES_PER_WORKER = 4 # type: int
+#   How many duplicated sequences to name when logging
+_EXAMPLES = 5 # type: int
+#   Deletes plain bases, leaving only IUPAC codes
+_PLAIN = str.maketrans('', '', 'ACGT') # type: Dict[int, None]
+
+
 def expand_iupac(barcode: str) -> Tuple[str]:
     """Expand IUPAC codes, i.e. turn 'AY' to ['AC', 'AT'], removes 'N's"""
     barcode = barcode.upper()
     if all((i in 'ACGTN' for i in set(barcode))):
         return (barcode.replace('N', ''),)
-    pos = regex.search(r'[%s]' % ''.join(IUPAC_CODES.keys()), barcode).start()
-    code = barcode[pos]
-    return utilities.unpack(collection=(expand_iupac(barcode.replace(code, i, 1)) for i in IUPAC_CODES[code]))
+    choices = [IUPAC_CODES.get(base, base) for base in barcode.replace('N', '')] # type: List[str]
+    return tuple(''.join(bases) for bases in itertools.product(*choices))
+
+
+_COMPLEMENTS = str.maketrans('ACGTRYKMSWBDHVNacgtrykmswbdhvn', 'TGCAYRMKSWVHDBNtgcayrmkswvhdbn') # type: Dict[int, int]
+
+
+def reverse_complement(barcode: str) -> str:
+    """Reverse complement a barcode, IUPAC codes included"""
+    return barcode.translate(_COMPLEMENTS)[::-1]
 
 
 def read_barcodes(barcodes_file: str) -> Dict[str, str]:
     """Read the barcodes CSV"""
     logging.info("Reading in barcodes file %s", barcodes_file)
     read_start = time.time() # type: float
-    barcodes_dict = dict()
     try:
+        #   Split the whole file at once; per-line reads are most of the cost for huge whitelists
         with open(barcodes_file, 'r') as bfile:
-            for line in bfile: # type: str
-                if line.startswith('#'):
-                    continue
-                line = line.strip().split(',')
-                if len(line) == 2:
-                    barcodes_dict[line[0]] = line[1]
+            rows = [line.strip().split(',') for line in bfile.read().splitlines() if not line.startswith('#')] # type: List[List[str]]
     except FileNotFoundError:
         raise SystemExit(logging.critical("Cannot find barcodes file %s", barcodes_file))
+    rows = [row for row in rows if len(row) == 2] # type: List[List[str]]
+    barcodes_dict = dict(rows) # type: Dict[str, str]
     if not barcodes_dict:
         raise ValueError(logging.error("No barcodes found in the barcodes file"))
+    if len(barcodes_dict) < len(rows):
+        logging.warning("%s barcode names are listed more than once in %s, the last listing of each is used", len(rows) - len(barcodes_dict), barcodes_file)
     logging.debug("Reading in barcodes took %s seconds", round(time.time() - read_start, 3))
     return barcodes_dict
 
 
-def barcode_check(barcode_dict: Dict[str, str]) -> bool:
+def _distinct(sequences: Sequence[str]) -> Tuple[Set[str], Set[str]]:
+    """The distinct sequences, and those seen more than once"""
+    distinct = set(sequences) # type: Set[str]
+    if len(distinct) == len(sequences):
+        return distinct, set()
+    return distinct, {sequence for sequence, count in Counter(sequences).items() if count > 1}
+
+
+def _expand_slice(barcodes: Sequence[str]) -> Tuple[Set[str], Set[str], int]:
+    """Expand a slice of barcodes, returns the distinct sequences, those seen more than once, and the number of expansions"""
+    expanded = list(itertools.chain.from_iterable(map(expand_iupac, barcodes))) # type: List[str]
+    return _distinct(sequences=expanded) + (len(expanded),)
+
+
+def _slices(items: Sequence[Any], count: int) -> List[Sequence[Any]]:
+    size = max(-(-len(items) // count), 1) # type: int
+    return [items[start:start + size] for start in range(0, len(items), size)]
+
+
+def validate_barcodes(barcode_dict: Dict[str, str], workers: Optional[int]=1) -> Dict[str, Any]:
+    """Expand every barcode and look for sequences more than one barcode recognizes
+    Plain barcodes are checked a whole column at a time; barcodes with IUPAC codes are
+    expanded in slices over a pool of worker processes when there are enough of them,
+    then every slice's distinct sequences are compared with set operations
+    barcode_dict [Dict[str, str]]   Barcode sequences by name
+    workers [int]=1                 Number of worker processes; if None, one per core
+    Returns a report with the number of barcodes and expanded sequences, the sequences
+    recognized more than once, the barcode lengths seen, and each step's timing
+    """
+    report = {'seconds': dict()} # type: Dict[str, Any]
+    step_start = time.time() # type: float
+    barcodes = [barcode.upper().replace('N', '') for barcode in utilities.unpack(collection=barcode_dict.values())] # type: List[str]
+    plain = barcodes # type: List[str]
+    ambiguous = list() # type: List[str]
+    #   One pass over the whole column finds whether any barcode has IUPAC codes at all
+    if ''.join(barcodes).translate(_PLAIN):
+        plain = list() # type: List[str]
+        for barcode in barcodes: # type: str
+            (ambiguous if barcode.translate(_PLAIN) else plain).append(barcode)
+    report['seconds']['load'] = round(time.time() - step_start, 3)
+    step_start = time.time() # type: float
+    results = [_distinct(sequences=plain) + (len(plain),)] # type: List[Tuple[Set[str], Set[str], int]]
+    if (workers is None or workers > 1) and len(ambiguous) >= _PARALLEL_MINIMUM:
+        with Pool(processes=workers) as pool: # type: Pool
+            slices = _slices(items=ambiguous, count=_SLICES_PER_WORKER * getattr(pool, '_processes')) # type: List[Sequence[str]]
+            results.extend(pool.map(_expand_slice, slices))
+    elif ambiguous:
+        results.append(_expand_slice(barcodes=ambiguous))
+    report['seconds']['expand'] = round(time.time() - step_start, 3)
+    step_start = time.time() # type: float
+    seen = set() # type: Set[str]
+    duplicated = set() # type: Set[str]
+    for distinct, repeated, _ in results: # type: Set[str], Set[str], int
+        duplicated |= repeated
+        duplicated |= seen & distinct
+        seen |= distinct
+    report['seconds']['duplicates'] = round(time.time() - step_start, 3)
+    step_start = time.time() # type: float
+    report['lengths'] = Counter(map(len, barcodes))
+    report['seconds']['lengths'] = round(time.time() - step_start, 3)
+    report['barcodes'] = len(barcodes)
+    report['ambiguous'] = len(ambiguous)
+    report['expansions'] = sum(result[2] for result in results)
+    report['duplicates'] = tuple(sorted(duplicated))
+    return report
+
+
+def barcode_check(barcode_dict: Dict[str, str], workers: Optional[int]=1) -> bool:
     """Checks whether or not there are barcodes in use that are ambiguous and could thus recognize the same sequence.
     For example the barcodes 'AY' and 'AW' both recognize 'AT'.
     Does not check for ambiguity with regards to UMIs, i.e. strings of 'N'. So 'ACGN' and 'ACGT' are recognized as different
     even though they can both match 'ACGT'."""
     logging.info("Checking for ambiguous and duplicate barcodes")
     check_start = time.time() # type: float
-    barcodes = utilities.unpack(collection=barcode_dict.values()) # type: Iterable[str]
-    expanded_barcodes = utilities.unpack(expand_iupac(bc) for bc in barcodes) # type: Tuple[str]
-    multiplicate_barcodes = dict(filter(lambda item: item[1] > 1 , Counter(expanded_barcodes).items())) # type: Dict[str, int]
+    report = validate_barcodes(barcode_dict=barcode_dict, workers=workers) # type: Dict[str, Any]
+    logging.debug("Splitting out barcodes with IUPAC codes took %s seconds", report['seconds']['load'])
+    logging.debug("Expanding IUPAC codes took %s seconds", report['seconds']['expand'])
+    logging.debug("Finding duplicate barcodes took %s seconds", report['seconds']['duplicates'])
+    logging.debug("Checking barcode lengths took %s seconds", report['seconds']['lengths'])
+    logging.info("%s barcodes, %s with IUPAC codes, expand to %s sequences", report['barcodes'], report['ambiguous'], report['expansions'])
+    if len(report['lengths']) > 1:
+        logging.warning(
+            "Barcodes have %s different lengths: %s",
+            len(report['lengths']),
+            ', '.join('%s bp (%s)' % item for item in sorted(report['lengths'].items()))
+        )
+    if report['duplicates']:
+        logging.error(
+            "%s sequences are recognized by more than one barcode, such as %s",
+            len(report['duplicates']),
+            ', '.join(report['duplicates'][:_EXAMPLES])
+        )
     logging.debug("Checking barcode validity took %s seconds", round(time.time() - check_start, 3))
-    return bool(multiplicate_barcodes)
+    return bool(report['duplicates'])
 
 
 # def extract_barcodes(sample_sheet, barcode_csv):
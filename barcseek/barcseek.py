@@ -10,14 +10,20 @@ if not (sys.version_info.major == 3 and sys.version_info.minor >= 5):
 #   Load standard modules
 import os
 import time
-import signal
 import logging
 import warnings
 from multiprocessing import Lock
-from multiprocessing.pool import Pool
 
 #   Load custom modules
 import barcseek.barcodes as barcodes
+import barcseek.batch as batch
+import barcseek.parallel as parallel
+import barcseek.affinity as affinity
+import barcseek.discovery as discovery
+import barcseek.memory as memory
+import barcseek.executors as executors
+import barcseek.quality as quality
+import barcseek.partition as partition
 import barcseek.utilities as utilities
 import barcseek.arguments as arguments
 
@@ -51,12 +57,18 @@ def main() -> None:
     if not sys.argv[1:]:
         sys.exit(parser.print_help())
     args = vars(parser.parse_args()) # type: Dict[str, Any]
+    if args['sink_command'] and args['fifo']:
+        parser.error("Cannot pass both --sink-command and --fifo")
+    if args['spill'] and (args['sink_command'] or args['fifo']):
+        parser.error("Cannot spill outputs that are streamed")
+    if (args['sink_command'] or args['fifo']) and args['resume']:
+        parser.error("Cannot resume a run that streams its outputs")
     #   Make an output directory
     # if os.path.exists(args['outdirectory']):
     #     args['outdirectory'] = args['outdirectory'] + time.strftime('_%Y-%m-%d_%H:%M')
     os.makedirs(args['outdirectory'], exist_ok=True)
     #   Make a prefix for project-level output files
-    output_prefix = os.path.join(args['outdirectory'], sys.argv[0]) # type: str
+    output_prefix = os.path.join(args['outdirectory'], os.path.basename(sys.argv[0])) # type: str
     #   Setup the logger
     #   Formatting values
     log_format = '%(asctime)s %(levelname)s:\t%(message)s' # type: str
@@ -92,47 +104,150 @@ def main() -> None:
     #   Begin the program
     logging.info("Welcome to %s!", os.path.basename(sys.argv[0]))
     program_start = time.time() # type: float
+    #   Work out which CPUs the run may use and how many jobs to run on them
+    cpus = args['cpus'] or affinity.available_cpus() # type: Tuple[int]
+    worker_cpus = tuple(cpu for cpu in cpus if cpu not in (args['writer_cpus'] or ())) or cpus # type: Tuple[int]
+    num_workers = args['num_cores'] or affinity.default_workers(cpus=worker_cpus) # type: int
+    #   Pick where chunks run; a single job doesn't need a pool
+    executor_name = args['executor'] or ('serial' if num_workers == 1 else 'process') # type: str
+    if executor_name == 'serial':
+        num_workers = 1
+    #   Workers started later inherit where this process may run, then take their own CPUs
+    if args['writer_cpus']:
+        affinity.pin(cpus=args['writer_cpus'])
+    elif executor_name == 'serial' and args['pin'] != 'none':
+        affinity.pin(cpus=affinity.plan_placement(cpus=cpus, workers=1, placement=args['pin'])[0])
+    elif args['cpus']:
+        affinity.pin(cpus=cpus)
+    if executor_name == 'process' and args['pin'] != 'none':
+        cpu_sets = affinity.plan_placement(cpus=worker_cpus, workers=num_workers, placement=args['pin']) # type: Optional[Tuple[Tuple[int]]]
+    elif executor_name == 'process' and args['writer_cpus']:
+        cpu_sets = tuple(worker_cpus for _ in range(num_workers)) # type: Optional[Tuple[Tuple[int]]]
+    else:
+        cpu_sets = None # type: Optional[Tuple[Tuple[int]]]
+    if cpu_sets:
+        logging.info("Pinning %s workers to CPUs %s", num_workers, '; '.join(','.join(map(str, cpu_set)) for cpu_set in cpu_sets))
     #   Read in the barcodes
     barcodes_dict = barcodes.read_barcodes(barcodes_file=args['barcodes']) # type: Dict[str, str]
-    if barcodes.barcode_check(barcode_dict=barcodes_dict):
+    if barcodes.barcode_check(barcode_dict=barcodes_dict, workers=num_workers):
         raise ValueError(logging.error("Cannot have ambiguous or duplicate barcodes"))
     #   Read in the sample sheet and match barcode sequences to each sample
     sample_sheet = utilities.load_sample_sheet(sheet_file=args['sample_sheet']) # type: Dict[str, Tuple[str, Optional[str]]]
     sample_barcodes = utilities.match_barcodes(sample_sheet=sample_sheet, barcodes_dictionary=barcodes_dict) # type: Dict[str, Tuple[str, Optional[str]]]
-    print(sample_barcodes)
-    raise SystemExit
-    #   Create the multiprocessing pool
-    #   Tell the pool to ignore SIGINT (^C)
-    #   by turning INTERUPT signals into IGNORED signals
-    sigint_handler = signal.signal(signal.SIGINT, signal.SIG_IGN) # type: function
-    #   Setup our multiprocessing pool
-    #   Allow the user to specify the number of jobs to run at once
-    #   If not specified, let multiprocessing figure it out
-    if args['num_cores']:
-        pool = Pool(processes=args['num_cores'])
+    #   Read structures can come from the command line or the sample sheet
+    read_structures = args['read_structure'] or utilities.load_read_structures(sheet_file=args['sample_sheet']) # type: Tuple[str]
+    if len(read_structures) > 2:
+        parser.error("Can have at most two read structures, one for each read")
+    if read_structures:
+        logging.info("Using read structures %s", ' '.join(read_structures))
+    #   Only run the quality stage if asked to
+    if any(args[key] is not None for key in ('min_mean_quality', 'min_base_quality', 'tail_quality')):
+        quality_filter = quality.QualityFilter( # type: Optional[quality.QualityFilter]
+            window=args['barcode_window'],
+            min_mean=args['min_mean_quality'],
+            min_base=args['min_base_quality'],
+            tail_quality=args['tail_quality'],
+            min_length=args['min_length'],
+            offset=args['phred_offset']
+        )
+    else:
+        quality_filter = None # type: Optional[quality.QualityFilter]
+    #   Split the memory budget before anything sized from it is built
+    if args['max_memory']:
+        governor = memory.Governor(budget=args['max_memory'] * 1024 * 1024, workers=num_workers) # type: Optional[memory.Governor]
     else:
-        pool = Pool()
-    #   Re-enable the capturing of SIGINT, catch with KeyboardInterrupt
-    #   or ExitPool, depending on how the exit was initiated
-    #   Note: SystemExits are swallowed by Pool, no way to change that
-    signal.signal(signal.SIGINT, sigint_handler)
-    if getattr(pool, '_processes') > 1:
-        try:
-            #   Use map_async and get with a large timeout
-            #   to allow for KeyboardInterrupts to be caught
-            #   and handled with the try/except
-            pass
-        except KeyboardInterrupt:
-            pool.terminate()
-            pool.join()
-            raise SystemExit('\nkilled')
-        else:
-            pool.join()
-    #   Otherwise, don't bother with pool.map() make life easy
+        governor = None # type: Optional[memory.Governor]
+    match_cache = args['match_cache'] * 1024 * 1024 # type: int
+    if governor and match_cache:
+        match_cache = governor.cache_budget(requested=match_cache)
+    #   Build the matcher once for every lane
+    matcher = partition.Matcher( # type: partition.Matcher
+        samples=sample_barcodes,
+        error_rate=args['error'],
+        prefilter=args['prefilter'],
+        verifier=args['verifier'],
+        quality=quality_filter,
+        index=args['index'],
+        orientation=args['orientation'],
+        window=args['search_window'],
+        cache=match_cache,
+        structures=read_structures or None
+    )
+    if args['interleaved'] and args['reverse']:
+        parser.error("Cannot pass reverse FASTQ files with --interleaved")
+    lanes = tuple( # type: Tuple[parallel.Lane]
+        parallel.make_lane(forward=forward, reverse=reverse, interleaved=args['interleaved'])
+        for forward, reverse in utilities.find_lanes(forward=args['forward'], reverse=args['reverse'])
+    )
+    #   Check the sheet against a sample of reads and stop
+    if args['dry_run']:
+        for lane in lanes: # type: parallel.Lane
+            logging.info("Sampling %s reads from %s", args['sample'], lane.forward)
+            reads = discovery.sample_reads( # type: Tuple[fastq.Read]
+                forward=lane.forward,
+                reverse=lane.reverse,
+                interleaved=lane.interleaved,
+                size=args['sample'],
+                reservoir=args['reservoir']
+            )
+            discovery.log_report(report=discovery.discover(
+                reads=reads,
+                samples=sample_barcodes,
+                error_rate=args['error'],
+                verifier=args['verifier']
+            ))
+        logging.debug("Entire program took %s seconds to run", round(time.time() - program_start, 3))
+        return
+    #   Lock in the barcode orientation before the matcher is shipped to workers
+    if args['orientation'] == 'auto':
+        sample = discovery.sample_reads( # type: Tuple[fastq.Read]
+            forward=lanes[0].forward,
+            reverse=lanes[0].reverse,
+            interleaved=lanes[0].interleaved,
+            size=args['sample'],
+            reservoir=args['reservoir']
+        )
+        matcher.detect(batch=batch.ReadBatch.from_reads(reads=sample))
+    executor = executors.create( # type: executors.Executor
+        name=executor_name,
+        matcher=matcher,
+        workers=num_workers,
+        address=args['scheduler'],
+        cpu_sets=cpu_sets
+    )
+    logging.info("Running with the %s executor on %s workers", executor_name, executor.workers)
+    usage = affinity.CoreUsage(cpus=cpus) # type: affinity.CoreUsage
+    try:
+        parallel.parallelize(
+            matcher=matcher,
+            lanes=lanes,
+            directory=args['outdirectory'],
+            num_reads=args['chunk_size'],
+            executor=executor,
+            resume=args['resume'],
+            merge=args['merge'],
+            bare_plus=args['bare_plus'],
+            sink_command=args['sink_command'],
+            fifo=args['fifo'],
+            output_format=args['output_format'],
+            pair_window=args['pair_window'],
+            skip_unpaired=args['skip_unpaired'],
+            progress_interval=args['progress_interval'],
+            status_file=args['status_file'],
+            stats_formats=args['stats'] or (('pdf',) if args['stats'] is not None else ()),
+            spill_runs=args['spill'],
+            max_open_files=args['max_open_files'],
+            merge_buffer=args['merge_buffer'] * 1024 * 1024,
+            governor=governor,
+            log_assignments=args['assignment_log'],
+            sink_spill=args['sink_spill'] * 1024 * 1024
+        )
+    except KeyboardInterrupt:
+        executor.terminate()
+        raise SystemExit('\nkilled')
     else:
-        #   Clean up the pool
-        pool.close(); pool.terminate(); pool.join()
-        #   Use standard map
+        executor.close()
+    usage.log()
     #   End the program
     logging.debug("Entire program took %s seconds to run", round(time.time() - program_start, 3))
     devnull.close()
@@ -140,17 +255,6 @@ def main() -> None:
         logfile.close()
     except NameError:
         pass
-    # from parallel import parallelize
-    # if args['numlines'] %4 != 0:
-    #     raise InputError('-l  must be divisible by four'+str(args['numlines']))
-    # sample_dict = extract_barcodes(args['sample'],args['barcodes'])
-    # barcode_ambiguity_dict = barcode_check(sample_dict)
-    # if barcode_ambiguity_dict:
-    #     raise InputError("There are ambiguous barcodes \n" + str(json.dumps(barcode_ambiguity_dict, indent=2)))
-    # #call the parallel layer which does the work:
-    # '''def parallelize(barcodes:tuple, samples:dict, num_chunks:int, forward_fastq:str,
-    #             reverse_fastq:Optional(str) = None)'''
-    # parallelize(sample_dict, args['forward'], args['num_lines'], reverse_fastq = args['reverse'])
 
 
 if __name__ == '__main__':
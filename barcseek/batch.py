@@ -0,0 +1,381 @@
+#!/usr/bin/env python3
+
+"""Columnar batches of reads"""
+
+import sys
+if not (sys.version_info.major == 3 and sys.version_info.minor >= 5):
+    sys.exit("Please use Python 3.5 or higher for this module: " + __name__)
+
+
+#   Load standard modules
+import copy
+import logging
+import itertools
+import functools
+from typing import Any, Callable, List, Optional, Sequence, Tuple
+
+#   Load custom modules
+import barcseek.fastq as fastq
+
+#   Load installed modules
+try:
+    import numpy
+except ImportError as error:
+    sys.exit("Please install " + error.name)
+
+
+_LINES_PER_RECORD = 4 # type: int
+_NEWLINE = ord('\n') # type: int
+_RETURN = ord('\r') # type: int
+_AT = ord('@') # type: int
+_PLUS = ord('+') # type: int
+
+
+class Records(object):
+
+    """The records of one FASTQ file as columns
+    Every record stays in one decoded buffer; names, sequences, and quality scores
+    are (start, end) offset arrays into that buffer, so nothing is copied per read
+    """
+
+    def __init__(self, data: bytes, names: Tuple, sequences: Tuple, qualities: Tuple) -> None:
+        """
+    data [bytes]        The FASTQ records
+    names [Tuple]       Start and end offsets of each read ID, without the '@'
+    sequences [Tuple]   Start and end offsets of each sequence
+    qualities [Tuple]   Start and end offsets of each quality score
+    """
+        self._data = memoryview(data) # type: memoryview
+        self._text = data.decode('ascii') # type: str
+        self._names = names # type: Tuple[numpy.ndarray, numpy.ndarray]
+        self._sequences = sequences # type: Tuple[numpy.ndarray, numpy.ndarray]
+        self._qualities = qualities # type: Tuple[numpy.ndarray, numpy.ndarray]
+        self._offsets = None # type: Optional[Tuple[List[int], ...]]
+
+    @classmethod
+    def parse(cls, data: bytes) -> 'Records':
+        """Find the fields of every record in a block of four-line FASTQ records
+        data [bytes]    Whole FASTQ records
+        """
+        raw = numpy.frombuffer(data, dtype=numpy.uint8) # type: numpy.ndarray
+        ends = numpy.flatnonzero(raw == _NEWLINE) # type: numpy.ndarray
+        #   Count a final line without a trailing newline
+        if data and data[-1] != _NEWLINE:
+            ends = numpy.append(ends, len(data))
+        if len(ends) % _LINES_PER_RECORD:
+            raise ValueError("Records must be four lines long")
+        starts = numpy.concatenate(([0], ends[:-1] + 1)).astype(ends.dtype) # type: numpy.ndarray
+        #   Leave off carriage returns from Windows line endings
+        if len(ends):
+            ends = ends - ((ends > starts) & (raw[numpy.maximum(ends - 1, 0)] == _RETURN))
+        headers, pluses = starts[0::_LINES_PER_RECORD], starts[2::_LINES_PER_RECORD] # type: numpy.ndarray, numpy.ndarray
+        if numpy.any(ends[0::_LINES_PER_RECORD] == headers) or numpy.any(raw[headers] != _AT):
+            raise ValueError("Records must start with '@'")
+        if numpy.any(ends[2::_LINES_PER_RECORD] == pluses) or numpy.any(raw[pluses] != _PLUS):
+            raise ValueError("Records must have a '+' line")
+        sequences = (starts[1::_LINES_PER_RECORD], ends[1::_LINES_PER_RECORD]) # type: Tuple[numpy.ndarray, numpy.ndarray]
+        qualities = (starts[3::_LINES_PER_RECORD], ends[3::_LINES_PER_RECORD]) # type: Tuple[numpy.ndarray, numpy.ndarray]
+        if numpy.any(sequences[1] - sequences[0] != qualities[1] - qualities[0]):
+            raise ValueError("Sequences and quality scores must be the same length")
+        return cls(
+            data=data,
+            names=(headers + 1, ends[0::_LINES_PER_RECORD]),
+            sequences=sequences,
+            qualities=qualities
+        )
+
+    def __len__(self) -> int:
+        return len(self._names[0])
+
+    def _select(self, rows: Any) -> 'Records':
+        """Some of the records, sharing this buffer"""
+        records = copy.copy(self) # type: Records
+        records._names = tuple(column[rows] for column in self._names)
+        records._sequences = tuple(column[rows] for column in self._sequences)
+        records._qualities = tuple(column[rows] for column in self._qualities)
+        records._offsets = None
+        return records
+
+    def deinterleave(self) -> Tuple['Records', 'Records']:
+        """Split interleaved records into first and second reads, sharing this buffer"""
+        if len(self) % 2:
+            raise ValueError("Interleaved records must come in pairs")
+        return self._select(rows=slice(0, None, 2)), self._select(rows=slice(1, None, 2))
+
+    def name(self, index: int) -> str:
+        """The read ID of one record"""
+        return self._text[self._names[0][index]:self._names[1][index]]
+
+    def sequence(self, index: int) -> str:
+        """The sequence of one record"""
+        return self._text[self._sequences[0][index]:self._sequences[1][index]]
+
+    def quality(self, index: int) -> str:
+        """The quality scores of one record"""
+        return self._text[self._qualities[0][index]:self._qualities[1][index]]
+
+    def _get_text(self) -> str:
+        return self._text
+
+    def _get_data(self) -> memoryview:
+        return self._data
+
+    def _get_names(self) -> Tuple[numpy.ndarray, numpy.ndarray]:
+        return self._names
+
+    def _get_sequences(self) -> Tuple[numpy.ndarray, numpy.ndarray]:
+        return self._sequences
+
+    def _get_qualities(self) -> Tuple[numpy.ndarray, numpy.ndarray]:
+        return self._qualities
+
+    def truncate(self, lengths: numpy.ndarray) -> None:
+        """Shorten reads by moving their end offsets
+        lengths [numpy.ndarray]     The new length of every read, no longer than the current length
+        """
+        if numpy.any(lengths > self._sequences[1] - self._sequences[0]):
+            raise ValueError("Reads can only be shortened")
+        self._sequences = (self._sequences[0], self._sequences[0] + lengths)
+        self._qualities = (self._qualities[0], self._qualities[0] + lengths)
+        self._offsets = None
+
+    def _get_spans(self) -> Tuple[List[int], List[int]]:
+        return self._sequences[0].tolist(), self._sequences[1].tolist()
+
+    def render(self, buffer: bytearray, index: int, cuts: Sequence[Tuple[int, int]]=(), bare_plus: bool=False) -> None:
+        """Write one record in FASTQ format onto the end of a buffer
+        The record is copied straight from the original bytes, one slice per span
+        of sequence kept, without building any strings
+        buffer [bytearray]                  The buffer to write to
+        index [int]                         Which record to write
+        cuts [Sequence[Tuple[int, int]]]    Spans of the buffer to cut out, left to right
+        bare_plus [bool]=False              Write a bare '+' line rather than repeating the read ID
+        """
+        if self._offsets is None:
+            #   Plain lists index much faster than arrays one record at a time
+            self._offsets = tuple(column.tolist() for column in self._names + self._sequences + self._qualities[:1])
+        name_starts, name_ends, starts, ends, quality_starts = self._offsets # type: List[int], List[int], List[int], List[int], List[int]
+        data = self._data # type: memoryview
+        name = data[name_starts[index]:name_ends[index]] # type: memoryview
+        start, end = starts[index], ends[index] # type: int, int
+        shift = quality_starts[index] - start # type: int
+        buffer += b'@'
+        buffer += name
+        buffer += b'\n'
+        if cuts:
+            intervals = fastq.keep_intervals(start=start, end=end, cuts=cuts) # type: List[Tuple[int, int]]
+            for keep_start, keep_end in intervals: # type: int, int
+                buffer += data[keep_start:keep_end]
+        else:
+            intervals = ((start, end),)
+            buffer += data[start:end]
+        if bare_plus:
+            buffer += b'\n+\n'
+        else:
+            buffer += b'\n+'
+            buffer += name
+            buffer += b'\n'
+        for keep_start, keep_end in intervals: # type: int, int
+            buffer += data[keep_start + shift:keep_end + shift]
+        buffer += b'\n'
+
+    text = property(fget=_get_text, doc='The decoded FASTQ records')
+    data = property(fget=_get_data, doc='The raw FASTQ records')
+    names = property(fget=_get_names, doc='Start and end offsets of each read ID as arrays')
+    sequences = property(fget=_get_sequences, doc='Start and end offsets of each sequence as arrays')
+    qualities = property(fget=_get_qualities, doc='Start and end offsets of each quality score as arrays')
+    spans = property(fget=_get_spans, doc='Start and end offsets of each sequence as lists')
+
+
+def _extend(
+        context: Callable[[], Tuple[Tuple[bytes, Optional[bytes]], Tuple[bytes, Optional[bytes]]]],
+        data: bytes,
+        reverse: Optional[bytes]=None
+) -> Tuple[Records, Records, Tuple[int, int]]:
+    """Parse records with their neighbours' around them
+    Returns the forward and reverse records, and how many of each come before the ones given
+    context [Callable]      Gives the forward and reverse records just before and just after, empty at the ends
+                            of a file and None in place of reverse records for interleaved records
+    data [bytes]            Forward or interleaved FASTQ records
+    reverse [bytes]=None    Reverse FASTQ records, None if 'data' is interleaved
+    """
+    (forward_before, reverse_before), (forward_after, reverse_after) = context()
+    if reverse is None:
+        forward, mates = Records.parse(data=forward_before + data + forward_after).deinterleave() # type: Records, Records
+        lead = forward_before.count(b'\n') // (2 * _LINES_PER_RECORD) # type: int
+        return forward, mates, (lead, lead)
+    return (
+        Records.parse(data=forward_before + data + forward_after),
+        Records.parse(data=reverse_before + reverse + reverse_after),
+        (forward_before.count(b'\n') // _LINES_PER_RECORD, reverse_before.count(b'\n') // _LINES_PER_RECORD)
+    )
+
+
+class ReadBatch(object):
+
+    """A batch of reads from a FASTQ file (or paired FASTQ files) held as columns
+    Matching works on offsets into one buffer per file rather than on a 'fastq.Read'
+    per record; trims are spans of that buffer to leave out when writing
+    """
+
+    def __init__(self, forward: Records, reverse: Optional[Records]=None) -> None:
+        """
+    forward [Records]       Forward or single records
+    reverse [Records]=None  Optional reverse records, in the same order
+    """
+        if reverse is not None and len(reverse) != len(forward):
+            raise ValueError("Forward and reverse records must have the same number of reads")
+        self._forward = forward # type: Records
+        self._reverse = reverse # type: Optional[Records]
+        self._unpaired = 0 # type: int
+        #   Where each read's forward record was in the data, if pairing dropped or moved any
+        self._rows = None # type: Optional[numpy.ndarray]
+
+    @classmethod
+    def from_bytes(
+            cls,
+            data: bytes,
+            reverse: Optional[bytes]=None,
+            window: int=0,
+            skip_unpaired: bool=False,
+            context: Optional[Callable[[], Tuple[Tuple[bytes, bytes], Tuple[bytes, bytes]]]]=None
+    ) -> 'ReadBatch':
+        """Build a batch from whole FASTQ records
+        data [bytes]                Forward or single FASTQ records
+        reverse [bytes]=None        Optional reverse FASTQ records
+        window [int]=0              How far out of order a read may be from its mate
+        skip_unpaired [bool]=False  Leave out reads without a mate rather than raising an error
+        context [Callable]=None     Gives the forward and reverse records just before and just after these,
+                                    empty at the ends of the files, so mates out of step across either edge
+                                    can be found; only called if the reads are out of step
+        """
+        forward = Records.parse(data=data) # type: Records
+        if reverse is None:
+            return cls(forward=forward)
+        return cls._synced(
+            forward=forward,
+            reverse=Records.parse(data=reverse),
+            window=window,
+            skip_unpaired=skip_unpaired,
+            extend=functools.partial(_extend, context=context, data=data, reverse=reverse) if context else None
+        )
+
+    @classmethod
+    def from_interleaved(
+            cls,
+            data: bytes,
+            window: int=0,
+            skip_unpaired: bool=False,
+            context: Optional[Callable[[], Tuple[Tuple[bytes, None], Tuple[bytes, None]]]]=None
+    ) -> 'ReadBatch':
+        """Build a paired batch from FASTQ records where each pair is next to each other
+        data [bytes]                Interleaved FASTQ records
+        window [int]=0              How far out of order a read may be from its mate
+        skip_unpaired [bool]=False  Leave out reads without a mate rather than raising an error
+        context [Callable]=None     Gives the interleaved records (and None) just before and just after these
+        """
+        forward, reverse = Records.parse(data=data).deinterleave() # type: Records, Records
+        return cls._synced(
+            forward=forward,
+            reverse=reverse,
+            window=window,
+            skip_unpaired=skip_unpaired,
+            extend=functools.partial(_extend, context=context, data=data) if context else None
+        )
+
+    @classmethod
+    def _synced(
+            cls,
+            forward: Records,
+            reverse: Records,
+            window: int,
+            skip_unpaired: bool,
+            extend: Optional[Callable[[], Tuple[Records, Records, Tuple[int, int]]]]=None
+    ) -> 'ReadBatch':
+        """Pair forward and reverse records by normalized read ID
+        Pairs already in step are kept as they are; otherwise records are put
+        back in step with 'fastq.PairSync', leaving out any without a mate. So the
+        reorder window reaches past the edges of the batch, 'extend' gives the
+        records with their neighbours' around them: a pair belongs to the batch
+        holding its forward read, and only this batch's reads can be unpaired here
+        """
+        forward_ids = [fastq.normalize_id(read_id=forward.name(index)) for index in range(len(forward))] # type: List[str]
+        reverse_ids = [fastq.normalize_id(read_id=reverse.name(index)) for index in range(len(reverse))] # type: List[str]
+        if forward_ids == reverse_ids:
+            return cls(forward=forward, reverse=reverse)
+        counts, leads = (len(forward), len(reverse)), (0, 0) # type: Tuple[int, int], Tuple[int, int]
+        if extend is not None:
+            forward, reverse, leads = extend()
+            forward_ids = [fastq.normalize_id(read_id=forward.name(index)) for index in range(len(forward))]
+            reverse_ids = [fastq.normalize_id(read_id=reverse.name(index)) for index in range(len(reverse))]
+        #   Reads left over in the neighbours are theirs to count, so count this batch's here
+        sync = fastq.PairSync(window=window, skip_unpaired=True) # type: fastq.PairSync
+        found = list(sync.pair(forward=zip(forward_ids, itertools.count()), reverse=zip(reverse_ids, itertools.count()))) # type: List[Tuple[int, int]]
+        paired = numpy.array(found, dtype=numpy.int64).reshape(-1, 2) # type: numpy.ndarray
+        lost = tuple( # type: Tuple[numpy.ndarray, numpy.ndarray]
+            numpy.setdiff1d(numpy.arange(leads[side], leads[side] + counts[side]), paired[:, side], assume_unique=True)
+            for side in range(2)
+        )
+        if not skip_unpaired:
+            for records, missing, stream in zip((forward, reverse), lost, ('Forward', 'Reverse')): # type: Records, numpy.ndarray, str
+                if len(missing):
+                    raise ValueError(logging.error("%s read %s has no mate within %s reads", stream, records.name(int(missing[0])), window))
+        paired = paired[(paired[:, 0] >= leads[0]) & (paired[:, 0] < leads[0] + counts[0])]
+        rows = paired[numpy.argsort(paired[:, 0], kind='stable')] # type: numpy.ndarray
+        batch = cls(forward=forward._select(rows=rows[:, 0]), reverse=reverse._select(rows=rows[:, 1])) # type: ReadBatch
+        batch._unpaired = len(lost[0]) + len(lost[1])
+        batch._rows = rows[:, 0] - leads[0]
+        return batch
+
+    @classmethod
+    def from_reads(cls, reads: Sequence[fastq.Read]) -> 'ReadBatch':
+        """Build a batch from 'fastq.Read' objects, paired if every read is paired
+        reads [Sequence[fastq.Read]]    The reads to put in the batch
+        """
+        data = ''.join(read.fastq + '\n' for read in reads).encode('ascii') # type: bytes
+        if reads and all(read.paired for read in reads):
+            reverse = ''.join(read.reverse_fastq + '\n' for read in reads).encode('ascii') # type: Optional[bytes]
+        else:
+            reverse = None
+        return cls.from_bytes(data=data, reverse=reverse)
+
+    def __len__(self) -> int:
+        return len(self._forward)
+
+    def __iter__(self):
+        for index in range(len(self)): # type: int
+            yield self.read(index=index)
+
+    def _is_paired(self) -> bool:
+        return self._reverse is not None
+
+    def _get_forward(self) -> Records:
+        return self._forward
+
+    def _get_reverse(self) -> Optional[Records]:
+        return self._reverse
+
+    def _get_unpaired(self) -> int:
+        return self._unpaired
+
+    def _get_rows(self) -> Optional[numpy.ndarray]:
+        return self._rows
+
+    def read(self, index: int) -> fastq.Read:
+        """Get one read as a 'fastq.Read'"""
+        forward = self._forward # type: Records
+        if self._reverse is None:
+            return fastq.Read(read_id=forward.name(index), seq=forward.sequence(index), qual=forward.quality(index))
+        return fastq.Read(
+            read_id=forward.name(index),
+            seq=forward.sequence(index),
+            qual=forward.quality(index),
+            rev=self._reverse.sequence(index),
+            rev_qual=self._reverse.quality(index)
+        )
+
+    paired = property(fget=_is_paired, doc='Is this batch paired?')
+    forward = property(fget=_get_forward, doc='Forward or single records')
+    reverse = property(fget=_get_reverse, doc='Reverse records, None for single-end data')
+    unpaired = property(fget=_get_unpaired, doc='Number of reads left out for having no mate')
+    rows = property(fget=_get_rows, doc="Position of each read's forward record in the data it came from, None if every record was kept in order")
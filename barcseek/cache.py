@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+
+"""A bounded cache of match results for duplicated barcode windows"""
+
+import sys
+if not (sys.version_info.major == 3 and sys.version_info.minor >= 5):
+    sys.exit("Please use Python 3.5 or higher for this module: " + __name__)
+
+
+#   Load standard modules
+import collections
+from typing import Any, Dict, Hashable, Optional, Tuple
+
+#   Rough cost of one entry besides its key's bases: the key tuple and strings,
+#   the result tuple and its spans, and the ordered dict's own bookkeeping
+_ENTRY_BYTES = 400 # type: int
+_STRING_BYTES = 49 # type: int
+
+
+def entry_size(key: Tuple[str, ...]) -> int:
+    """Approximate memory held by one cached result, in bytes"""
+    return _ENTRY_BYTES + sum(_STRING_BYTES + len(sequence) for sequence in key)
+
+
+class MatchCache(object):
+
+    """A least-recently-used map from searched sequences to match results
+    Amplicon and screen libraries repeat the same few barcode windows over and
+    over; keeping their results turns most searches into a dict lookup. Entries
+    are evicted oldest first once the memory budget is spent
+    """
+
+    def __init__(self, budget: int) -> None:
+        """
+    budget [int]    Memory to spend on cached results, in bytes
+    """
+        if budget <= 0:
+            raise ValueError("'budget' must be positive")
+        self._budget = budget # type: int
+        self._entries = collections.OrderedDict() # type: collections.OrderedDict
+        self._nbytes = 0 # type: int
+        self.hits = 0 # type: int
+        self.misses = 0 # type: int
+        self.evictions = 0 # type: int
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def __getstate__(self) -> Dict[str, Any]:
+        #   Ship an empty cache to workers; each fills its own
+        state = self.__dict__.copy() # type: Dict[str, Any]
+        state['_entries'] = collections.OrderedDict()
+        state['_nbytes'] = 0
+        return state
+
+    def get(self, key: Tuple[str, ...]) -> Optional[Any]:
+        """Look a result up, marking it as recently used; None if it isn't cached"""
+        try:
+            value = self._entries[key] # type: Any
+        except KeyError:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key: Tuple[str, ...], value: Any) -> None:
+        """Cache a result, evicting the least recently used ones to stay in budget"""
+        size = entry_size(key=key) # type: int
+        if size > self._budget or key in self._entries:
+            return
+        while self._nbytes + size > self._budget:
+            old_key, _ = self._entries.popitem(last=False) # type: Tuple[str, ...], Any
+            self._nbytes -= entry_size(key=old_key)
+            self.evictions += 1
+        self._entries[key] = value
+        self._nbytes += size
+
+    def clear(self) -> None:
+        """Drop every cached result, keeping the counters"""
+        self._entries.clear()
+        self._nbytes = 0
+
+    def counts(self) -> collections.Counter:
+        """Hits, misses, and evictions so far"""
+        return collections.Counter(hits=self.hits, misses=self.misses, evictions=self.evictions)
+
+    def _get_budget(self) -> int:
+        return self._budget
+
+    def _hit_rate(self) -> float:
+        lookups = self.hits + self.misses # type: int
+        return self.hits / lookups if lookups else 0.0
+
+    def _bytes(self) -> int:
+        return self._nbytes
+
+    budget = property(fget=_get_budget, doc='Memory to spend on cached results, in bytes')
+    hit_rate = property(fget=_hit_rate, doc='Fraction of lookups found in the cache')
+    nbytes = property(fget=_bytes, doc='Approximate memory held by cached results, in bytes')
+
+
+def hit_rate(counts: Dict[Hashable, int]) -> float:
+    """Fraction of lookups found in the cache from hit and miss counts"""
+    lookups = counts.get('hits', 0) + counts.get('misses', 0) # type: int
+    return counts.get('hits', 0) / lookups if lookups else 0.0
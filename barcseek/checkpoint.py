@@ -0,0 +1,260 @@
+#!/usr/bin/env python3
+
+"""Checkpoint manifests for resumable runs"""
+
+import sys
+if not (sys.version_info.major == 3 and sys.version_info.minor >= 5):
+    sys.exit("Please use Python 3.5 or higher for this module: " + __name__)
+
+
+#   Load standard modules
+import os
+import json
+import logging
+from collections import Counter
+from typing import Any, Dict, Iterable, Optional, Set, Tuple
+
+#   Load custom modules
+import barcseek.chunks as chunks
+
+_MANIFEST_VERSION = 1 # type: int
+#   Chunks committed since the manifest was last written in full, one JSON line each
+_JOURNAL_SUFFIX = '.journal' # type: str
+
+
+def fingerprint(filename: Optional[str]) -> Optional[Dict[str, Any]]:
+    """Describe an input file well enough to notice if it changes between runs
+    filename [str]  The file to describe, may be None
+    """
+    if not filename:
+        return None
+    info = os.stat(filename) # type: os.stat_result
+    return {'path': os.path.abspath(filename), 'size': info.st_size, 'mtime': int(info.st_mtime)}
+
+
+class Manifest(object):
+
+    """A record of which chunks have been demultiplexed and flushed to disk
+    After every chunk is appended to the per-sample outputs, the outputs are
+    synced and their sizes are written to the manifest together with the chunk's
+    byte ranges. On resume, outputs are truncated back to those sizes so that any
+    partially appended chunk is dropped, and finished chunks are skipped
+    Rather than rewriting the whole manifest for every chunk, each commit appends
+    one line to a journal next to it; loading replays the journal, and 'save'
+    folds it back into the manifest
+    """
+
+    def __init__(self, filename: Optional[str], parameters: Dict[str, Any]) -> None:
+        """
+    filename [str]                      Where to store the manifest; if None, the manifest
+                                        is only kept in memory and is never saved
+    parameters [Dict[str, Any]]:        Inputs and settings for this run; a manifest
+                                        can only be resumed with identical parameters
+    """
+        self._filename = filename # type: Optional[str]
+        self._parameters = json.loads(json.dumps(parameters)) # type: Dict[str, Any]
+        self._chunks = dict() # type: Dict[str, Dict[str, Any]]
+        self._outputs = dict() # type: Dict[str, int]
+        self._counts = dict() # type: Dict[str, Dict[str, int]]
+        self._stages = dict() # type: Dict[str, Dict[str, int]]
+        self._distances = dict() # type: Dict[str, Dict[str, Dict[str, int]]]
+        self._finished = set() # type: Set[Tuple[int, int]]
+        #   Has the manifest been written in full since the journal was started?
+        self._saved = False # type: bool
+
+    def __contains__(self, chunk: chunks.Chunk) -> bool:
+        return all((chunk.lane, block) in self._finished for block in range(chunk.index, chunk.index + chunk.blocks))
+
+    def __len__(self) -> int:
+        return len(self._finished)
+
+    @staticmethod
+    def _key(chunk: chunks.Chunk) -> str:
+        return '%s:%s' % (chunk.lane, chunk.index)
+
+    @staticmethod
+    def _describe(chunk: chunks.Chunk) -> Dict[str, Any]:
+        return {
+            'lane': chunk.lane,
+            'forward': list(chunk.forward),
+            'reverse': list(chunk.reverse) if chunk.reverse else None,
+            'blocks': chunk.blocks
+        }
+
+    @classmethod
+    def load(cls, filename: str, parameters: Dict[str, Any]) -> 'Manifest':
+        """Load a manifest, starting a new one if it doesn't exist
+        filename [str]                  The manifest file
+        parameters [Dict[str, Any]]:    Inputs and settings for this run
+        """
+        manifest = cls(filename=filename, parameters=parameters) # type: Manifest
+        try:
+            with open(filename, 'r') as mfile:
+                contents = json.load(mfile) # type: Dict[str, Any]
+        except FileNotFoundError:
+            logging.warning("No checkpoint found at %s, starting from the beginning", filename)
+            return manifest
+        if contents.get('version') != _MANIFEST_VERSION:
+            raise ValueError(logging.error("Checkpoint %s was made by an incompatible version", filename))
+        if contents.get('parameters') != manifest._parameters:
+            raise ValueError(logging.error("Checkpoint %s was made with different inputs or settings", filename))
+        manifest._chunks = contents['chunks']
+        manifest._outputs = contents['outputs']
+        manifest._counts = contents['counts']
+        manifest._stages = contents.get('stages', {})
+        manifest._distances = contents.get('distances', {})
+        for entry in manifest._journal(): # type: Dict[str, Any]
+            manifest._apply(entry=entry)
+        for key, record in manifest._chunks.items(): # type: str, Dict[str, Any]
+            lane, index = map(int, key.split(':')) # type: int, int
+            manifest._finished.update((lane, block) for block in range(index, index + record['blocks']))
+        #   Start a fresh journal from everything recovered so far
+        manifest.save()
+        logging.info("Resuming from checkpoint %s with %s blocks already done", filename, len(manifest))
+        return manifest
+
+    def _journal_name(self) -> str:
+        return self._filename + _JOURNAL_SUFFIX
+
+    def _journal(self) -> Iterable[Dict[str, Any]]:
+        """Every complete entry in the journal, in the order they were committed"""
+        try:
+            with open(self._journal_name(), 'r') as jfile:
+                for line in jfile: # type: str
+                    #   A crash partway through a commit leaves a line without its newline; that chunk isn't done
+                    if not line.endswith('\n'):
+                        logging.debug("Ignoring a partial commit at the end of %s", self._journal_name())
+                        break
+                    yield json.loads(line)
+        except FileNotFoundError:
+            return
+
+    def _apply(self, entry: Dict[str, Any]) -> None:
+        """Fold one journal entry into the manifest"""
+        key = entry['key'] # type: str
+        self._chunks[key] = entry['chunk']
+        self._outputs.update(entry['outputs'])
+        self._counts[key] = entry['counts']
+        if entry.get('stages'):
+            self._stages[key] = entry['stages']
+        if entry.get('distances'):
+            self._distances[key] = entry['distances']
+
+    def save(self) -> None:
+        """Atomically write the whole manifest to disk and empty the journal"""
+        if not self._filename:
+            return
+        contents = { # type: Dict[str, Any]
+            'version': _MANIFEST_VERSION,
+            'parameters': self._parameters,
+            'chunks': self._chunks,
+            'outputs': self._outputs,
+            'counts': self._counts,
+            'stages': self._stages,
+            'distances': self._distances
+        }
+        temp = self._filename + '.tmp' # type: str
+        with open(temp, 'w') as mfile:
+            json.dump(contents, mfile)
+            mfile.flush()
+            os.fsync(mfile.fileno())
+        os.replace(temp, self._filename)
+        #   Everything in the journal is in the manifest now
+        try:
+            os.remove(self._journal_name())
+        except FileNotFoundError:
+            pass
+        self._saved = True
+
+    def restore(self, outputs: Iterable[str]) -> None:
+        """Truncate outputs to their checkpointed sizes, removing any partial tail
+        outputs [Iterable[str]]     Every output file for this run
+        """
+        for output in outputs: # type: str
+            size = self._outputs.get(output, 0) # type: int
+            with open(output, 'ab') as ofile:
+                if ofile.tell() > size:
+                    logging.debug("Truncating partial output in %s", output)
+                ofile.truncate(size)
+
+    def commit(
+            self,
+            chunk: chunks.Chunk,
+            outputs: Iterable[str],
+            counts: Optional[Dict[str, int]]=None,
+            stages: Optional[Dict[str, int]]=None,
+            distances: Optional[Dict[Tuple[str, int], int]]=None
+    ) -> None:
+        """Record that a chunk has been written and synced to every output
+        chunk [chunks.Chunk]                            The chunk that was written
+        outputs [Iterable[str]]                         Every output file for this run
+        counts [Dict[str, int]]=None                    Number of reads written to each category
+        stages [Dict[str, int]]=None                    Number of reads stopped or trimmed at each quality stage
+        distances [Dict[Tuple[str, int], int]]=None     Number of reads assigned to each sample at each edit distance
+        """
+        sizes = dict() # type: Dict[str, int]
+        for output in outputs: # type: str
+            size = os.path.getsize(output) # type: int
+            #   Only outputs this chunk grew need to go in its entry
+            if self._outputs.get(output) != size:
+                sizes[output] = size
+        by_sample = dict() # type: Dict[str, Dict[str, int]]
+        for (sample, distance), count in (distances or {}).items(): # type: (str, int), int
+            by_sample.setdefault(sample, dict())[str(distance)] = count
+        entry = { # type: Dict[str, Any]
+            'key': self._key(chunk),
+            'chunk': self._describe(chunk),
+            'outputs': sizes,
+            'counts': dict(counts or {}),
+            'stages': dict(stages or {}),
+            'distances': by_sample
+        }
+        self._apply(entry=entry)
+        self._finished.update((chunk.lane, block) for block in range(chunk.index, chunk.index + chunk.blocks))
+        if not self._filename:
+            return
+        if not self._saved:
+            #   The journal needs the manifest's parameters beside it to be resumed
+            self.save()
+            return
+        with open(self._journal_name(), 'a') as jfile:
+            jfile.write(json.dumps(entry) + '\n')
+            jfile.flush()
+            os.fsync(jfile.fileno())
+
+    def chunks(self) -> Tuple[Tuple[int, int]]:
+        """The lane and first block of every finished chunk, in input order"""
+        return tuple(sorted(tuple(map(int, key.split(':'))) for key in self._chunks))
+
+    def counts(self) -> Counter:
+        """Total number of reads written to each category by finished chunks"""
+        totals = Counter() # type: Counter
+        for counts in self._counts.values(): # type: Dict[str, int]
+            totals.update(counts)
+        return totals
+
+    def stages(self) -> Counter:
+        """Total number of reads stopped or trimmed at each quality stage by finished chunks"""
+        totals = Counter() # type: Counter
+        for stages in self._stages.values(): # type: Dict[str, int]
+            totals.update(stages)
+        return totals
+
+    def distances(self) -> Counter:
+        """Total number of reads assigned to each sample at each edit distance by finished chunks, keyed by (sample, distance)"""
+        totals = Counter() # type: Counter
+        for by_sample in self._distances.values(): # type: Dict[str, Dict[str, int]]
+            for sample, counts in by_sample.items(): # type: str, Dict[str, int]
+                totals.update({(sample, int(distance)): count for distance, count in counts.items()})
+        return totals
+
+    def remove(self) -> None:
+        """Remove the manifest and its journal from disk"""
+        if not self._filename:
+            return
+        for name in (self._filename, self._journal_name()): # type: str
+            try:
+                os.remove(name)
+            except FileNotFoundError:
+                pass
+        self._saved = False
@@ -0,0 +1,504 @@
+#!/usr/bin/env python3
+
+"""Plan and read byte-range chunks of FASTQ files"""
+
+import sys
+if not (sys.version_info.major == 3 and sys.version_info.minor >= 5):
+    sys.exit("Please use Python 3.5 or higher for this module: " + __name__)
+
+
+#   Load standard modules
+import os
+import gzip
+import zlib
+import time
+import logging
+import functools
+import collections
+from typing import Callable, Dict, Iterator, Optional, Sequence, Tuple, List
+
+#   Load custom modules
+import barcseek.bam as bam
+import barcseek.batch as batch
+
+#   Load installed modules
+try:
+    import numpy
+except ImportError as error:
+    sys.exit("Please install " + error.name)
+
+
+BLOCK_READS = 5000 # type: int
+_BLOCK_SIZE = 4 * 1024 * 1024 # type: int
+#   Bytes on disk to read at a time while planning as a file is read
+_RAW_READ = 256 * 1024 # type: int
+#   Have zlib expect a gzip header and trailer
+_GZIP_WBITS = 31 # type: int
+_LINES_PER_RECORD = 4 # type: int
+_NEWLINE = ord('\n') # type: int
+
+#   A piece of a FASTQ file (or paired FASTQ files) made of one or more consecutive blocks
+#   'lane' is the position of the file(s) among the lanes of a run
+#   'index' is the position of this chunk's first block in the file(s)
+#   'forward' and 'reverse' are (start, end) byte offsets, 'reverse' is None for single-end and interleaved data;
+#   offsets into BAM and BGZF-compressed FASTQ files are BGZF virtual offsets
+#   'blocks' is the number of blocks in this chunk
+Chunk = collections.namedtuple('Chunk', ('lane', 'index', 'forward', 'reverse', 'blocks'))
+
+
+def _open(filename: str, mode: str='rb'):
+    if os.path.splitext(filename)[-1] == '.gz':
+        return gzip.open(filename, mode)
+    return open(filename, mode)
+
+
+def random_access(filename: str) -> bool:
+    """Can chunks of a file be read from anywhere in it? Plain gzip can only be read in order"""
+    return os.path.splitext(filename)[-1] != '.gz' or bam.is_bgzf(filename=filename)
+
+
+def virtual_offsets(filename: Optional[str]) -> bool:
+    """Are offsets into a file BGZF virtual offsets? True for BAM and BGZF-compressed FASTQ files"""
+    return bool(filename) and (bam.is_bam(filename=filename) or bam.is_bgzf(filename=filename))
+
+
+def _blocks(filename: str) -> Iterator[Tuple[int, bytes]]:
+    """Read a file a block at a time as (offset of the block's first byte, block)
+    Offsets for BGZF files are virtual offsets, so offsets within a block are still the
+    block's offset plus a position; BGZF blocks are inflated on every CPU at once.
+    Offsets for plain gzip are in the uncompressed stream
+    """
+    if bam.is_bgzf(filename=filename):
+        with bam.BgzfReader(filename) as reader:
+            for start, data in reader.blocks(threads=os.cpu_count() or 1): # type: int, bytes
+                if data:
+                    yield start << 16, data
+        return
+    position = 0 # type: int
+    with _open(filename) as ffile:
+        while True:
+            block = ffile.read(_BLOCK_SIZE) # type: bytes
+            if not block:
+                break
+            yield position, block
+            position += len(block)
+
+
+def index_records(filename: str, step: int) -> Tuple[int]:
+    """Find the offset of every 'step'-th record in a FASTQ file
+    Records must be four lines long; offsets for BGZF files are virtual offsets, and
+    offsets for other gzipped files are in the uncompressed stream. The last offset is
+    the end of the file. Plain gzip is better planned while it's read, see 'BlockStream'
+    filename [str]  The FASTQ file to index
+    step [int]      The number of records between offsets
+    """
+    if step < 1:
+        raise ValueError("'step' must be a positive integer")
+    lines_per_step = step * _LINES_PER_RECORD # type: int
+    offsets = [0] # type: List[int]
+    end = 0 # type: int
+    lines = 0 # type: int
+    last = b'' # type: bytes
+    for base, block in _blocks(filename=filename): # type: int, bytes
+        newlines = numpy.flatnonzero(numpy.frombuffer(block, dtype=numpy.uint8) == _NEWLINE) # type: numpy.ndarray
+        #   The first newline in this block that closes a step
+        first = lines_per_step - lines % lines_per_step - 1 # type: int
+        offsets.extend(base + int(pos) + 1 for pos in newlines[first::lines_per_step])
+        lines += len(newlines)
+        end = base + len(block)
+        last = block[-1:]
+    #   Count a final line without a trailing newline
+    if last and last != b'\n':
+        lines += 1
+    if lines % _LINES_PER_RECORD:
+        raise ValueError("%s does not look like a four-line FASTQ file" % filename)
+    if offsets[-1] != end:
+        offsets.append(end)
+    return tuple(offsets)
+
+
+def plan_chunks(
+        forward: str,
+        reverse: Optional[str]=None,
+        num_reads: int=BLOCK_READS,
+        lane: int=0,
+        interleaved: bool=False
+) -> Tuple[Chunk]:
+    """Split a FASTQ file (or paired FASTQ files) into chunks of 'num_reads' reads
+    Unaligned BAM files are split by record; for paired BAM or interleaved FASTQ
+    files, a read is both halves of a pair, so pairs are never split across chunks
+    forward [str]               Forward or single FASTQ filename, or a BAM filename
+    reverse [str]=None          Optional reverse FASTQ filename
+    num_reads [int]=5000        Number of reads per chunk
+    lane [int]=0                Which lane of the run these files are
+    interleaved [bool]=False    Are both reads of each pair in 'forward'?
+    """
+    logging.info("Planning chunks of %s reads for %s", num_reads, forward)
+    plan_start = time.time() # type: float
+    if bam.is_bam(filename=forward):
+        forward_offsets = bam.index_records(filename=forward, step=num_reads) # type: Tuple[int]
+    else:
+        forward_offsets = index_records(filename=forward, step=num_reads * (2 if interleaved else 1))
+    if reverse:
+        reverse_offsets = index_records(filename=reverse, step=num_reads) # type: Optional[Tuple[int]]
+        if len(reverse_offsets) != len(forward_offsets):
+            raise ValueError(logging.error("%s and %s have different numbers of reads", forward, reverse))
+    else:
+        reverse_offsets = None
+    chunks = list() # type: List[Chunk]
+    for index in range(len(forward_offsets) - 1): # type: int
+        chunks.append(Chunk(
+            lane=lane,
+            index=index,
+            forward=forward_offsets[index:index + 2],
+            reverse=reverse_offsets[index:index + 2] if reverse_offsets else None,
+            blocks=1
+        ))
+    logging.debug("Planning %s chunks took %s seconds", len(chunks), round(time.time() - plan_start, 3))
+    return tuple(chunks)
+
+
+def merge_chunks(pieces: Sequence[Chunk]) -> Chunk:
+    """Merge consecutive chunks into one chunk
+    pieces [Sequence[Chunk]]    Chunks to merge, in order and without gaps
+    """
+    first, last = pieces[0], pieces[-1] # type: Chunk, Chunk
+    if last.index + last.blocks - first.index != sum(piece.blocks for piece in pieces):
+        raise ValueError("Can only merge consecutive chunks")
+    if any(piece.lane != first.lane for piece in pieces):
+        raise ValueError("Can only merge chunks from the same lane")
+    return Chunk(
+        lane=first.lane,
+        index=first.index,
+        forward=(first.forward[0], last.forward[1]),
+        reverse=(first.reverse[0], last.reverse[1]) if first.reverse else None,
+        blocks=last.index + last.blocks - first.index
+    )
+
+
+def _read_bytes(filename: str, span: Tuple[int, int]) -> bytes:
+    if bam.is_bgzf(filename=filename):
+        return bam.read_range(filename=filename, span=span)
+    if os.path.splitext(filename)[-1] == '.gz':
+        raise ValueError("%s is gzipped but not BGZF, so its chunks can only be read in order with a BlockStream" % filename)
+    start, end = span # type: int, int
+    with _open(filename) as ffile:
+        ffile.seek(start)
+        return ffile.read(end - start)
+
+
+def _edge(data: Optional[bytes], records: int, last: bool=False) -> Optional[bytes]:
+    """The first, or last, 'records' of some whole four-line FASTQ records, all of them if there are fewer"""
+    if data is None:
+        return None
+    lines = records * _LINES_PER_RECORD # type: int
+    if last:
+        position = len(data) - 1 if data.endswith(b'\n') else len(data) # type: int
+        for _ in range(lines):
+            position = data.rfind(b'\n', 0, position)
+            if position < 0:
+                return data
+        return data[position + 1:]
+    position = -1
+    for _ in range(lines):
+        position = data.find(b'\n', position + 1)
+        if position < 0:
+            return data
+    return data[:position + 1]
+
+
+def _neighbour(block: Optional[Chunk], forward: str, reverse: Optional[str], interleaved: bool) -> Tuple[bytes, Optional[bytes]]:
+    """Read a block next to a chunk, empty past the ends of the file(s)"""
+    if block is None:
+        return b'', None if interleaved else b''
+    if bam.is_bam(filename=forward):
+        return bam.decode(data=bam.read_range(filename=forward, span=block.forward), paired=interleaved), None
+    return _read_bytes(filename=forward, span=block.forward), None if interleaved else _read_bytes(filename=reverse, span=block.reverse)
+
+
+def _context(
+        neighbours: Tuple[Optional[Chunk], Optional[Chunk]],
+        edges: Optional[Tuple[Optional[Tuple[bytes, Optional[bytes]]], Optional[Tuple[bytes, Optional[bytes]]]]],
+        forward: str,
+        reverse: Optional[str],
+        interleaved: bool,
+        window: int
+) -> Tuple[Tuple[bytes, Optional[bytes]], Tuple[bytes, Optional[bytes]]]:
+    """The last 'window' reads before a chunk and the first 'window' after it, for 'batch.ReadBatch'"""
+    records = window * (2 if interleaved else 1) # type: int
+    around = list() # type: List[Tuple[bytes, Optional[bytes]]]
+    for position, block in enumerate(neighbours): # type: int, Optional[Chunk]
+        if edges is not None:
+            data = edges[position] or (b'', None if interleaved else b'') # type: Tuple[bytes, Optional[bytes]]
+        else:
+            data = _neighbour(block=block, forward=forward, reverse=reverse, interleaved=interleaved)
+        around.append(tuple(_edge(data=piece, records=records, last=not position) for piece in data))
+    return around[0], around[1]
+
+
+class _RecordReader(object):
+
+    """Read whole four-line FASTQ records from the start of a file, a number of them at a time
+    Gzipped files are inflated here rather than through 'gzip', which reads ahead on disk,
+    so where each piece read ends both on disk and inflated is known; how far into the file
+    on disk a record ends is then worked out from where it sits in its piece
+    """
+
+    def __init__(self, filename: str) -> None:
+        self._filename = filename # type: str
+        self._handle = open(filename, 'rb')
+        #   Members of a gzipped file are inflated one after another
+        self._inflater = zlib.decompressobj(wbits=_GZIP_WBITS) if os.path.splitext(filename)[-1] == '.gz' else None
+        self._rest = b'' # type: bytes
+        self._position = 0 # type: int
+        #   Where pieces not yet handed out in full end, as (offset once inflated, offset on disk)
+        self._marks = collections.deque(((0, 0),)) # type: collections.deque
+
+    def _on_disk(self, offset: int) -> int:
+        """Roughly where an offset in the inflated stream falls in the file on disk"""
+        while len(self._marks) > 1 and self._marks[1][0] <= offset:
+            self._marks.popleft()
+        inflated, on_disk = self._marks[0] # type: int, int
+        if len(self._marks) == 1 or offset == inflated:
+            return on_disk
+        next_inflated, next_on_disk = self._marks[1] # type: int, int
+        return on_disk + (next_on_disk - on_disk) * (offset - inflated) // (next_inflated - inflated)
+
+    def _read(self) -> bytes:
+        """Read the next piece of the file, inflated if it's gzipped; empty at the end"""
+        while True:
+            raw = self._handle.read(_RAW_READ) # type: bytes
+            if self._inflater is None:
+                return raw
+            if not raw:
+                if not self._inflater.eof and self._handle.tell():
+                    raise ValueError("%s ends partway through a gzip member" % self._filename)
+                return raw
+            data = self._inflater.decompress(raw) # type: bytes
+            while self._inflater.eof and self._inflater.unused_data:
+                rest = self._inflater.unused_data # type: bytes
+                self._inflater = zlib.decompressobj(wbits=_GZIP_WBITS)
+                data += self._inflater.decompress(rest)
+            if data:
+                return data
+
+    def read(self, records: int) -> Tuple[int, bytes, int, int]:
+        """Read the next 'records' records, fewer at the end of the file
+        Returns the offset of the first one in the uncompressed stream, the records, how many there
+        are, and how far into the file on disk reading has got
+        """
+        lines = records * _LINES_PER_RECORD # type: int
+        pieces = [self._rest] # type: List[bytes]
+        counted = self._rest.count(b'\n') # type: int
+        while counted < lines:
+            block = self._read() # type: bytes
+            if not block:
+                break
+            pieces.append(block)
+            counted += block.count(b'\n')
+            self._marks.append((self._marks[-1][0] + len(block), self._handle.tell()))
+        data = b''.join(pieces) # type: bytes
+        if counted >= lines:
+            end = int(numpy.flatnonzero(numpy.frombuffer(data, dtype=numpy.uint8) == _NEWLINE)[lines - 1]) + 1 # type: int
+        else:
+            #   Count a final line without a trailing newline
+            if data and not data.endswith(b'\n'):
+                counted += 1
+            if counted % _LINES_PER_RECORD:
+                raise ValueError("%s does not look like a four-line FASTQ file" % self._filename)
+            records, end = counted // _LINES_PER_RECORD, len(data)
+        start, self._rest = self._position, data[end:] # type: int, bytes
+        self._position += end
+        return start, data[:end], records, self._on_disk(offset=self._position)
+
+    def close(self) -> None:
+        self._handle.close()
+
+
+class BlockStream(object):
+
+    """Plan and read the blocks of a lane in one pass, for gzipped files that aren't BGZF
+    Plain gzip can only be read from the start, so rather than decompressing it once to
+    plan blocks and again to read them, each block is found as the lane is read: it's the
+    next 'num_reads' reads, kept until its chunk is handed out. Offsets are in the
+    uncompressed streams, as 'plan_chunks' would give them
+    """
+
+    def __init__(
+            self,
+            forward: str,
+            reverse: Optional[str]=None,
+            num_reads: int=BLOCK_READS,
+            lane: int=0,
+            interleaved: bool=False,
+            window: int=0
+    ) -> None:
+        """
+    forward [str]               Forward or single FASTQ filename
+    reverse [str]=None          Optional reverse FASTQ filename
+    num_reads [int]=5000        Number of reads per block
+    lane [int]=0                Which lane of the run these files are
+    interleaved [bool]=False    Are both reads of each pair in 'forward'?
+    window [int]=0              How far out of order a read may be from its mate; this many reads
+                                either side of each block are kept for 'edges'
+    """
+        self._names = (forward, reverse) # type: Tuple[str, Optional[str]]
+        self._readers = tuple(_RecordReader(filename=filename) for filename in filter(None, self._names)) # type: Tuple[_RecordReader, ...]
+        self._records = num_reads * (2 if interleaved else 1) # type: int
+        self._edge_records = window * (2 if interleaved else 1) # type: int
+        self._lane = lane # type: int
+        self._index = 0 # type: int
+        self._compressed = 0 # type: int
+        self._skipped = 0 # type: int
+        self._finished = False # type: bool
+        #   Data and bytes on disk of every block read but not yet handed out or finished
+        self._data = dict() # type: Dict[int, Tuple[bytes, Optional[bytes]]]
+        self._sizes = dict() # type: Dict[int, int]
+        #   The reads just before and just after every block not yet finished, the data of the last block
+        #   read, and a block read early to find the reads after the one before it
+        self._edges = dict() # type: Dict[int, List[Optional[Tuple[bytes, Optional[bytes]]]]]
+        self._last = None # type: Optional[Tuple[bytes, Optional[bytes]]]
+        self._ahead = collections.deque() # type: collections.deque
+
+    def _trim(self, data: Optional[Tuple[bytes, Optional[bytes]]], last: bool) -> Optional[Tuple[bytes, Optional[bytes]]]:
+        if data is None:
+            return None
+        return tuple(_edge(data=piece, records=self._edge_records, last=last) for piece in data)
+
+    def _read_block(self) -> Optional[Tuple[Chunk, Tuple[bytes, Optional[bytes]], int]]:
+        """Read the next block from the files, with its data and bytes on disk; None at the end of the lane"""
+        if self._finished:
+            return None
+        pieces = tuple(reader.read(records=self._records) for reader in self._readers) # type: Tuple[Tuple[int, bytes, int, int], ...]
+        if len(set(piece[2] for piece in pieces)) > 1:
+            raise ValueError(logging.error("%s and %s have different numbers of reads", *self._names))
+        if not pieces[0][2]:
+            self._finished = True
+            return None
+        compressed = sum(piece[3] for piece in pieces) # type: int
+        block = Chunk( # type: Chunk
+            lane=self._lane,
+            index=self._index,
+            forward=(pieces[0][0], pieces[0][0] + len(pieces[0][1])),
+            reverse=(pieces[1][0], pieces[1][0] + len(pieces[1][1])) if len(pieces) > 1 else None,
+            blocks=1
+        )
+        self._index += 1
+        size, self._compressed = compressed - self._compressed, compressed # type: int, int
+        data = (pieces[0][1], pieces[1][1] if len(pieces) > 1 else None) # type: Tuple[bytes, Optional[bytes]]
+        if self._edge_records:
+            if block.index - 1 in self._edges:
+                self._edges[block.index - 1][1] = self._trim(data=data, last=False)
+            self._edges[block.index] = [self._trim(data=self._last, last=True), None]
+            self._last = data
+        return block, data, size
+
+    def next_block(self, skip: Optional[Callable[[Chunk], bool]]=None) -> Optional[Chunk]:
+        """Read the next block, None at the end of the lane
+        skip [Callable[[Chunk], bool]]=None     Pass over blocks this is True for, such as ones already done
+        """
+        while True:
+            read = self._ahead.popleft() if self._ahead else self._read_block() # type: Optional[Tuple[Chunk, Tuple[bytes, Optional[bytes]], int]]
+            if read is None:
+                return None
+            block, data, size = read # type: Chunk, Tuple[bytes, Optional[bytes]], int
+            if skip is not None and skip(block):
+                self._skipped += size
+                self._edges.pop(block.index, None)
+                continue
+            self._data[block.index] = data
+            self._sizes[block.index] = size
+            return block
+
+    def edges(self, chunk: Chunk) -> Tuple[Optional[Tuple[bytes, Optional[bytes]]], Optional[Tuple[bytes, Optional[bytes]]]]:
+        """The forward and reverse bytes of the 'window' reads just before and just after a chunk, None past
+        the ends of the lane, reading the next block early if it hasn't been read yet
+        """
+        if not self._edge_records:
+            return None, None
+        last = chunk.index + chunk.blocks - 1 # type: int
+        if self._edges[last][1] is None and not self._finished:
+            read = self._read_block() # type: Optional[Tuple[Chunk, Tuple[bytes, Optional[bytes]], int]]
+            if read is not None:
+                self._ahead.append(read)
+        return self._edges[chunk.index][0], self._edges[last][1]
+
+    def take(self, chunk: Chunk) -> Tuple[bytes, Optional[bytes]]:
+        """Hand over the data of every block in a chunk, dropping it from the stream"""
+        pieces = tuple(self._data.pop(index) for index in range(chunk.index, chunk.index + chunk.blocks)) # type: Tuple[Tuple[bytes, Optional[bytes]], ...]
+        return b''.join(forward for forward, _ in pieces), b''.join(reverse for _, reverse in pieces) if chunk.reverse else None
+
+    def finish(self, chunk: Chunk) -> int:
+        """Mark a chunk as done, returning how many bytes on disk its blocks took up"""
+        for index in range(chunk.index, chunk.index + chunk.blocks): # type: int
+            self._edges.pop(index, None)
+        return sum(self._sizes.pop(index) for index in range(chunk.index, chunk.index + chunk.blocks))
+
+    def close(self) -> None:
+        """Close the files"""
+        for reader in self._readers: # type: _RecordReader
+            reader.close()
+
+    def _get_skipped(self) -> int:
+        return self._skipped
+
+    def _get_size(self) -> int:
+        return sum(os.path.getsize(filename) for filename in filter(None, self._names))
+
+    skipped = property(fget=_get_skipped, doc='Bytes on disk of the blocks passed over so far')
+    size = property(fget=_get_size, doc='Bytes on disk of every file in the lane')
+
+
+def read_batch(
+        chunk: Chunk,
+        forward: str,
+        reverse: Optional[str]=None,
+        interleaved: bool=False,
+        window: int=0,
+        skip_unpaired: bool=False,
+        data: Optional[Tuple[Optional[bytes], Optional[bytes]]]=None,
+        neighbours: Optional[Tuple[Optional[Chunk], Optional[Chunk]]]=None,
+        edges: Optional[Tuple[Optional[Tuple[bytes, Optional[bytes]]], Optional[Tuple[bytes, Optional[bytes]]]]]=None
+) -> batch.ReadBatch:
+    """Read the reads within a chunk as one columnar batch
+    chunk [Chunk]               The chunk to read
+    forward [str]               Forward or single FASTQ filename, or a BAM filename
+    reverse [str]=None          Optional reverse FASTQ filename
+    interleaved [bool]=False    Are both reads of each pair in 'forward'?
+    window [int]=0              How far out of order a read may be from its mate
+    skip_unpaired [bool]=False  Leave out reads without a mate rather than raising an error
+    data [Tuple]=None           The chunk's forward and reverse bytes if already read, such as from a
+                                'BlockStream'; either may be None to read it here
+    neighbours [Tuple]=None     The blocks just before and just after the chunk, None past the ends of
+                                the file(s); read only if the chunk's reads are out of step, so mates
+                                within 'window' reads of each other across its edges are found
+    edges [Tuple]=None          The forward and reverse bytes of the reads either side of the chunk if
+                                already read, such as from 'BlockStream.edges', in place of 'neighbours'
+    """
+    forward_data, reverse_data = data or (None, None) # type: Optional[bytes], Optional[bytes]
+    if bam.is_bam(filename=forward):
+        forward_data = bam.decode(data=bam.read_range(filename=forward, span=chunk.forward), paired=interleaved)
+    elif forward_data is None:
+        forward_data = _read_bytes(filename=forward, span=chunk.forward)
+    context = None # type: Optional[Callable[[], Tuple[Tuple[bytes, Optional[bytes]], Tuple[bytes, Optional[bytes]]]]]
+    if window and (neighbours or edges):
+        context = functools.partial(
+            _context,
+            neighbours=neighbours or (None, None),
+            edges=edges,
+            forward=forward,
+            reverse=reverse,
+            interleaved=interleaved,
+            window=window
+        )
+    if interleaved:
+        return batch.ReadBatch.from_interleaved(data=forward_data, window=window, skip_unpaired=skip_unpaired, context=context)
+    if reverse and chunk.reverse and reverse_data is None:
+        reverse_data = _read_bytes(filename=reverse, span=chunk.reverse)
+    return batch.ReadBatch.from_bytes(
+        data=forward_data,
+        reverse=reverse_data if reverse and chunk.reverse else None,
+        window=window,
+        skip_unpaired=skip_unpaired,
+        context=context
+    )
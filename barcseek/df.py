@@ -1,13 +1,12 @@
 
 from dask import dataframe as dd
-from dask import multiprocessing
 import dask
 import logging
 import json
 
 logging.basicConfig(filename='parallel.log', filemode="w", level=logging.DEBUG, format='%(asctime)s %(message)s',
                     datefmt='%m/%d/%Y %I:%M:%S %p')
-dask.set_options(get=multiprocessing.get)
+dask.config.set(scheduler='processes')
 
 
 def mangle_partition(par):
@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+
+"""Check a sample sheet against a sample of reads before a full run"""
+
+import sys
+if not (sys.version_info.major == 3 and sys.version_info.minor >= 5):
+    sys.exit("Please use Python 3.5 or higher for this module: " + __name__)
+
+
+#   Load standard modules
+import time
+import random
+import logging
+import itertools
+from collections import Counter
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+#   Load custom modules
+import barcseek.bam as bam
+import barcseek.batch as batch
+import barcseek.fastq as fastq
+import barcseek.chunks as chunks
+import barcseek.barcodes as barcodes
+import barcseek.partition as partition
+import barcseek.utilities as utilities
+
+#   Load installed modules
+try:
+    import regex
+except ImportError as error:
+    sys.exit("Please install " + error.name)
+
+
+SAMPLE_SIZE = 10000 # type: int
+MAX_OFFSET = 20 # type: int
+_TOP_KMERS = 5 # type: int
+_ORIENTATIONS = ('as given', 'reverse complemented') # type: Tuple[str]
+_SLOTS = ('forward', 'reverse') # type: Tuple[str]
+
+
+def _iter_reads(forward: str, reverse: Optional[str]=None, interleaved: bool=False) -> Iterator[fastq.Read]:
+    if bam.is_bam(filename=forward):
+        for chunk in chunks.plan_chunks(forward=forward, interleaved=interleaved): # type: chunks.Chunk
+            yield from chunks.read_batch(chunk=chunk, forward=forward, interleaved=interleaved)
+    else:
+        yield from utilities.iter_fastq(fastq_file=forward, pair=reverse, interleaved=interleaved)
+
+
+def sample_reads(
+        forward: str,
+        reverse: Optional[str]=None,
+        interleaved: bool=False,
+        size: int=SAMPLE_SIZE,
+        reservoir: bool=False,
+        seed: int=0
+) -> Tuple[fastq.Read]:
+    """Take a sample of reads from a lane
+    forward [str]               Forward or single FASTQ filename, or a BAM filename
+    reverse [str]=None          Optional reverse FASTQ filename
+    interleaved [bool]=False    Are both reads of each pair in 'forward'?
+    size [int]=10000            How many reads to take
+    reservoir [bool]=False      Sample evenly from the whole input rather than taking the first reads;
+                                this reads the whole input once but holds only the sample
+    seed [int]=0                Seed for reservoir sampling
+    """
+    reads = _iter_reads(forward=forward, reverse=reverse, interleaved=interleaved) # type: Iterator[fastq.Read]
+    if not reservoir:
+        return tuple(itertools.islice(reads, size))
+    generator = random.Random(seed) # type: random.Random
+    sample = list(itertools.islice(reads, size)) # type: List[fastq.Read]
+    for seen, read in enumerate(reads, start=size + 1): # type: int, fastq.Read
+        slot = generator.randrange(seen) # type: int
+        if slot < size:
+            sample[slot] = read
+    return tuple(sample)
+
+
+def _slot_pattern(slot_barcodes: List[str]):
+    """One anchored pattern matching any barcode of a slot exactly, IUPAC codes and 'N's included"""
+    alternatives = sorted(set( # type: List[str]
+        partition.fix_iupac(barcode=barcode.upper().replace(',', '')).replace('N', '[ACGTN]')
+        for barcode in slot_barcodes
+    ))
+    return regex.compile('|'.join('(?:%s)' % alternative for alternative in alternatives))
+
+
+def discover(
+        reads: Tuple[fastq.Read],
+        samples: Dict[str, Tuple[str, Optional[str]]],
+        error_rate: int=1,
+        verifier: str=partition.VERIFIERS[0],
+        max_offset: int=MAX_OFFSET
+) -> Dict[str, Any]:
+    """Find how well a sample sheet fits a sample of reads
+    For each barcode slot, counts the most frequent k-mers at every offset and
+    finds the offset and orientation where the sheet's barcodes turn up most;
+    then assigns the sample with the sheet as given and with each slot reverse
+    complemented to estimate the assignment rate of a full run
+    reads [Tuple[fastq.Read]]                       The sample of reads
+    samples [Dict[str, Tuple[str, Optional[str]]]]  Barcodes for each sample, from 'utilities.match_barcodes'
+    error_rate [int]=1                              Errors allowed when assigning reads
+    verifier [str]='regex'                          Verifier used when assigning reads
+    max_offset [int]=20                             Furthest offset from the start of a read to look for barcodes
+    """
+    discovery_start = time.time() # type: float
+    report = {'reads': len(reads), 'slots': {}, 'orientations': {}} # type: Dict[str, Any]
+    if not reads:
+        return report
+    paired = all(read.paired for read in reads) # type: bool
+    slots = 2 if paired and any(len(tuple(filter(None, bcs))) > 1 for bcs in samples.values()) else 1 # type: int
+    for slot in range(slots): # type: int
+        slot_barcodes = [bcs[slot] for bcs in samples.values() if len(bcs) > slot and bcs[slot]] # type: List[str]
+        if not slot_barcodes:
+            continue
+        sequences = [read.reverse if slot else read.forward for read in reads] # type: List[str]
+        length = Counter(len(barcode.replace(',', '')) for barcode in slot_barcodes).most_common(1)[0][0] # type: int
+        hits = dict() # type: Dict[Tuple[str, int], int]
+        for orientation, flip in zip(_ORIENTATIONS, (False, True)): # type: str, bool
+            pattern = _slot_pattern(slot_barcodes=[barcodes.reverse_complement(barcode=bc) if flip else bc for bc in slot_barcodes])
+            for offset in range(max_offset + 1): # type: int
+                hits[(orientation, offset)] = sum(1 for sequence in sequences if pattern.match(sequence, offset))
+        (orientation, offset), count = max(hits.items(), key=lambda item: (item[1], item[0][0] == _ORIENTATIONS[0], -item[0][1]))
+        kmers = Counter(sequence[offset:offset + length] for sequence in sequences if len(sequence) >= offset + length) # type: Counter
+        report['slots'][_SLOTS[slot]] = {
+            'orientation': orientation,
+            'offset': offset,
+            'exact_rate': round(count / len(reads), 4),
+            'top_kmers': kmers.most_common(_TOP_KMERS)
+        }
+    #   Assign the sample with every combination of orientations
+    matcher = partition.Matcher(samples=samples, error_rate=error_rate, verifier=verifier, orientation='auto') # type: partition.Matcher
+    rates = matcher.rates(batch=batch.ReadBatch.from_reads(reads=reads)) # type: Dict[Tuple[bool, bool], float]
+    for flips, rate in rates.items(): # type: Tuple[bool, bool], float
+        name = ', '.join('%s %s' % (_SLOTS[slot], _ORIENTATIONS[flip]) for slot, flip in enumerate(flips[:slots])) # type: str
+        report['orientations'][name] = round(rate, 4)
+    report['best'] = max(report['orientations'].items(), key=lambda item: item[1])[0]
+    report['seconds'] = round(time.time() - discovery_start, 3)
+    return report
+
+
+def log_report(report: Dict[str, Any]) -> None:
+    """Log what 'discover' found"""
+    logging.info("Checked the sample sheet against %s reads in %s seconds", report['reads'], report.get('seconds', 0))
+    for slot, found in report['slots'].items(): # type: str, Dict[str, Any]
+        logging.info(
+            "%s barcodes: %s%% of reads match exactly at offset %s, %s",
+            slot.capitalize(),
+            round(100 * found['exact_rate'], 1),
+            found['offset'],
+            found['orientation']
+        )
+        logging.info(
+            "Most frequent %s k-mers at offset %s: %s",
+            slot,
+            found['offset'],
+            ', '.join('%s (%s)' % kmer for kmer in found['top_kmers'])
+        )
+    for name, rate in report['orientations'].items(): # type: str, float
+        logging.info("Expected assignment rate with %s: %s%%", name, round(100 * rate, 1))
+    if report['orientations']:
+        logging.info("Best orientation: %s", report['best'])
@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+
+"""Execution backends for running chunks of work"""
+
+import sys
+if not (sys.version_info.major == 3 and sys.version_info.minor >= 5):
+    sys.exit("Please use Python 3.5 or higher for this module: " + __name__)
+
+
+#   Load standard modules
+import queue
+import signal
+import logging
+import collections
+import multiprocessing
+from multiprocessing.pool import Pool
+from typing import Any, Callable, Dict, Optional, Sequence, Tuple
+
+#   Load custom modules
+import barcseek.affinity as affinity
+import barcseek.partition as partition
+
+EXECUTORS = ('serial', 'process', 'dask') # type: Tuple[str]
+
+#   The matcher used by this worker process, set by 'init_worker'
+_MATCHER = None # type: Optional[partition.Matcher]
+
+
+def init_worker(matcher: partition.Matcher, cpu_sets: Optional[Sequence[Tuple[int]]]=None, counter: Optional[Any]=None) -> None:
+    """Give a worker process its matcher once rather than once per task
+    matcher [partition.Matcher]             The matcher for this worker
+    cpu_sets [Sequence[Tuple[int]]]=None    CPUs for each worker to be pinned to, taken in turn
+    counter [multiprocessing.Value]=None    Shared count of workers started, to take the next CPU set
+    """
+    global _MATCHER
+    _MATCHER = matcher
+    if cpu_sets and counter is not None:
+        with counter.get_lock():
+            index = counter.value # type: int
+            counter.value += 1
+        affinity.pin(cpus=cpu_sets[index % len(cpu_sets)])
+
+
+def _call_with_matcher(function: Callable, args: Tuple, kwargs: Dict[str, Any]) -> Any:
+    return function(*args, matcher=_MATCHER, **kwargs)
+
+
+class Executor(object):
+
+    """Run tasks and hand back their results as they finish
+    Every task is called with the run's matcher as the 'matcher' keyword argument;
+    each backend makes sure the matcher is shipped to its workers only once
+    """
+
+    def __init__(self, matcher: partition.Matcher, workers: Optional[int]=None) -> None:
+        """
+    matcher [partition.Matcher]     The matcher to give to every task
+    workers [int]=None              Number of workers to run
+    """
+        self._matcher = matcher # type: partition.Matcher
+        self._workers = workers or 1 # type: int
+        self._pending = 0 # type: int
+
+    def __enter__(self) -> 'Executor':
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        if exc_type is None:
+            self.close()
+        else:
+            self.terminate()
+
+    def _num_workers(self) -> int:
+        return self._workers
+
+    def _num_pending(self) -> int:
+        return self._pending
+
+    def submit(self, function: Callable, *args, **kwargs) -> None:
+        """Queue up 'function(*args, matcher=matcher, **kwargs)'"""
+        raise NotImplementedError
+
+    def next_result(self) -> Any:
+        """Wait for a task to finish and return its result, re-raising any errors"""
+        raise NotImplementedError
+
+    def close(self) -> None:
+        """Wait for workers to finish and shut down"""
+        pass
+
+    def terminate(self) -> None:
+        """Stop workers immediately"""
+        self.close()
+
+    workers = property(fget=_num_workers, doc='Number of workers')
+    pending = property(fget=_num_pending, doc='Number of tasks submitted but not yet returned')
+
+
+class SerialExecutor(Executor):
+
+    """Run tasks one at a time in this process"""
+
+    def __init__(self, matcher: partition.Matcher, workers: Optional[int]=None) -> None:
+        super(SerialExecutor, self).__init__(matcher=matcher, workers=1)
+        self._tasks = collections.deque() # type: collections.deque
+
+    def submit(self, function: Callable, *args, **kwargs) -> None:
+        self._tasks.append((function, args, kwargs))
+        self._pending += 1
+
+    def next_result(self) -> Any:
+        function, args, kwargs = self._tasks.popleft() # type: Callable, Tuple, Dict
+        self._pending -= 1
+        return function(*args, matcher=self._matcher, **kwargs)
+
+
+class ProcessExecutor(Executor):
+
+    """Run tasks in a multiprocessing pool on this machine"""
+
+    def __init__(self, matcher: partition.Matcher, workers: Optional[int]=None, cpu_sets: Optional[Sequence[Tuple[int]]]=None) -> None:
+        """
+    matcher [partition.Matcher]             The matcher to give to every task
+    workers [int]=None                      Number of worker processes
+    cpu_sets [Sequence[Tuple[int]]]=None    CPUs to pin each worker to, in the order workers start;
+                                            workers that replace others take the next set in turn
+    """
+        super(ProcessExecutor, self).__init__(matcher=matcher, workers=workers)
+        #   Tell the pool to ignore SIGINT (^C)
+        #   by turning INTERUPT signals into IGNORED signals
+        sigint_handler = signal.signal(signal.SIGINT, signal.SIG_IGN) # type: function
+        #   Each worker gets its own copy of the matcher up front
+        self._pool = Pool( # type: Pool
+            processes=workers,
+            initializer=init_worker,
+            initargs=(matcher, cpu_sets, multiprocessing.Value('i', 0) if cpu_sets else None)
+        )
+        #   Re-enable the capturing of SIGINT, catch with KeyboardInterrupt
+        signal.signal(signal.SIGINT, sigint_handler)
+        self._workers = getattr(self._pool, '_processes') # type: int
+        self._results = queue.Queue() # type: queue.Queue
+
+    def _done(self, result: Any) -> None:
+        self._results.put((True, result))
+
+    def _failed(self, error: BaseException) -> None:
+        self._results.put((False, error))
+
+    def submit(self, function: Callable, *args, **kwargs) -> None:
+        self._pool.apply_async(
+            _call_with_matcher,
+            args=(function, args, kwargs),
+            callback=self._done,
+            error_callback=self._failed
+        )
+        self._pending += 1
+
+    def next_result(self) -> Any:
+        #   Poll with a timeout so KeyboardInterrupts are still caught
+        while True:
+            try:
+                success, result = self._results.get(timeout=1) # type: bool, Any
+            except queue.Empty:
+                continue
+            break
+        self._pending -= 1
+        if not success:
+            raise result
+        return result
+
+    def close(self) -> None:
+        self._pool.close()
+        self._pool.join()
+
+    def terminate(self) -> None:
+        self._pool.terminate()
+        self._pool.join()
+
+
+class DaskExecutor(Executor):
+
+    """Run tasks on a dask distributed cluster
+    Connects to a running scheduler if given an address, otherwise starts a
+    LocalCluster. Workers on other hosts must see the inputs and the output
+    directory at the same paths, e.g. on a shared filesystem. One matcher is
+    sent to each worker and shared by its threads; every task counts on its own
+    copy, and each thread keeps its own match cache of the full cache budget
+    """
+
+    def __init__(self, matcher: partition.Matcher, workers: Optional[int]=None, address: Optional[str]=None) -> None:
+        """
+    matcher [partition.Matcher]     The matcher to give to every task
+    workers [int]=None              Number of workers for a LocalCluster
+    address [str]=None              Address of a running dask scheduler
+    """
+        super(DaskExecutor, self).__init__(matcher=matcher, workers=workers)
+        try:
+            from distributed import Client, LocalCluster, as_completed
+        except ImportError as error:
+            sys.exit("Please install " + error.name)
+        if address:
+            logging.info("Connecting to dask scheduler at %s", address)
+            self._cluster = None # type: Optional[LocalCluster]
+            self._client = Client(address) # type: Client
+        else:
+            logging.info("Starting a local dask cluster")
+            self._cluster = LocalCluster(n_workers=workers, threads_per_worker=1, processes=True)
+            self._client = Client(self._cluster)
+        self._workers = max(len(self._client.scheduler_info()['workers']), 1)
+        #   Send the matcher to every worker once, tasks refer to it by future
+        self._matcher_future = self._client.scatter(matcher, broadcast=True)
+        self._completed = as_completed() # type: as_completed
+
+    def submit(self, function: Callable, *args, **kwargs) -> None:
+        future = self._client.submit(function, *args, matcher=self._matcher_future, pure=False, **kwargs)
+        self._completed.add(future)
+        self._pending += 1
+
+    def next_result(self) -> Any:
+        future = next(self._completed)
+        self._pending -= 1
+        return future.result()
+
+    def close(self) -> None:
+        self._client.close()
+        if self._cluster:
+            self._cluster.close()
+
+    def terminate(self) -> None:
+        self._client.cancel(list(self._completed.futures))
+        self.close()
+
+
+def create(
+        name: str,
+        matcher: partition.Matcher,
+        workers: Optional[int]=None,
+        address: Optional[str]=None,
+        cpu_sets: Optional[Sequence[Tuple[int]]]=None
+) -> Executor:
+    """Create an executor by name
+    name [str]                              One of 'serial', 'process', or 'dask'
+    matcher [partition.Matcher]             The matcher to give to every task
+    workers [int]=None                      Number of workers, None to use every core
+    address [str]=None                      Address of a running dask scheduler
+    cpu_sets [Sequence[Tuple[int]]]=None    CPUs to pin each worker to, for the 'process' executor
+    """
+    if cpu_sets and name != 'process':
+        logging.warning("Workers are only pinned to CPUs with the 'process' executor")
+    if name == 'serial':
+        return SerialExecutor(matcher=matcher)
+    elif name == 'process':
+        return ProcessExecutor(matcher=matcher, workers=workers, cpu_sets=cpu_sets)
+    elif name == 'dask':
+        return DaskExecutor(matcher=matcher, workers=workers, address=address)
+    raise ValueError("'name' must be one of '%s'" % "', '".join(EXECUTORS))
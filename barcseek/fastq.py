@@ -8,7 +8,14 @@ if not (sys.version_info.major == 3 and sys.version_info.minor >= 5):
 
 
 #   Load standard modules
-from typing import Optional, Any
+import logging
+import itertools
+import collections
+from typing import Any, Iterable, Iterator, Optional, Sequence, Tuple, List
+
+#   Counts reads dropped for having no mate
+UNPAIRED = 'unpaired' # type: str
+_MATE_SUFFIXES = ('/1', '/2') # type: Tuple[str]
 
 class Read(object):
 
@@ -114,6 +121,20 @@ class Read(object):
             self._seq = self._seq[:start] + (self._seq[end:] if end else '')
             self._qual = self._qual[:start] + (self._qual[end:] if end else '')
 
+    def keep(self, intervals: Sequence[Tuple[int, int]], reverse: bool=False) -> None:
+        """Keep only some spans of sequence, rebuilding the read once (0-based)
+        intervals [Sequence[Tuple[int, int]]]   (start, end) spans to keep, left to right
+        reverse [bool]=False                    Are we trimming the reverse read?
+        """
+        if reverse:
+            if not self.paired:
+                raise ValueError("Cannot trim a nonexistant reverse read")
+            self._rseq = ''.join(self._rseq[start:end] for start, end in intervals)
+            self._rqual = ''.join(self._rqual[start:end] for start, end in intervals)
+        else:
+            self._seq = ''.join(self._seq[start:end] for start, end in intervals)
+            self._qual = ''.join(self._qual[start:end] for start, end in intervals)
+
     read_id = property(fget=__repr__, doc='The read ID')
     name = read_id
     forward = property(fget=_forward, doc='Forward sequence')
@@ -121,3 +142,91 @@ class Read(object):
     paired = property(fget=_is_paired, doc='Is this read paired?')
     fastq = property(fget=_fastq, doc='Read in FASTQ format')
     reverse_fastq = property(fget=_rev_fastq, doc='Reverse read in FASTQ format')
+
+
+def keep_intervals(start: int, end: int, cuts: Sequence[Tuple[int, int]]) -> List[Tuple[int, int]]:
+    """Turn spans to cut out of a sequence into the spans to keep
+    start [int]                         Where the sequence starts
+    end [int]                           Where the sequence ends
+    cuts [Sequence[Tuple[int, int]]]    (start, end) spans to cut, left to right
+    """
+    intervals = list() # type: List[Tuple[int, int]]
+    position = start # type: int
+    for cut_start, cut_end in cuts: # type: int, int
+        if cut_start > position:
+            intervals.append((position, cut_start))
+        position = max(position, cut_end)
+    if end > position:
+        intervals.append((position, end))
+    return intervals
+
+
+def normalize_id(read_id: str) -> str:
+    """The part of a read ID that both reads of a pair share
+    Drops anything after the first whitespace, like Illumina's '1:N:0:ATCACG'
+    comment, and a trailing '/1' or '/2'
+    """
+    fields = read_id.split(maxsplit=1) # type: List[str]
+    name = fields[0] if fields else '' # type: str
+    if name[-2:] in _MATE_SUFFIXES:
+        name = name[:-2]
+    return name
+
+
+class PairSync(object):
+
+    """Pair up reads from two streams by read ID as they are read
+    Reads are compared in lockstep; a read whose mate hasn't turned up yet waits
+    in a reorder buffer of at most 'window' reads per stream, so memory stays
+    constant however long the streams are. A read that falls out of the buffer,
+    or is left over at the end, has lost its mate: either stop right away or
+    skip it and count it
+    """
+
+    def __init__(self, window: int=0, skip_unpaired: bool=False) -> None:
+        """
+    window [int]=0                  How many reads may wait for their mate in each stream
+    skip_unpaired [bool]=False      Skip reads without a mate rather than raising an error
+    """
+        if window < 0:
+            raise ValueError("'window' must be a non-negative integer")
+        self._window = window # type: int
+        self._skip = skip_unpaired # type: bool
+        self.unpaired = 0 # type: int
+
+    def _lost(self, read_id: str, stream: str) -> None:
+        if not self._skip:
+            raise ValueError(logging.error("%s read %s has no mate within %s reads", stream, read_id, self._window))
+        logging.debug("Skipping %s read %s, which has no mate", stream, read_id)
+        self.unpaired += 1
+
+    def pair(self, forward: Iterable[Tuple[str, Any]], reverse: Iterable[Tuple[str, Any]]) -> Iterator[Tuple[Any, Any]]:
+        """Pair up two streams of (read ID, item), yielding (forward item, reverse item)
+        forward [Iterable[Tuple[str, Any]]]     Forward read IDs and items
+        reverse [Iterable[Tuple[str, Any]]]     Reverse read IDs and items, in about the same order
+        """
+        waiting = collections.OrderedDict(), collections.OrderedDict() # type: Tuple[collections.OrderedDict, collections.OrderedDict]
+        for fread, rread in itertools.zip_longest(forward, reverse): # type: Optional[Tuple[str, Any]], Optional[Tuple[str, Any]]
+            #   In-sync pairs never touch the buffers
+            if fread is not None and rread is not None and not (waiting[0] or waiting[1]):
+                fkey, rkey = normalize_id(read_id=fread[0]), normalize_id(read_id=rread[0]) # type: str, str
+                if fkey == rkey:
+                    yield fread[1], rread[1]
+                    continue
+                waiting[0][fkey], waiting[1][rkey] = fread, rread
+            else:
+                for side, read in enumerate((fread, rread)): # type: int, Optional[Tuple[str, Any]]
+                    if read is None:
+                        continue
+                    key = normalize_id(read_id=read[0]) # type: str
+                    mate = waiting[1 - side].pop(key, None) # type: Optional[Tuple[str, Any]]
+                    if mate is None:
+                        waiting[side][key] = read
+                    else:
+                        yield (read[1], mate[1]) if side == 0 else (mate[1], read[1])
+            for side, stream in enumerate(('Forward', 'Reverse')): # type: int, str
+                while len(waiting[side]) > self._window:
+                    self._lost(read_id=waiting[side].popitem(last=False)[1][0], stream=stream)
+        for side, stream in enumerate(('Forward', 'Reverse')): # type: int, str
+            for read_id, _ in waiting[side].values(): # type: str, Any
+                self._lost(read_id=read_id, stream=stream)
@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+
+"""Compact sorted index for very large barcode whitelists"""
+
+import sys
+if not (sys.version_info.major == 3 and sys.version_info.minor >= 5):
+    sys.exit("Please use Python 3.5 or higher for this module: " + __name__)
+
+
+#   Load standard modules
+from copy import copy
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+#   Load installed modules
+try:
+    import numpy
+except ImportError as error:
+    sys.exit("Please install " + error.name)
+
+
+MAX_LENGTH = 32 # type: int
+MISSING = -1 # type: int
+AMBIGUOUS = -2 # type: int
+_TABLE_LIMIT = 1 << 20 # type: int
+_INVALID = 255 # type: int
+
+#   Two bits per base, anything else is invalid
+_CODES = numpy.full(256, _INVALID, dtype=numpy.uint8) # type: numpy.ndarray
+for _code, _base in enumerate('ACGT'): # type: int, str
+    _CODES[ord(_base)] = _CODES[ord(_base.lower())] = _code
+
+
+def _encode(sequence: str) -> numpy.ndarray:
+    return _CODES[numpy.frombuffer(sequence.encode('ascii'), dtype=numpy.uint8)]
+
+
+def pack(barcode: str) -> Optional[int]:
+    """Pack a barcode into an int, two bits per base; None if it has anything but A, C, G, or T"""
+    if len(barcode) > MAX_LENGTH:
+        raise ValueError("Barcodes can be at most %s bases long" % MAX_LENGTH)
+    key = 0 # type: int
+    for code in _encode(sequence=barcode).tolist(): # type: int
+        if code == _INVALID:
+            return None
+        key = key << 2 | code
+    return key
+
+
+def pack_kmers(sequence: str, length: int) -> Tuple[numpy.ndarray, numpy.ndarray]:
+    """Pack every 'length'-long window of a sequence
+    Returns the packed windows and where they start; windows with anything
+    but A, C, G, or T are left out
+    sequence [str]  The sequence to pack
+    length [int]    How long each window is
+    """
+    codes = _encode(sequence=sequence) # type: numpy.ndarray
+    count = len(codes) - length + 1 # type: int
+    if count < 1:
+        return numpy.zeros(0, dtype=numpy.uint64), numpy.zeros(0, dtype=numpy.int64)
+    keys = numpy.zeros(count, dtype=numpy.uint64) # type: numpy.ndarray
+    for offset in range(length): # type: int
+        keys = (keys << numpy.uint64(2)) | codes[offset:offset + count].astype(numpy.uint64)
+    invalid = numpy.concatenate(([0], numpy.cumsum(codes == _INVALID))) # type: numpy.ndarray
+    starts = numpy.flatnonzero(invalid[length:] == invalid[:count]) # type: numpy.ndarray
+    return keys[starts], starts
+
+
+class BarcodeIndex(object):
+
+    """A sorted, array-backed index of fixed-length barcodes
+    Barcodes are packed two bits per base into 64-bit keys and kept sorted next to
+    their positions in the whitelist, twelve bytes per barcode. Exact lookups are
+    binary searches. One-mismatch lookups probe the 3L neighbours of a sequence in
+    one vectorized search; their answers fill a correction table on demand, so only
+    sequences actually seen cost memory
+    """
+
+    def __init__(self, barcodes: Sequence[str]) -> None:
+        """
+    barcodes [Sequence[str]]    The whitelist; every barcode must be the same length and only A, C, G, or T
+    """
+        if not barcodes:
+            raise ValueError("Cannot index an empty whitelist")
+        self._length = len(barcodes[0]) # type: int
+        if not 0 < self._length <= MAX_LENGTH:
+            raise ValueError("Barcodes must be between 1 and %s bases long" % MAX_LENGTH)
+        joined = ''.join(barcodes) # type: str
+        #   None is longer, and together they're no shorter, so all are the same length
+        if max(map(len, barcodes)) != self._length or len(joined) != len(barcodes) * self._length:
+            raise ValueError("Every barcode in an index must be the same length")
+        codes = _encode(sequence=joined).reshape(len(barcodes), self._length) # type: numpy.ndarray
+        if numpy.any(codes == _INVALID):
+            raise ValueError("Indexed barcodes can only have A, C, G, or T")
+        keys = numpy.zeros(len(barcodes), dtype=numpy.uint64) # type: numpy.ndarray
+        for column in range(self._length): # type: int
+            keys = (keys << numpy.uint64(2)) | codes[:, column].astype(numpy.uint64)
+        order = numpy.argsort(keys, kind='stable') # type: numpy.ndarray
+        self._keys = keys[order] # type: numpy.ndarray
+        self._ids = order.astype(numpy.int32) # type: numpy.ndarray
+        duplicates = numpy.flatnonzero(self._keys[1:] == self._keys[:-1]) # type: numpy.ndarray
+        if len(duplicates):
+            raise ValueError("Barcode %s is in the whitelist more than once" % barcodes[self._ids[duplicates[0]]])
+        #   Every single-base change, as values to XOR into a key
+        self._flips = ( # type: numpy.ndarray
+            numpy.arange(1, 4, dtype=numpy.uint64)[:, None] << (numpy.uint64(2) * numpy.arange(self._length, dtype=numpy.uint64))[None, :]
+        ).ravel()
+        self._corrections = dict() # type: Dict[int, int]
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def _barcode_length(self) -> int:
+        return self._length
+
+    def _nbytes(self) -> int:
+        return self._keys.nbytes + self._ids.nbytes
+
+    def reverse_complement(self) -> 'BarcodeIndex':
+        """An index of every barcode reverse complemented, each keeping its place in the whitelist
+        Worked out from the packed keys, so no barcode is encoded again
+        """
+        #   Complementing a base flips both its bits
+        complements = ~self._keys & numpy.uint64((1 << 2 * self._length) - 1) # type: numpy.ndarray
+        keys = numpy.zeros(len(complements), dtype=numpy.uint64) # type: numpy.ndarray
+        for _ in range(self._length):
+            keys = (keys << numpy.uint64(2)) | (complements & numpy.uint64(3))
+            complements = complements >> numpy.uint64(2)
+        order = numpy.argsort(keys, kind='stable') # type: numpy.ndarray
+        flipped = copy(self) # type: BarcodeIndex
+        flipped._keys = keys[order]
+        flipped._ids = self._ids[order]
+        flipped._corrections = dict()
+        return flipped
+
+    def find(self, keys: numpy.ndarray) -> numpy.ndarray:
+        """Find the whitelist position of each packed key, MISSING if it isn't there"""
+        positions = numpy.searchsorted(self._keys, keys) # type: numpy.ndarray
+        numpy.minimum(positions, len(self._keys) - 1, out=positions)
+        return numpy.where(self._keys[positions] == keys, self._ids[positions], MISSING)
+
+    def lookup(self, barcode: str) -> int:
+        """Find the whitelist position of a barcode, MISSING if it isn't there"""
+        key = pack(barcode=barcode) # type: Optional[int]
+        if key is None or len(barcode) != self._length:
+            return MISSING
+        return int(self.find(numpy.array((key,), dtype=numpy.uint64))[0])
+
+    def correct(self, keys: numpy.ndarray) -> numpy.ndarray:
+        """Find the one barcode a single mismatch away from each packed key
+        Gives its whitelist position, AMBIGUOUS if several are, or MISSING if none are
+        keys [numpy.ndarray]    The packed sequences to correct
+        """
+        keys = numpy.asarray(keys, dtype=numpy.uint64)
+        results = numpy.array([self._corrections.get(key, MISSING - 1) for key in keys.tolist()], dtype=numpy.int64) # type: numpy.ndarray
+        unknown = numpy.flatnonzero(results == MISSING - 1) # type: numpy.ndarray
+        if len(unknown):
+            #   Probe every neighbour of every unknown key in one search
+            found = self.find((keys[unknown][:, None] ^ self._flips[None, :]).ravel()).reshape(len(unknown), -1) # type: numpy.ndarray
+            counts = numpy.count_nonzero(found != MISSING, axis=1) # type: numpy.ndarray
+            corrected = numpy.where(counts > 1, AMBIGUOUS, numpy.where(counts == 1, found.max(axis=1), MISSING)) # type: numpy.ndarray
+            results[unknown] = corrected
+            #   Most windows are a mismatch away from nothing and never come up again, so only keep the ones that are
+            near = numpy.flatnonzero(corrected != MISSING) # type: numpy.ndarray
+            if len(self._corrections) < _TABLE_LIMIT:
+                self._corrections.update(zip(keys[unknown[near]].tolist(), corrected[near].tolist()))
+        return results
+
+    def scan(self, sequence: str, mismatches: int=0) -> Tuple[Optional[int], Dict[int, int]]:
+        """Find whitelisted barcodes anywhere in a sequence
+        Exact hits are preferred; one-mismatch hits are only looked for if there are none
+        Returns the number of mismatches and the whitelist positions found, each with where it starts;
+        AMBIGUOUS is reported if a window is a mismatch away from several barcodes
+        sequence [str]      The sequence to scan
+        mismatches [int]=0  Allow up to one mismatch
+        """
+        keys, starts = pack_kmers(sequence=sequence, length=self._length) # type: numpy.ndarray, numpy.ndarray
+        if not len(keys):
+            return None, {}
+        found = self.find(keys) # type: numpy.ndarray
+        hits = numpy.flatnonzero(found != MISSING) # type: numpy.ndarray
+        if len(hits):
+            ids = dict() # type: Dict[int, int]
+            for id_, start in zip(found[hits].tolist(), starts[hits].tolist()): # type: int, int
+                ids.setdefault(id_, start)
+            return 0, ids
+        if not mismatches:
+            return None, {}
+        corrected = self.correct(keys=keys) # type: numpy.ndarray
+        hits = numpy.flatnonzero(corrected != MISSING) # type: numpy.ndarray
+        ids = dict() # type: Dict[int, int]
+        for id_, start in zip(corrected[hits].tolist(), starts[hits].tolist()): # type: int, int
+            ids.setdefault(id_, start)
+        return (1, ids) if ids else (None, {})
+
+    length = property(fget=_barcode_length, doc='Length of every barcode in the index')
+    nbytes = property(fget=_nbytes, doc='Bytes used by the sorted keys and positions')
+
+
+def distinct(barcodes: Sequence[str]) -> Tuple[List[str], numpy.ndarray]:
+    """The distinct barcodes of a list, sorted, and where each barcode of the list is among them"""
+    whitelist, positions = numpy.unique(numpy.array(barcodes), return_inverse=True) # type: numpy.ndarray, numpy.ndarray
+    return whitelist.tolist(), positions.ravel()
+
+
+class SampleTable(object):
+
+    """Which sample each combination of whitelisted barcodes belongs to
+    A sample's whitelist position in every slot is packed into one 64-bit key, and
+    keys are kept sorted next to the sample's number, twelve bytes per sample, so
+    finding the sample for a combination is one binary search
+    """
+
+    def __init__(self, positions: Sequence[numpy.ndarray], sizes: Sequence[int], names: Sequence[str]) -> None:
+        """
+    positions [Sequence[numpy.ndarray]] Every sample's whitelist position, one array per slot
+    sizes [Sequence[int]]               How many barcodes each slot's whitelist holds
+    names [Sequence[str]]               Sample names, only used to report samples with the same barcodes
+    """
+        if not positions or len(positions) != len(sizes):
+            raise ValueError("Need the whitelist positions and size of every slot")
+        if numpy.prod(numpy.array(sizes, dtype=numpy.float64)) >= 2 ** 63:
+            raise ValueError("Too many combinations of barcodes to pack into one key")
+        self._sizes = tuple(int(size) for size in sizes) # type: Tuple[int, ...]
+        keys = numpy.zeros(len(positions[0]), dtype=numpy.int64) # type: numpy.ndarray
+        for column, size in zip(positions, self._sizes): # type: numpy.ndarray, int
+            keys = keys * size + numpy.asarray(column, dtype=numpy.int64)
+        order = numpy.argsort(keys, kind='stable') # type: numpy.ndarray
+        self._keys = keys[order] # type: numpy.ndarray
+        self._samples = order.astype(numpy.int32) # type: numpy.ndarray
+        duplicates = numpy.flatnonzero(self._keys[1:] == self._keys[:-1]) # type: numpy.ndarray
+        if len(duplicates):
+            raise ValueError("Samples %s and %s have the same barcodes" % (names[self._samples[duplicates[0]]], names[self._samples[duplicates[0] + 1]]))
+
+    def __len__(self) -> int:
+        return len(self._keys)
+
+    def _nbytes(self) -> int:
+        return self._keys.nbytes + self._samples.nbytes
+
+    def find(self, ids: Sequence[int]) -> int:
+        """Find the number of the sample with these whitelist positions, MISSING if there isn't one"""
+        key = 0 # type: int
+        for id_, size in zip(ids, self._sizes): # type: int, int
+            if not 0 <= id_ < size:
+                return MISSING
+            key = key * size + id_
+        position = int(numpy.searchsorted(self._keys, key)) # type: int
+        if position < len(self._keys) and self._keys[position] == key:
+            return int(self._samples[position])
+        return MISSING
+
+    nbytes = property(fget=_nbytes, doc='Bytes used by the sorted keys and sample numbers')
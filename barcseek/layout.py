@@ -0,0 +1,414 @@
+#!/usr/bin/env python3
+
+"""Read structures: where barcodes, UMIs, and template sit in each read"""
+
+import sys
+if not (sys.version_info.major == 3 and sys.version_info.minor >= 5):
+    sys.exit("Please use Python 3.5 or higher for this module: " + __name__)
+
+
+#   Load standard modules
+import collections
+from typing import Dict, FrozenSet, Iterator, List, Optional, Sequence, Tuple
+
+#   Load custom modules
+from barcseek.partition import IUPAC_CODES, AMBIGUOUS, UNDETERMINED, barcode_to_regex
+
+#   Load installed modules
+try:
+    import regex
+except ImportError as error:
+    sys.exit("Please install " + error.name)
+
+
+#   Segment types: template, sample barcode, molecular barcode (UMI), and skipped bases
+TEMPLATE = 'T' # type: str
+BARCODE = 'B' # type: str
+MOLECULAR = 'M' # type: str
+SKIP = 'S' # type: str
+#   A segment of this length takes up whatever the fixed segments leave
+VARIABLE = '+' # type: str
+
+_TOKEN = regex.compile(r'(\d+|\+)([TBMS])') # type: _regex.Pattern
+_ANY = frozenset('ACGTN') # type: FrozenSet[str]
+
+#   One segment of a read structure; 'length' is None for a variable-length segment
+Segment = collections.namedtuple('Segment', ('kind', 'length'))
+
+#   A run of fixed-length segments between variable ones
+#   'anchor' is 'start' or 'end' if the run sits at a fixed offset from that end of the read,
+#   or 'float' if it has to be found; 'offsets' are where each segment starts within the run
+Group = collections.namedtuple('Group', ('anchor', 'segments', 'offsets', 'length'))
+
+
+def parse(structure: str) -> Tuple[Segment]:
+    """Parse a read structure such as '8B10M8B+T' into its segments
+    Each segment is a length, or '+' for a variable length, followed by 'T' (template),
+    'B' (sample barcode), 'M' (molecular barcode), or 'S' (skip). Only template and
+    skipped segments may be variable; fixed-length segments between two variable ones
+    float, so they must hold a sample barcode to be found by
+    structure [str]     The read structure
+    """
+    structure = structure.strip().upper() # type: str
+    segments = list() # type: List[Segment]
+    position = 0 # type: int
+    for token in _TOKEN.finditer(structure): # type: _regex.Match
+        if token.start() != position:
+            break
+        length, kind = token.groups() # type: str, str
+        if length == VARIABLE:
+            if kind not in (TEMPLATE, SKIP):
+                raise ValueError("Only template and skipped segments can be variable in read structure %s" % structure)
+            if segments and segments[-1].length is None:
+                raise ValueError("Read structure %s has two variable segments in a row" % structure)
+            segments.append(Segment(kind=kind, length=None))
+        else:
+            if not int(length):
+                raise ValueError("Read structure %s has a zero-length segment" % structure)
+            segments.append(Segment(kind=kind, length=int(length)))
+        position = token.end()
+    if position != len(structure) or not segments:
+        raise ValueError("Cannot read read structure '%s' at '%s'" % (structure, structure[position:]))
+    return tuple(segments)
+
+
+def _groups(segments: Sequence[Segment]) -> Tuple[Group]:
+    """Split segments into runs of fixed-length segments and anchor each run"""
+    runs = [[]] # type: List[List[Segment]]
+    for segment in segments: # type: Segment
+        if segment.length is None:
+            runs.append([])
+        else:
+            runs[-1].append(segment)
+    groups = list() # type: List[Group]
+    for index, run in enumerate(runs): # type: int, List[Segment]
+        if index == 0:
+            anchor = 'start' # type: str
+        elif index == len(runs) - 1:
+            anchor = 'end'
+        else:
+            anchor = 'float'
+            if not any(segment.kind == BARCODE for segment in run):
+                raise ValueError("Segments between two variable segments need a sample barcode to be found by")
+        offsets = tuple(sum(segment.length for segment in run[:position]) for position in range(len(run))) # type: Tuple[int]
+        groups.append(Group(anchor=anchor, segments=tuple(run), offsets=offsets, length=sum(segment.length for segment in run)))
+    return tuple(groups)
+
+
+def _allowed(piece: str) -> Tuple[FrozenSet[str]]:
+    """The bases allowed at each position of a barcode piece, IUPAC codes and 'N's included"""
+    return tuple(_ANY if base == 'N' else frozenset(IUPAC_CODES.get(base, base)) for base in piece)
+
+
+def _mismatches(observed: str, allowed: Tuple[FrozenSet[str]], limit: int) -> Optional[int]:
+    """Mismatches between observed bases and allowed ones, None once past 'limit'"""
+    mismatches = 0 # type: int
+    for base, bases in zip(observed, allowed): # type: str, FrozenSet[str]
+        if base not in bases:
+            mismatches += 1
+            if mismatches > limit:
+                return None
+    return mismatches
+
+
+class ReadStructure(object):
+
+    """One read's structure compiled to an extraction plan
+    Runs of segments anchored to either end of the read are sliced at fixed offsets;
+    a run between two variable segments is found by searching for its first sample
+    barcode, and everything else in the run is sliced relative to that. Without any
+    variable segment, the rest of the read past the structure is left alone
+    """
+
+    def __init__(self, structure: str) -> None:
+        """
+    structure [str]     The read structure, such as '8B10M8B+T'
+    """
+        self._structure = structure.strip().upper() # type: str
+        self._segments = parse(structure=structure) # type: Tuple[Segment]
+        self._groups = _groups(segments=self._segments) # type: Tuple[Group]
+        self._floating = any(group.anchor == 'float' for group in self._groups) # type: bool
+        self._fixed = sum(group.length for group in self._groups) # type: int
+        #   Where each cut span ends up in 'cuts', so UMIs can be found again after a match
+        self._umi_cuts = tuple( # type: Tuple[int]
+            index for index, segment in enumerate(segment for segment in self._segments if segment.kind != TEMPLATE)
+            if segment.kind == MOLECULAR
+        )
+
+    def __repr__(self) -> str:
+        return self._structure
+
+    def _barcode_lengths(self) -> Tuple[int]:
+        return tuple(segment.length for segment in self._segments if segment.kind == BARCODE)
+
+    def _get_groups(self) -> Tuple[Group]:
+        return self._groups
+
+    def _get_floating(self) -> bool:
+        return self._floating
+
+    def _get_umi_cuts(self) -> Tuple[int]:
+        return self._umi_cuts
+
+    def _get_minimum(self) -> int:
+        return self._fixed
+
+    def fixed_spans(self, start: int, end: int) -> Optional[Dict[int, int]]:
+        """Where each run anchored to an end of the read starts, None if the read is too short
+        start [int]     Where the read starts
+        end [int]       Where the read ends
+        """
+        if end - start < self._fixed:
+            return None
+        starts = dict() # type: Dict[int, int]
+        for index, group in enumerate(self._groups): # type: int, Group
+            if group.anchor == 'start':
+                starts[index] = start
+            elif group.anchor == 'end':
+                starts[index] = end - group.length
+        return starts
+
+    def barcodes(self, text: str, starts: Dict[int, int]) -> Tuple[str]:
+        """The bases of every fixed sample barcode segment, in order"""
+        observed = list() # type: List[str]
+        for index, group in enumerate(self._groups): # type: int, Group
+            if index not in starts:
+                continue
+            for segment, offset in zip(group.segments, group.offsets): # type: Segment, int
+                if segment.kind == BARCODE:
+                    observed.append(text[starts[index] + offset:starts[index] + offset + segment.length])
+        return tuple(observed)
+
+    def cuts(self, starts: Dict[int, int], end: int) -> Tuple[Tuple[int, int]]:
+        """Spans of every segment but template, left to right, once every run has been placed
+        starts [Dict[int, int]]     Where each run starts
+        end [int]                   Where the read ends
+        """
+        spans = list() # type: List[Tuple[int, int]]
+        group = 0 # type: int
+        position = starts[0] # type: int
+        for segment in self._segments: # type: Segment
+            if segment.length is None:
+                group += 1
+                following = starts[group] # type: int
+                if segment.kind != TEMPLATE:
+                    spans.append((position, following))
+                position = following
+                continue
+            if segment.kind != TEMPLATE:
+                spans.append((position, position + segment.length))
+            position += segment.length
+        return tuple(spans)
+
+    groups = property(fget=_get_groups, doc='Runs of fixed-length segments and how each is placed')
+    barcode_lengths = property(fget=_barcode_lengths, doc='Length of each sample barcode segment')
+    floating = property(fget=_get_floating, doc='Are any segments found by searching rather than sliced?')
+    umi_cuts = property(fget=_get_umi_cuts, doc="Which spans from 'cuts' are molecular barcodes")
+    minimum = property(fget=_get_minimum, doc='Shortest read the structure fits')
+
+
+class ExtractionPlan(object):
+
+    """Assign reads by slicing barcodes out of them at the offsets given by read structures
+    Fixed barcode segments are compared base by base; when every barcode is fixed and
+    plain, an exact hit is a single dict lookup. Only barcodes between two variable
+    segments are searched for, with a pattern per sample. Each sample sheet barcode
+    column is read from one read, the first from the forward and the second from the
+    reverse, so a structure per column is a structure per read; for two barcodes in
+    one read, put both in that read's structure and in one column
+    """
+
+    def __init__(
+            self,
+            structures: Sequence[Optional[str]],
+            samples: Dict[str, Tuple[str, Optional[str]]],
+            error_rate: int=0
+    ) -> None:
+        """
+    structures [Sequence[Optional[str]]]            A read structure for the forward and optionally the reverse read
+    samples [Dict[str, Tuple[str, Optional[str]]]]  Barcodes for each sample, one per read with sample barcode segments;
+                                                    written out in full, or with 'N's standing in for UMIs
+    error_rate [int]=0                              Mismatches or, for searched barcodes, edits allowed over all barcodes
+    """
+        if not 0 < len(structures) <= 2:
+            raise ValueError("Need a read structure for the forward and optionally the reverse read")
+        self._structures = tuple(ReadStructure(structure=structure) if structure else None for structure in structures) # type: Tuple[Optional[ReadStructure]]
+        self._error = error_rate # type: int
+        self._samples = tuple(samples) # type: Tuple[str]
+        #   Each sample's barcode pieces, and the bases allowed at each position of each piece, per read
+        self._pieces = dict() # type: Dict[str, Tuple[Tuple[str, ...], ...]]
+        self._allowed = dict() # type: Dict[str, Tuple[Tuple[Tuple[FrozenSet[str]], ...], ...]]
+        for sample, barcodes in samples.items(): # type: str, Tuple[str, Optional[str]]
+            barcodes = tuple(filter(None, barcodes))
+            pieces = list() # type: List[Tuple[str, ...]]
+            for slot, structure in enumerate(self._structures): # type: int, Optional[ReadStructure]
+                lengths = structure.barcode_lengths if structure else () # type: Tuple[int]
+                if not lengths:
+                    pieces.append(())
+                    continue
+                if slot >= len(barcodes):
+                    raise ValueError("Sample %s has no barcode for read structure %s" % (sample, structure))
+                pieces.append(self._split(sample=sample, barcode=barcodes[slot], lengths=lengths))
+            if len(barcodes) > sum(1 for piece in pieces if piece):
+                raise ValueError("Sample %s has more barcodes than the read structures have room for" % sample)
+            self._pieces[sample] = tuple(pieces)
+            self._allowed[sample] = tuple(tuple(_allowed(piece=piece) for piece in slot) for slot in pieces)
+        #   Exact hits are one lookup when every barcode is sliced at a fixed offset and written plainly
+        self._exact = None # type: Optional[Dict[Tuple[str, ...], str]]
+        plain = all( # type: bool
+            set(''.join(piece for slot in pieces for piece in slot)) <= set('ACGT')
+            for pieces in self._pieces.values()
+        )
+        if plain and not any(structure.floating for structure in filter(None, self._structures)):
+            self._exact = dict()
+            for sample, pieces in self._pieces.items(): # type: str, Tuple[Tuple[str, ...], ...]
+                key = sum(pieces, ()) # type: Tuple[str, ...]
+                self._exact[key] = AMBIGUOUS if key in self._exact else sample
+        self._patterns = dict() # type: Dict[Tuple[str, int], _regex.Pattern]
+
+    @staticmethod
+    def _split(sample: str, barcode: str, lengths: Tuple[int]) -> Tuple[str, ...]:
+        """Split a sample's barcode into one piece per sample barcode segment"""
+        barcode = barcode.upper().replace(',', '') # type: str
+        if len(barcode) != sum(lengths):
+            #   UMIs may be written into the barcode as runs of 'N's
+            barcode = barcode.replace('N', '')
+        if len(barcode) != sum(lengths):
+            raise ValueError("Barcode for sample %s doesn't fit sample barcode segments of %s bases" % (sample, '+'.join(map(str, lengths))))
+        pieces = list() # type: List[str]
+        for length in lengths: # type: int
+            pieces.append(barcode[:length])
+            barcode = barcode[length:]
+        return tuple(pieces)
+
+    def _pattern(self, piece: str, errors: int):
+        try:
+            return self._patterns[(piece, errors)]
+        except KeyError:
+            pattern = self._patterns[(piece, errors)] = barcode_to_regex(barcode=piece, error_rate=errors or None)
+            return pattern
+
+    def _place(self, sample: str, slot: int, text: str, start: int, end: int, starts: Dict[int, int], budget: int) -> Optional[Tuple[int, Dict[int, int]]]:
+        """Compare a sample's barcodes for one read, placing any floating runs
+        Returns the distance and where every run starts, None past the error budget
+        """
+        structure = self._structures[slot] # type: ReadStructure
+        allowed = iter(self._allowed[sample][slot]) # type: Iterator[Tuple[FrozenSet[str]]]
+        pieces = iter(self._pieces[sample][slot]) # type: Iterator[str]
+        starts = dict(starts) # type: Dict[int, int]
+        distance = 0 # type: int
+        for index, group in enumerate(structure.groups): # type: int, Group
+            if index not in starts:
+                #   Search for the run's first barcode between the runs around it
+                position = starts[index - 1] + structure.groups[index - 1].length # type: int
+                limit = starts[index + 1] if index + 1 in starts else end # type: int
+                first = group.segments.index(next(segment for segment in group.segments if segment.kind == BARCODE)) # type: int
+                piece = next(pieces) # type: str
+                next(allowed)
+                match = self._pattern(piece=piece, errors=budget - distance).search(
+                    text,
+                    position + group.offsets[first],
+                    limit - group.length + group.offsets[first] + len(piece)
+                ) # type: Optional[_regex.Match]
+                if match is None:
+                    return None
+                distance += sum(match.fuzzy_counts)
+                starts[index] = match.start() - group.offsets[first]
+                segments = tuple(zip(group.segments, group.offsets))[first + 1:] # type: Tuple[Tuple[Segment, int]]
+            else:
+                segments = tuple(zip(group.segments, group.offsets))
+            for segment, offset in segments: # type: Segment, int
+                if segment.kind != BARCODE:
+                    continue
+                next(pieces)
+                observed = text[starts[index] + offset:starts[index] + offset + segment.length] # type: str
+                mismatches = _mismatches(observed=observed, allowed=next(allowed), limit=budget - distance) # type: Optional[int]
+                if mismatches is None:
+                    return None
+                distance += mismatches
+        return distance, starts
+
+    def assign(self, sequences: Tuple) -> Tuple[str, Optional[int], Tuple]:
+        """Find the best sample for a read's sequences
+        Returns the sample, the mismatches, and the spans of every non-template segment of each read
+        sequences [Tuple]   A (text, start, end) span for the forward and, if paired, reverse sequence
+        """
+        anchored = list() # type: List[Optional[Dict[int, int]]]
+        for slot, structure in enumerate(self._structures): # type: int, Optional[ReadStructure]
+            target = sequences[slot] if slot < len(sequences) else None # type: Optional[Tuple[str, int, int]]
+            if structure is None:
+                anchored.append(None)
+                continue
+            if not target:
+                return UNDETERMINED, None, ()
+            starts = structure.fixed_spans(start=target[1], end=target[2]) # type: Optional[Dict[int, int]]
+            if starts is None:
+                return UNDETERMINED, None, ()
+            anchored.append(starts)
+        if self._exact is not None:
+            key = sum( # type: Tuple[str, ...]
+                (structure.barcodes(text=target[0], starts=starts) for structure, target, starts in zip(self._structures, sequences, anchored) if structure),
+                ()
+            )
+            sample = self._exact.get(key) # type: Optional[str]
+            if sample == AMBIGUOUS:
+                return AMBIGUOUS, 0, ()
+            if sample is not None:
+                return sample, 0, self._cuts(sequences=sequences, anchored=anchored)
+            if not self._error:
+                return UNDETERMINED, None, ()
+        best = None # type: Optional[Tuple[str, List[Dict[int, int]]]]
+        best_distance = None # type: Optional[int]
+        tied = False # type: bool
+        for sample in self._samples: # type: str
+            distance = 0 # type: int
+            placed = list() # type: List[Optional[Dict[int, int]]]
+            for slot, (structure, starts) in enumerate(zip(self._structures, anchored)): # type: int, (Optional[ReadStructure], Optional[Dict[int, int]])
+                if structure is None:
+                    placed.append(None)
+                    continue
+                text, start, end = sequences[slot] # type: str, int, int
+                found = self._place(sample=sample, slot=slot, text=text, start=start, end=end, starts=starts, budget=self._error - distance) # type: Optional[Tuple[int, Dict[int, int]]]
+                if found is None:
+                    break
+                distance += found[0]
+                placed.append(found[1])
+            else:
+                if best_distance is None or distance < best_distance:
+                    best, best_distance, tied = (sample, placed), distance, False
+                elif distance == best_distance:
+                    tied = True
+        if best is None:
+            return UNDETERMINED, None, ()
+        if tied:
+            return AMBIGUOUS, best_distance, ()
+        sample, placed = best
+        return sample, best_distance, self._cuts(sequences=sequences, anchored=placed)
+
+    def _cuts(self, sequences: Tuple, anchored: Sequence[Optional[Dict[int, int]]]) -> Tuple[Tuple[Tuple[int, int]]]:
+        cuts = list() # type: List[Tuple[Tuple[int, int]]]
+        for slot, target in enumerate(sequences): # type: int, Optional[Tuple[str, int, int]]
+            structure = self._structures[slot] if slot < len(self._structures) else None # type: Optional[ReadStructure]
+            if structure is None or target is None:
+                cuts.append(())
+            else:
+                cuts.append(structure.cuts(starts=anchored[slot], end=target[2]))
+        return tuple(cuts)
+
+    def umi(self, texts: Tuple[str, Optional[str]], cuts: Tuple[Tuple[Tuple[int, int]]]) -> Optional[str]:
+        """The molecular barcode bases of an assigned read, None if the structures have none"""
+        umi = list() # type: List[str]
+        for slot, (structure, spans) in enumerate(zip(self._structures, cuts)): # type: int, (Optional[ReadStructure], Tuple[Tuple[int, int]])
+            if structure is None:
+                continue
+            umi.extend(texts[slot][spans[index][0]:spans[index][1]] for index in structure.umi_cuts)
+        return '+'.join(umi) if umi else None
+
+    def _get_molecular(self) -> bool:
+        return any(structure.umi_cuts for structure in filter(None, self._structures))
+
+    def _get_structures(self) -> Tuple[Optional[str]]:
+        return tuple(repr(structure) if structure else None for structure in self._structures)
+
+    molecular = property(fget=_get_molecular, doc='Do the structures have any molecular barcodes?')
+    structures = property(fget=_get_structures, doc='The read structures')
@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+
+"""Keep a run within a memory budget"""
+
+import sys
+if not (sys.version_info.major == 3 and sys.version_info.minor >= 5):
+    sys.exit("Please use Python 3.5 or higher for this module: " + __name__)
+
+
+#   Load standard modules
+import os
+import time
+import logging
+from typing import List, Sequence, Tuple
+
+#   Load custom modules
+import barcseek.chunks as chunks
+import barcseek.progress as progress
+
+#   Rough bytes held per byte of input while a chunk is in flight: the raw text,
+#   the parsed batch, and the rendered outputs waiting to be written
+_CHUNK_OVERHEAD = 4 # type: int
+#   BGZF blocks are measured in compressed bytes, which inflate about this much
+_BAM_EXPANSION = 4 # type: int
+#   Hold back new chunks once the run gets this close to its budget
+_HIGH_WATER = 0.9 # type: float
+#   Most of each worker's share to spend on its match cache
+_CACHE_SHARE = 0.25 # type: float
+#   Smallest copy buffer worth using
+_MIN_BUFFER = 64 * 1024 # type: int
+#   Seconds between reading the process tree's memory
+_CHECK_INTERVAL = 0.5 # type: float
+
+
+def _page_size() -> int:
+    try:
+        return os.sysconf('SC_PAGE_SIZE')
+    except (AttributeError, ValueError, OSError):
+        return 4096
+
+
+_PAGE_SIZE = _page_size() # type: int
+
+
+def process_rss(pid: int) -> int:
+    """Resident memory of one process in bytes, 0 if it can't be read"""
+    try:
+        with open('/proc/%s/statm' % pid, 'r') as sfile:
+            return int(sfile.read().split()[1]) * _PAGE_SIZE
+    except (OSError, IndexError, ValueError):
+        return 0
+
+
+def process_pss(pid: int) -> int:
+    """Proportional memory of one process in bytes: pages shared with other processes,
+    such as a forked worker's copy-on-write pages, count as a share of each page
+    Falls back on resident memory where /proc/<pid>/smaps_rollup can't be read
+    """
+    try:
+        with open('/proc/%s/smaps_rollup' % pid, 'r') as sfile:
+            for line in sfile: # type: str
+                if line.startswith('Pss:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, IndexError, ValueError):
+        pass
+    return process_rss(pid=pid)
+
+
+def _children(pid: int) -> Sequence[int]:
+    children = list() # type: List[int]
+    try:
+        entries = os.listdir('/proc') # type: List[str]
+    except OSError:
+        return children
+    for entry in entries: # type: str
+        if not entry.isdigit():
+            continue
+        try:
+            with open('/proc/%s/stat' % entry, 'r') as sfile:
+                #   The parent's PID follows the command name, which may itself hold spaces
+                parent = int(sfile.read().rsplit(')', 1)[1].split()[1]) # type: int
+        except (OSError, IndexError, ValueError):
+            continue
+        if parent == pid:
+            children.append(int(entry))
+    return children
+
+
+def run_memory() -> int:
+    """Memory of this process and its worker processes in bytes
+    Sums proportional memory so pages the processes share are only counted once;
+    reads /proc where there is one, and elsewhere falls back on this process's peak
+    """
+    own = process_pss(pid=os.getpid()) # type: int
+    if not own:
+        try:
+            import resource
+            #   Peak rather than current, reported in KiB on Linux and bytes on macOS
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss # type: int
+            return peak if sys.platform == 'darwin' else peak * 1024
+        except (ImportError, OSError):
+            return 0
+    return own + sum(process_pss(pid=child) for child in _children(pid=os.getpid()))
+
+
+def _block_bytes(block: chunks.Chunk, virtual: Tuple[bool, bool]=(False, False)) -> int:
+    """Roughly how many bytes of reads a block holds once read in"""
+    return progress.chunk_bytes(chunk=block, virtual=virtual[0], reverse_virtual=virtual[1]) * (_BAM_EXPANSION if any(virtual) else 1)
+
+
+class Governor(object):
+
+    """Split a memory budget between the parts of a run and hold back work near the limit
+    The budget left after what's already in use is shared among workers; each share
+    covers a worker's match cache and the chunks it has in flight, which sets how large
+    chunks may grow and how much is copied at a time. While the run goes on, new chunks
+    are only handed out while the process tree stays under the budget's high-water mark
+    Data queued for streamed outputs and the whitelist index's correction table aren't
+    given a share up front, but count toward the memory the process tree is seen using
+    """
+
+    def __init__(self, budget: int, workers: int=1) -> None:
+        """
+    budget [int]        Memory the whole run may use, in bytes
+    workers [int]=1     Number of workers sharing the budget
+    """
+        if budget <= 0:
+            raise ValueError("'budget' must be positive")
+        self._budget = budget # type: int
+        self._workers = max(workers, 1) # type: int
+        baseline = run_memory() # type: int
+        #   Forked workers share this process's pages, but each page a worker writes to becomes its own,
+        #   so set aside a whole copy per worker; the run is then watched counting shared pages once
+        in_use = baseline * (self._workers + 1 if self._workers > 1 else 1) # type: int
+        if in_use >= budget:
+            raise ValueError(logging.error(
+                "A memory budget of %s MiB leaves nothing for %s workers, %s MiB is already in use",
+                budget // 2 ** 20,
+                self._workers,
+                in_use // 2 ** 20
+            ))
+        self._share = (budget - in_use) // self._workers # type: int
+        self._peak = baseline # type: int
+        self._used = baseline # type: int
+        self._checked = 0.0 # type: float
+        self._throttled = 0 # type: int
+        logging.info("Sharing a %s MiB memory budget among %s workers, %s MiB each", budget // 2 ** 20, self._workers, self._share // 2 ** 20)
+
+    def cache_budget(self, requested: int) -> int:
+        """How much of a requested match cache each worker may have, in bytes"""
+        allowed = int(self._share * _CACHE_SHARE) # type: int
+        if requested > allowed:
+            logging.warning("Shrinking the match cache from %s to %s MiB per worker to fit the memory budget", requested // 2 ** 20, allowed // 2 ** 20)
+            return allowed
+        return requested
+
+    def buffer_size(self, requested: int) -> int:
+        """How many bytes to copy at a time, at most a sixteenth of a worker's share"""
+        return max(min(requested, self._share // 16), _MIN_BUFFER)
+
+    def max_blocks(self, blocks: Sequence[chunks.Chunk], virtual: Sequence[Tuple[bool, bool]]=()) -> int:
+        """Most blocks one chunk may hold so every chunk in flight fits in the budget
+        blocks [Sequence[chunks.Chunk]]                 The blocks to be handed out
+        virtual [Sequence[Tuple[bool, bool]]]=()        For each lane, are its forward and reverse offsets BGZF virtual offsets?
+        """
+        if not blocks:
+            return 1
+        sizes = [_block_bytes(block=block, virtual=virtual[block.lane] if virtual else (False, False)) for block in blocks] # type: List[int]
+        block_bytes = max(sum(sizes) / len(sizes), 1) # type: float
+        #   Each worker has a chunk running and one queued behind it
+        chunk_bytes = self._share * (1 - _CACHE_SHARE) / (2 * _CHUNK_OVERHEAD) # type: float
+        if max(sizes) > chunk_bytes:
+            logging.warning(
+                "Blocks of up to %s MiB may not fit a %s MiB share of the memory budget, consider a smaller --chunk-size",
+                round(max(sizes) / 2 ** 20, 1),
+                self._share // 2 ** 20
+            )
+        return max(int(chunk_bytes // block_bytes), 1)
+
+    def allow(self, pending: int) -> bool:
+        """Can another chunk be handed out with this many already in flight?
+        There's always room for one, so a run makes progress even over its budget
+        """
+        if not pending:
+            return True
+        now = time.time() # type: float
+        if now - self._checked >= _CHECK_INTERVAL:
+            self._used = run_memory()
+            self._peak = max(self._peak, self._used)
+            self._checked = now
+        if self._used < _HIGH_WATER * self._budget:
+            return True
+        self._throttled += 1
+        logging.debug("Holding back chunks at %s MiB of a %s MiB budget", self._used // 2 ** 20, self._budget // 2 ** 20)
+        return False
+
+    def _get_budget(self) -> int:
+        return self._budget
+
+    def _get_share(self) -> int:
+        return self._share
+
+    def _get_peak(self) -> int:
+        return self._peak
+
+    def _get_throttled(self) -> int:
+        return self._throttled
+
+    budget = property(fget=_get_budget, doc='Memory the whole run may use, in bytes')
+    share = property(fget=_get_share, doc="Each worker's share of the budget, in bytes")
+    peak = property(fget=_get_peak, doc='Most memory the run was seen using, in bytes')
+    throttled = property(fget=_get_throttled, doc='Number of times new chunks were held back')
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+
+"""Bit-parallel edit distance search for barcodes"""
+
+import sys
+if not (sys.version_info.major == 3 and sys.version_info.minor >= 5):
+    sys.exit("Please use Python 3.5 or higher for this module: " + __name__)
+
+
+#   Load standard modules
+import collections
+from typing import Dict, List, Optional, Tuple
+
+#   Load custom modules
+from barcseek.partition import IUPAC_CODES
+
+#   Where a barcode was found in a sequence
+#   'distance' is the edit distance of the alignment
+#   'start' and 'end' are the span of the alignment in the sequence
+#   'positions' holds, for each barcode position and the end, where it lines up in the sequence
+Alignment = collections.namedtuple('Alignment', ('distance', 'start', 'end', 'positions'))
+
+
+class Pattern(object):
+
+    """A barcode compiled for Myers' bit-vector edit distance search
+    The whole barcode is kept in one Python int, one bit per position, so each
+    sequence base costs a handful of integer operations no matter how long the
+    barcode is. 'N' positions match any base and IUPAC codes match their bases.
+    The search finds the lowest edit distance and where that alignment ends; a
+    small DP banded to the barcode length plus the distance then recovers where
+    each position of the barcode lines up, which is what trimming needs
+    Edits count over the whole barcode, UMI positions included. Regex patterns
+    allow the error rate in each barcode segment and UMI separately, so the two
+    find the same lowest distance for barcodes without UMIs, but a barcode with
+    UMIs and edits spread over its segments may match as a regex and not here
+    """
+
+    def __init__(self, barcode: str) -> None:
+        """
+    barcode [str]   The barcode sequence, with 'N's for UMIs
+    """
+        self._barcode = barcode.upper() # type: str
+        self._length = len(self._barcode) # type: int
+        if not self._length:
+            raise ValueError("Cannot search for an empty barcode")
+        self._mask = (1 << self._length) - 1 # type: int
+        self._high = 1 << (self._length - 1) # type: int
+        self._peq = dict((base, 0) for base in 'ACGT') # type: Dict[str, int]
+        for index, code in enumerate(self._barcode): # type: int, str
+            if code == 'N':
+                bases = 'ACGT' # type: str
+            else:
+                bases = IUPAC_CODES.get(code, code)
+            for base in bases: # type: str
+                self._peq[base] = self._peq.get(base, 0) | (1 << index)
+
+    def __repr__(self) -> str:
+        return self._barcode
+
+    def __len__(self) -> int:
+        return self._length
+
+    def _matches(self, index: int, base: str) -> bool:
+        return bool(self._peq.get(base, 0) >> index & 1)
+
+    def search(self, sequence: str, max_distance: Optional[int]=None, pos: int=0, endpos: Optional[int]=None) -> Optional[Tuple[int, int]]:
+        """Find the lowest edit distance of this barcode anywhere in a sequence
+        Returns (distance, end) of the leftmost best alignment, None if over 'max_distance'
+        sequence [str]              The sequence to search
+        max_distance [int]=None     The highest distance to accept
+        pos [int]=0                 Where to start searching
+        endpos [int]=None           Where to stop searching
+        """
+        peq, mask, high = self._peq, self._mask, self._high # type: Dict[str, int], int, int
+        positive, negative = mask, 0 # type: int, int
+        score = self._length # type: int
+        best, best_end = self._length + 1, None # type: int, Optional[int]
+        endpos = len(sequence) if endpos is None else min(endpos, len(sequence)) # type: int
+        for index in range(pos, endpos): # type: int
+            equal = peq.get(sequence[index], 0) # type: int
+            vertical = equal | negative # type: int
+            horizontal = (((equal & positive) + positive) ^ positive) | equal # type: int
+            horizontal_positive = negative | ~(horizontal | positive) # type: int
+            horizontal_negative = positive & horizontal # type: int
+            if horizontal_positive & high:
+                score += 1
+            elif horizontal_negative & high:
+                score -= 1
+            #   Alignments may start anywhere in the sequence, so nothing is shifted in
+            horizontal_positive <<= 1
+            horizontal_negative <<= 1
+            positive = (horizontal_negative | ~(vertical | horizontal_positive)) & mask
+            negative = horizontal_positive & vertical & mask
+            if score < best:
+                best, best_end = score, index + 1
+                if not best:
+                    break
+            elif score == best and best_end == index:
+                #   Extend a run of equally good ends so a mismatched last base
+                #   is preferred over dropping it as a deletion
+                best_end = index + 1
+        if best_end is None or (max_distance is not None and best > max_distance):
+            return None
+        return best, best_end
+
+    def align(self, sequence: str, end: int, distance: int, pos: int=0) -> Alignment:
+        """Recover the alignment that ends at 'end' with edit distance 'distance'
+        sequence [str]      The sequence the barcode was found in
+        end [int]           Where the alignment ends, from 'search'
+        distance [int]      The edit distance, from 'search'
+        pos [int]=0         Where the search started
+        """
+        offset = max(end - self._length - distance, pos) # type: int
+        window = sequence[offset:end] # type: str
+        rows, columns = self._length + 1, len(window) + 1 # type: int, int
+        #   Alignments may start anywhere in the window, so the first row is all zeros
+        table = [[0] * columns] # type: List[List[int]]
+        for row in range(1, rows): # type: int
+            previous = table[-1] # type: List[int]
+            current = [row] + [0] * (columns - 1) # type: List[int]
+            for column in range(1, columns): # type: int
+                cost = 0 if self._matches(row - 1, window[column - 1]) else 1 # type: int
+                current[column] = min(previous[column - 1] + cost, previous[column] + 1, current[column - 1] + 1)
+            table.append(current)
+        if table[-1][-1] != distance:
+            raise ValueError("No alignment of %s ends at %s with distance %s" % (self._barcode, end, distance))
+        positions = [0] * rows # type: List[int]
+        row, column = self._length, columns - 1 # type: int, int
+        positions[row] = offset + column
+        while row:
+            score = table[row][column] # type: int
+            if column and score == table[row - 1][column - 1] + (0 if self._matches(row - 1, window[column - 1]) else 1):
+                row, column = row - 1, column - 1
+            elif score == table[row - 1][column] + 1:
+                row -= 1
+            else:
+                column -= 1
+                continue
+            positions[row] = offset + column
+        return Alignment(distance=distance, start=positions[0], end=end, positions=tuple(positions))
+
+    def locate(self, sequence: str, max_distance: Optional[int]=None, pos: int=0, endpos: Optional[int]=None) -> Optional[Alignment]:
+        """Find and align the best occurrence of this barcode in a sequence
+        sequence [str]              The sequence to search
+        max_distance [int]=None     The highest distance to accept
+        pos [int]=0                 Where to start searching
+        endpos [int]=None           Where to stop searching
+        """
+        found = self.search(sequence=sequence, max_distance=max_distance, pos=pos, endpos=endpos) # type: Optional[Tuple[int, int]]
+        if found is None:
+            return None
+        distance, end = found # type: int, int
+        return self.align(sequence=sequence, end=end, distance=distance, pos=pos)
+
+    def segments(self) -> Tuple[Tuple[int, int]]:
+        """The (start, end) of every non-UMI segment of the barcode"""
+        spans = list() # type: List[Tuple[int, int]]
+        start = None # type: Optional[int]
+        for index, code in enumerate(self._barcode + 'N'): # type: int, str
+            if code != 'N' and start is None:
+                start = index
+            elif code == 'N' and start is not None:
+                spans.append((start, index))
+                start = None
+        return tuple(spans)
+
+
+def compile_barcode(barcode: str) -> Pattern:
+    """Compile a barcode for bit-vector search"""
+    return Pattern(barcode=barcode)
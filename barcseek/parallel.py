@@ -1,255 +1,619 @@
 #!/usr/bin/env python3
 
+"""Demultiplex chunks of FASTQ files in parallel"""
+
 import sys
+if not (sys.version_info.major == 3 and sys.version_info.minor >= 5):
+    sys.exit("Please use Python 3.5 or higher for this module: " + __name__)
 
-if sys.version_info.major is not 3 and sys.version_info.minor < 5:
-    sys.exit("Please use Python 3.5 or higher for this program")
 
+#   Load standard modules
 import os
-import glob
-import dask
-from dask import multiprocessing, delayed
+import time
+import shutil
 import logging
-import json
-import sys
-import subprocess
-import shlex
-import re
-from time import sleep
-from partition import partition
-from BarcSeek import extract_barcodes
-
 import itertools
-from typing import Optional
-
-logging.basicConfig(filename='parallel.log', filemode="w", level=logging.DEBUG, format='%(asctime)s %(message)s',
-                    datefmt='%m/%d/%Y %I:%M:%S %p')
-logger = logging.getLogger('barcode-logger')
-ch = logging.StreamHandler()
-ch.setLevel(logging.DEBUG)
-logger.addHandler(ch)
-
-split_file_pattern = 'x12345_filename.fastq'
-
-dask.set_options(get=dask.multiprocessing.get)
-
-def _fake_partition_(filename: str):
-    logger.debug("loading file: %s", filename)
-    i = 0
-    with open(filename, 'r') as f:
-        for line in f:
-            i = i + 1
-    f.close()
-    logger.debug("number of lines in file: %i", i)
-
-
-def _read_filenames_(input_dir: str) -> dict:
-    logger.debug("reading filenames from directory %s", input_dir)
-
-
-def split_files(file_f: str, file_r: str):
-    subprocess.run()
-
-
-def _invoke_workers_(files: dict):
-    logger.debug("invoking workers, number of files %i", len(files.keys()))
-    # for each file, call partition()
-
-
-# one output file per barcode, for forward and reverse
-def _join_output_files_(output_file_dir: str):
-    logger.debug("joining output files in dir %s", output_file_dir)
-
-
-def _run_command_(command):
-    process = subprocess.Popen(shlex.split(command), stdout=subprocess.PIPE, bufsize=1)
-    so = []
-    while True:
-        output = process.stdout.readline().decode()
-        if output == '' and process.poll() is not None:
-            break
-        if output:
-            so.append(output.strip())
-    rc = process.poll()
-    return rc, so
-
-
-def _get_line_count_(fastq_fn:str) -> int:
-    (rc, out) = _run_command_("wc -l %s" % fastq_fn)
-    return int(out[0].split(" ")[0])
-
-
-def _get_dir_fn_(fastq_file: str) -> tuple:
-    if fastq_file:
-        (*paths, fn) = os.path.split(fastq_file)
-        return paths[0], fn
+import collections
+from typing import Any, Callable, Counter, Dict, Optional, Sequence, Set, Tuple
+
+#   Load custom modules
+import barcseek.bam as bam
+import barcseek.cache as cache
+import barcseek.fastq as fastq
+import barcseek.sinks as sinks
+import barcseek.spill as spill
+import barcseek.assignments as assignments
+import barcseek.batch as batch
+import barcseek.chunks as chunks
+import barcseek.memory as memory
+import barcseek.partition as partition
+import barcseek.executors as executors
+import barcseek.scheduler as scheduler
+import barcseek.checkpoint as checkpoint
+import barcseek.progress as progress
+
+MANIFEST_NAME = 'checkpoint.json' # type: str
+MERGED_NAME = 'merged.fastq' # type: str
+_PARTS_DIRECTORY = '.barcseek_parts' # type: str
+_SPILL_DIRECTORY = '.barcseek_spill' # type: str
+_COPY_BUFFER = 16 * 1024 * 1024 # type: int
+
+#   What a worker hands back after demultiplexing one chunk
+#   'directory' holds the per-sample partial outputs for this chunk, or is the chunk's spill run when spilling
+#   'filtered' holds the reads stopped or trimmed at each quality stage, and any left out for having no mate
+#   'buffers' holds the rendered forward and reverse reads for each category when streaming, None otherwise
+#   'distances' and 'umis' count assigned reads per sample and edit distance, and per sample and UMI
+#   'cache' holds the match cache's hits, misses, and evictions, empty without a cache
+#   'assignments' holds the position, sample, distance, and UMI of every read as 'assignments.Columns', None unless logging them
+ChunkResult = collections.namedtuple(
+    'ChunkResult',
+    ('chunk', 'directory', 'counts', 'evaluations', 'filtered', 'seconds', 'buffers', 'distances', 'umis', 'cache', 'assignments')
+)
+
+#   A forward FASTQ file (or BAM file) and its optional reverse FASTQ file
+#   'interleaved' is True if both reads of each pair are in the forward file
+Lane = collections.namedtuple('Lane', ('forward', 'reverse', 'interleaved'))
+
+
+def make_lane(forward: str, reverse: Optional[str]=None, interleaved: bool=False) -> Lane:
+    """Describe a lane, finding out whether a BAM file is paired"""
+    if bam.is_bam(filename=forward):
+        if reverse:
+            raise ValueError(logging.error("Cannot pair BAM file %s with reverse file %s", forward, reverse))
+        interleaved = bam.is_paired(filename=forward)
+    elif interleaved and reverse:
+        raise ValueError(logging.error("Cannot pair interleaved file %s with reverse file %s", forward, reverse))
+    return Lane(forward=forward, reverse=reverse, interleaved=interleaved)
+
+
+def _paired(lane: Lane) -> bool:
+    return bool(lane.reverse) or lane.interleaved
+
+
+def _basename(filename: str, output_format: str=partition.OUTPUT_FORMATS[0]) -> str:
+    basename = os.path.basename(filename) # type: str
+    if basename.endswith('.gz'):
+        basename = basename[:-3]
+    #   Name outputs for what's in them rather than for the input
+    if output_format == 'bam' or bam.is_bam(filename=basename):
+        basename = os.path.splitext(basename)[0] + ('.bam' if output_format == 'bam' else '.fastq')
+    return basename
+
+
+def output_names(
+        matcher: partition.Matcher,
+        directory: str,
+        forward: str,
+        paired: bool=False,
+        output_format: str=partition.OUTPUT_FORMATS[0]
+) -> Dict[str, Tuple[str, Optional[str]]]:
+    """Create output names for every category in a matcher"""
+    return partition.output_names(
+        categories=matcher.categories,
+        directory=directory,
+        basename=_basename(filename=forward, output_format=output_format),
+        paired=paired,
+        joined=output_format != partition.OUTPUT_FORMATS[0]
+    )
+
+
+def _run_name(directory: str, lane: int, index: int) -> str:
+    return os.path.join(directory, _SPILL_DIRECTORY, 'lane%03d_chunk%06d%s' % (lane, index, spill.RUN_SUFFIX))
+
+
+def _feed(reader: chunks.BlockStream, manifest: checkpoint.Manifest, tracker: progress.Progress) -> Callable[[], Optional[chunks.Chunk]]:
+    """Hand the scheduler the blocks of a lane planned as it's read, passing over those already done"""
+    def next_block() -> Optional[chunks.Chunk]:
+        skipped = reader.skipped # type: int
+        block = reader.next_block(skip=manifest.__contains__) # type: Optional[chunks.Chunk]
+        tracker.skip(size=reader.skipped - skipped)
+        return block
+    return next_block
+
+
+def demultiplex_chunk(
+        chunk: chunks.Chunk,
+        lane: Lane,
+        directory: str,
+        matcher: partition.Matcher,
+        bare_plus: bool=False,
+        stream: bool=False,
+        output_format: str=partition.OUTPUT_FORMATS[0],
+        pair_window: int=0,
+        skip_unpaired: bool=False,
+        spill_runs: bool=False,
+        log_assignments: bool=False,
+        data: Optional[Tuple[Optional[bytes], Optional[bytes]]]=None,
+        neighbours: Optional[Tuple[Optional[chunks.Chunk], Optional[chunks.Chunk]]]=None,
+        edges: Optional[Tuple[Optional[Tuple[bytes, Optional[bytes]]], Optional[Tuple[bytes, Optional[bytes]]]]]=None
+) -> ChunkResult:
+    """Demultiplex one chunk into its own set of partial outputs
+    chunk [chunks.Chunk]                The chunk to demultiplex
+    lane [Lane]                         The FASTQ file(s) the chunk comes from
+    directory [str]                     Output directory for the run
+    matcher [partition.Matcher]         Matcher to use, given by the executor
+    bare_plus [bool]=False              Write a bare '+' line rather than repeating the read ID
+    stream [bool]=False                 Hand the rendered reads back rather than writing partial outputs
+    output_format [str]='fastq'         Write 'fastq', 'interleaved' FASTQ, or 'bam' records
+    pair_window [int]=0                 How far out of order a read may be from its mate
+    skip_unpaired [bool]=False          Leave out reads without a mate rather than stopping
+    spill_runs [bool]=False             Write every category into one spill run rather than one partial output each
+    log_assignments [bool]=False        Hand back the sample, distance, and UMI of every read as columns
+    data [Tuple]=None                   The chunk's forward and reverse bytes if read ahead of time, for inputs
+                                        that can only be read in order; either may be None to read it here
+    neighbours [Tuple]=None             The blocks just before and just after the chunk, for mates across its edges
+    edges [Tuple]=None                  The reads either side of the chunk if read ahead of time, in place of 'neighbours'
+    """
+    chunk_start = time.time() # type: float
+    forward, reverse, interleaved = lane # type: str, Optional[str], bool
+    #   Workers may run several tasks at once on one matcher, so count this chunk on a copy of its own
+    matcher = matcher.task() # type: partition.Matcher
+    cache_counts = matcher.cache_counts # type: Counter
+    reads = chunks.read_batch( # type: batch.ReadBatch
+        chunk=chunk,
+        forward=forward,
+        reverse=reverse,
+        interleaved=interleaved,
+        window=pair_window,
+        skip_unpaired=skip_unpaired,
+        data=data,
+        neighbours=neighbours,
+        edges=edges
+    )
+    #   Match here rather than while rendering so the assignments can be logged too
+    assigned = matcher.match_batch(batch=reads) if log_assignments else None # type: Optional[partition.Assignments]
+    if stream:
+        part_directory = None # type: Optional[str]
+        counts, buffers = partition.render_batch(matcher=matcher, batch=reads, bare_plus=bare_plus, output_format=output_format, assignments=assigned) # type: Counter, Optional[Dict[str, Tuple[bytes, Optional[bytes]]]]
+    elif spill_runs:
+        part_directory = _run_name(directory=directory, lane=chunk.lane, index=chunk.index)
+        counts, rendered = partition.render_batch(matcher=matcher, batch=reads, bare_plus=bare_plus, output_format=output_format, assignments=assigned) # type: Counter, Dict[str, Tuple[bytes, Optional[bytes]]]
+        spill.write_run(filename=part_directory, categories=matcher.categories, rendered=rendered)
+        buffers = None
     else:
-        return "", ""
-
-
-''' creates files of the format x12345_filename.fastq '''
-def _split_fastq_(fastq_fn: str, num_lines: int):
-    (d, fn) = _get_dir_fn_(fastq_fn)
-    logger.debug("chunk file num lines=%i" % num_lines)
-    logger.debug("changing dir to: %s" % d)
-    os.chdir(d)
-    cmd = "split -d -a 5 -l %i --additional-suffix=_%s %s" % (num_lines, fn, fn)
-
-    logger.debug("running command %s" % cmd)
-    (rc, out) = _run_command_(cmd)
-    return rc, out
-
-
-''' creates files of the format x12345_filename.fastq '''
-def _split_files_(num_lines: int, forward_fastq: str, reverse_fastq: Optional[str] = None):
-    (rc, out) = _split_fastq_(forward_fastq, num_lines)
-    if rc:
-        raise Exception("Error splitting files, error code %s" % rc)
-
-    if reverse_fastq:
-        (rc, out) = _split_fastq_(reverse_fastq, num_lines)
-        if rc:
-            raise Exception("Error splitting files, error code %s" % rc)
-
-
-''' files in the format x12345_filename.fastq '''
-def _fetch_chunk_files_(num_lines: int, forward_fastq: str, reverse_fastq: Optional[str] = None) -> dict:
-    (d, f_fn) = _get_dir_fn_(forward_fastq)
-
-    logger.debug("fetching chunk files, changing dir to %s" % d)
-    os.chdir(d)
-
-    master_dict = {}
-
-    _split_files_(num_lines, forward_fastq, reverse_fastq)
-    logger.debug("fetching new file names")
-
-    f_regex = 'x*_' + f_fn
-    logger.debug("looking for files of pattern %s" % f_regex)
-    f_files = glob.glob(f_regex)
-
-    logger.debug("found %i files" % len(f_files))
-
-    f_dict = {re.search('x(\d+)', fn).group(0): fn for fn in f_files}
-
-    prefixes = list(f_dict.keys())
-    prefixes.sort()
-    logger.debug("num prefixes: %i" % len(prefixes))
-
-    if (reverse_fastq):
-        (d, r_fn) = _get_dir_fn_(reverse_fastq)
-        r_files = glob.glob('x*_' + r_fn)
-        r_files.sort()
-        r_dict = {re.search('x(\d+)', fn).group(0): fn for fn in r_files}
-        for p in prefixes:
-            f_file = os.path.join(d, f_dict[p])
-            r_file = os.path.join(d, r_dict[p])
-            master_dict[p] = {'f_input': f_file, 'r_input': r_file}
+        part_directory = os.path.join(directory, _PARTS_DIRECTORY, 'lane%03d_chunk%06d' % (chunk.lane, chunk.index))
+        shutil.rmtree(part_directory, ignore_errors=True)
+        os.makedirs(part_directory)
+        buffers = None
+        counts = partition.partition_batch(
+            matcher=matcher,
+            batch=reads,
+            outputs=output_names(matcher=matcher, directory=part_directory, forward=forward, paired=_paired(lane=lane), output_format=output_format),
+            bare_plus=bare_plus,
+            output_format=output_format,
+            assignments=assigned
+        )
+    filtered = matcher.filtered # type: Counter
+    if reads.unpaired:
+        filtered[fastq.UNPAIRED] = reads.unpaired
+    return ChunkResult(
+        chunk=chunk,
+        directory=part_directory,
+        counts=counts,
+        evaluations=matcher.evaluations,
+        filtered=filtered,
+        seconds=time.time() - chunk_start,
+        buffers=buffers,
+        distances=matcher.distances,
+        umis=matcher.umis,
+        cache=matcher.cache_counts - cache_counts,
+        assignments=assignments.make_columns(assignments=assigned, categories=matcher.categories, positions=reads.rows) if assigned else None
+    )
+
+
+def _append(part: str, output: str, buffer_size: int=_COPY_BUFFER) -> None:
+    """Append a partial output to a final output and sync it to disk"""
+    with open(part, 'rb') as pfile, open(output, 'ab') as ofile:
+        shutil.copyfileobj(pfile, ofile, buffer_size)
+        ofile.flush()
+        os.fsync(ofile.fileno())
+
+
+def _collect(
+        result: ChunkResult,
+        parts: Dict[str, Tuple[str, Optional[str]]],
+        outputs: Dict[str, Tuple[str, Optional[str]]],
+        buffer_size: int=_COPY_BUFFER
+) -> None:
+    """Move one chunk's partial outputs onto the end of the final outputs"""
+    for category, (output_name, reverse_name) in outputs.items(): # type: str, (str, Optional[str])
+        part_name, part_reverse = parts[category] # type: str, Optional[str]
+        _append(part=part_name, output=output_name, buffer_size=buffer_size)
+        if reverse_name:
+            _append(part=part_reverse, output=reverse_name, buffer_size=buffer_size)
+    shutil.rmtree(result.directory)
+
+
+def _stream(result: ChunkResult, outputs: Dict[str, Tuple[str, Optional[str]]], streams: Dict[str, sinks.Sink]) -> None:
+    """Hand one chunk's rendered reads to the sinks for the final outputs"""
+    for category, (output_name, reverse_name) in outputs.items(): # type: str, (str, Optional[str])
+        data, reverse_data = result.buffers[category] # type: bytes, Optional[bytes]
+        streams[output_name].write(data)
+        if reverse_name:
+            streams[reverse_name].write(reverse_data)
+
+
+def _merge_runs(
+        manifest: checkpoint.Manifest,
+        matcher: partition.Matcher,
+        lane_outputs: Tuple[Dict[str, Tuple[str, Optional[str]]]],
+        directory: str,
+        merge: bool,
+        max_open_files: Optional[int]=None,
+        buffer_size: int=_COPY_BUFFER,
+        bam_output: bool=False
+) -> None:
+    """Write every lane's outputs from the spill runs of its finished chunks, in input order"""
+    merge_start = time.time() # type: float
+    finished = manifest.chunks() # type: Tuple[Tuple[int, int]]
+    groups = ((tuple(range(len(lane_outputs))),) if merge else tuple((lane,) for lane in range(len(lane_outputs)))) # type: Tuple[Tuple[int, ...]]
+    for lanes in groups: # type: Tuple[int, ...]
+        spill.merge(
+            runs=tuple(_run_name(directory=directory, lane=lane, index=index) for lane, index in finished if lane in lanes),
+            categories=matcher.categories,
+            outputs=lane_outputs[lanes[0]],
+            max_open_files=max_open_files,
+            buffer_size=buffer_size,
+            header=bam.header() if bam_output else b'',
+            trailer=bam.EOF if bam_output else b''
+        )
+    #   Outputs are complete, so the runs are no longer needed, even to resume
+    manifest.remove()
+    shutil.rmtree(os.path.join(directory, _SPILL_DIRECTORY), ignore_errors=True)
+    logging.debug("Merging spill runs took %s seconds", round(time.time() - merge_start, 3))
+
+
+def _lane_outputs(
+        matcher: partition.Matcher,
+        lanes: Sequence[Lane],
+        directory: str,
+        merge: bool,
+        output_format: str=partition.OUTPUT_FORMATS[0]
+) -> Tuple[Dict[str, Tuple[str, Optional[str]]]]:
+    """Create output names for each lane, sharing one set of outputs if merging"""
+    if merge:
+        merged = output_names(matcher=matcher, directory=directory, forward=MERGED_NAME, paired=_paired(lane=lanes[0]), output_format=output_format) # type: Dict[str, Tuple[str, Optional[str]]]
+        return tuple(merged for _ in lanes)
+    lane_outputs = tuple( # type: Tuple[Dict[str, Tuple[str, Optional[str]]]]
+        output_names(matcher=matcher, directory=directory, forward=lane.forward, paired=_paired(lane=lane), output_format=output_format)
+        for lane in lanes
+    )
+    seen = dict() # type: Dict[str, str]
+    for lane, outputs in zip(lanes, lane_outputs): # type: Lane, Dict[str, Tuple[str, Optional[str]]]
+        for output_name, _ in outputs.values(): # type: str, Optional[str]
+            if output_name in seen:
+                raise ValueError(logging.error("Lanes %s and %s would write to the same outputs, please merge lanes", seen[output_name], lane.forward))
+            seen[output_name] = lane.forward
+    return lane_outputs
+
+
+def parallelize(
+        matcher: partition.Matcher,
+        lanes: Sequence[Lane],
+        directory: str,
+        num_reads: Optional[int]=None,
+        executor: Optional[executors.Executor]=None,
+        resume: bool=False,
+        merge: bool=False,
+        bare_plus: bool=False,
+        sink_command: Optional[str]=None,
+        fifo: bool=False,
+        output_format: str=partition.OUTPUT_FORMATS[0],
+        pair_window: int=0,
+        skip_unpaired: bool=False,
+        progress_interval: float=progress.INTERVAL,
+        status_file: Optional[str]=None,
+        stats_formats: Sequence[str]=(),
+        spill_runs: bool=False,
+        max_open_files: Optional[int]=None,
+        merge_buffer: int=_COPY_BUFFER,
+        governor: Optional[memory.Governor]=None,
+        log_assignments: bool=False,
+        sink_spill: int=sinks.MAX_SPILL
+) -> Tuple[Dict[str, Tuple[str, Optional[str]]]]:
+    """Demultiplex one or more lanes of FASTQ files chunk by chunk
+    Returns the outputs for each lane; merged lanes share the same outputs
+    matcher [partition.Matcher]     The matcher used to assign reads
+    lanes [Sequence[Lane]]          Forward and optional reverse FASTQ files for each lane
+    directory [str]                 Output directory
+    num_reads [int]=None            Fixed number of reads per chunk; if None, size chunks from throughput
+    executor [Executor]=None        Where to run chunks; if None, run serially
+    resume [bool]=False             Skip chunks finished by a previous run of the same inputs
+    merge [bool]=False              Write every lane into one set of outputs per sample
+    bare_plus [bool]=False          Write a bare '+' line rather than repeating the read ID
+    sink_command [str]=None         Stream every output into this command rather than writing it to disk;
+                                    '{output}', '{sample}', and '{read}' are filled in for each output
+    fifo [bool]=False               Stream every output into a named pipe at its output name
+    output_format [str]='fastq'     Write pairs to separate FASTQ files, to one 'interleaved' FASTQ file, or to one unaligned 'bam' file
+    pair_window [int]=0             How far out of order a read may be from its mate, across chunks too
+    skip_unpaired [bool]=False      Leave out and count reads without a mate rather than stopping
+    progress_interval [float]=30.0  Seconds between progress reports; if 0, only report at the end
+    status_file [str]=None          Also write each progress report as a JSON line to this file
+    stats_formats [Sequence[str]]   Write summary tables and plots in these formats ('pdf', 'png', 'svg')
+                                    from the counts gathered while demultiplexing; if empty, skip them
+    spill_runs [bool]=False         Have each chunk write one spill run rather than a partial output per category,
+                                    then write every output once at the end; for thousands of samples
+    max_open_files [int]=None       Most spill runs to have open at once while merging; if None, from the system limit
+    merge_buffer [int]=16 MiB       Most bytes to copy at a time while merging
+    governor [memory.Governor]=None Keep chunk sizes, copy buffers, and chunks in flight within a memory budget
+    log_assignments [bool]=False    Write the sample, edit distance, and UMI of every read to a columnar
+                                    log in the output directory, see 'assignments.AssignmentReader'
+    sink_spill [int]=256 MiB        Most bytes a streamed output may fall behind, spilled to disk, before stopping;
+                                    no new chunks are handed out while any streamed output is behind
+    """
+    if len(set(_paired(lane=lane) for lane in lanes)) > 1:
+        raise ValueError(logging.error("Cannot mix paired and single-end lanes"))
+    stream = bool(sink_command or fifo) # type: bool
+    if stream and resume:
+        raise ValueError(logging.error("Cannot resume a run that streams its outputs"))
+    if stream and spill_runs:
+        raise ValueError(logging.error("Cannot spill a run that streams its outputs"))
+    os.makedirs(directory, exist_ok=True)
+    executor = executor or executors.SerialExecutor(matcher=matcher) # type: executors.Executor
+    lane_outputs = _lane_outputs(matcher=matcher, lanes=lanes, directory=directory, merge=merge, output_format=output_format) # type: Tuple[Dict[str, Tuple[str, Optional[str]]]]
+    output_files = tuple(sorted(set(filter( # type: Tuple[str]
+        None,
+        itertools.chain.from_iterable(itertools.chain.from_iterable(outputs.values()) for outputs in lane_outputs)
+    ))))
+    block_reads = num_reads or chunks.BLOCK_READS # type: int
+    #   Plain gzip can only be read in order, so lanes with any are planned here while they're read rather than up front
+    streamed = tuple( # type: Tuple[bool]
+        not all(chunks.random_access(filename=filename) for filename in filter(None, (lane.forward, lane.reverse)))
+        for lane in lanes
+    )
+    blocks = tuple(itertools.chain.from_iterable( # type: Tuple[chunks.Chunk]
+        chunks.plan_chunks(forward=lane.forward, reverse=lane.reverse, num_reads=block_reads, lane=index, interleaved=lane.interleaved)
+        for index, lane in enumerate(lanes)
+        if not streamed[index]
+    ))
+    parameters = { # type: Dict[str, Any]
+        'lanes': [(checkpoint.fingerprint(filename=lane.forward), checkpoint.fingerprint(filename=lane.reverse), lane.interleaved) for lane in lanes],
+        'merge': merge,
+        'bare_plus': bare_plus,
+        'output_format': output_format,
+        'pair_window': pair_window,
+        'skip_unpaired': skip_unpaired,
+        'block_reads': block_reads,
+        'matcher': matcher.settings
+    }
+    if log_assignments:
+        #   Only a run that logged from the start can resume its log
+        parameters['assignment_log'] = True
+    log_name = os.path.join(directory, assignments.LOG_NAME) if log_assignments else None # type: Optional[str]
+    log_files = (log_name,) if log_name else () # type: Tuple[str]
+    if stream:
+        #   Streamed outputs can't be truncated or replayed, so only keep counts in memory
+        manifest = checkpoint.Manifest(filename=None, parameters=parameters) # type: checkpoint.Manifest
+        streams = sinks.open_sinks(outputs=lane_outputs, command=sink_command, fifo=fifo, max_spill=sink_spill) # type: Dict[str, sinks.Sink]
+        if output_format == 'bam':
+            for sink in streams.values(): # type: sinks.Sink
+                sink.write(bam.header())
     else:
-        for p in prefixes:
-            f_file = os.path.join(d, f_dict[p])
-            master_dict[p] = {'f_input': f_file, 'r_input': None}
-
-    return master_dict
-
-
-def _join_output_(sample_dict:dict, forward_fastq:str, reverse_fastq: Optional[str] = None):
-    (d, fn) = _get_dir_fn_(forward_fastq)
-
-    os.chdir(d)
-    print("changed to dir %s" % os.getcwd())
-
-    for sample in sample_dict.keys():
-        multi_pattern = sample + "_" + "fwd" + "_x*_" + fn
-        output_file = sample + "_fwd_" + fn
-        print("joining output for %s" % sample)
-        cmd = "cat " + multi_pattern + " > " +  output_file
-        rmc = "rm -f " + multi_pattern
-        rc = subprocess.call(cmd, shell=True)
-        rc2 = subprocess.call(rmc, shell=True)
-        if rc:
-            raise Exception("Error joining output files"
-                            )
-
-def _sanity_checks_(num_lines:int, forward_fastq:str, reverse_fastq: Optional[str] = None):
-    logger.debug("sanity checks num_lines %i, forward_fastq %s, reverse %s" % (num_lines, forward_fastq, reverse_fastq))
-    (fdir, ffn) = _get_dir_fn_(forward_fastq)
-    (rdir, rfn) = _get_dir_fn_(reverse_fastq)
-    if rdir and not (fdir == rdir):
-        raise Exception("forward fastq and reverse fastq must be in same directory: %s   %s" % forward_fastq,
-                        reverse_fastq)
-    file_lines = _get_line_count_(forward_fastq)
-    if file_lines % 4 or num_lines % 4:
-        raise Exception("fastq file size, and split file size must both be a multiple of 4, you gave file: %i, split: %i"
-                % (file_lines, num_lines))
-
-
-def _dump_dict_(master_dict:dict):
-    for p in master_dict.keys():
-        f_f = master_dict[p]["f_input"]
-        r_f = master_dict[p]["r_input"]
-        logger.debug("prefix %s, forward: %s, reverse %s" % (p, f_f, r_f))
-
-
-def _partition_(barcodes:dict, forward_fn:str, reverse_fn: Optional[str] = None):
-    return partition(barcodes, forward_fn, reverse_fn)
-
-
-def _reduce_(results:list):
-    sleep(3)
-
-
-
-
-def parallelize(sample_dict:dict, num_lines:int, forward_fastq:str, reverse_fastq:Optional[str] = None):
-    orig_home = os.getcwd()
-
-    _sanity_checks_(num_lines, forward_fastq, reverse_fastq)
-    master_dict  = _fetch_chunk_files_(num_lines, forward_fastq, reverse_fastq)
-    logger.debug(json.dumps(master_dict))
-    logger.debug("iterating over partition calls")
-    results = []
-
-    for p in sorted(master_dict):
-        f_file = master_dict[p]['f_input']
-        r_file = master_dict[p]['r_input']
-        logger.debug("calling partition")
-        result = dask.delayed(_partition_)(sample_dict, f_file, r_file)
-        results.append(result)
-
-    logger.debug("calling reduce")
-    the_job = dask.delayed(_reduce_)(results)
-    the_job.compute(num_workers=4)
-
-    join_out = _join_output_(sample_dict, forward_fastq, reverse_fastq)
-
-    #the_job.visualize()
-
-
-def main():
+        manifest_name = os.path.join(directory, MANIFEST_NAME) # type: str
+        if resume:
+            manifest = checkpoint.Manifest.load(filename=manifest_name, parameters=parameters)
+        else:
+            manifest = checkpoint.Manifest(filename=manifest_name, parameters=parameters)
+            manifest.remove()
+        #   Drop anything written after the last checkpoint, including leftover partial outputs
+        manifest.restore(outputs=output_files + log_files)
+        shutil.rmtree(os.path.join(directory, _PARTS_DIRECTORY), ignore_errors=True)
+        if spill_runs:
+            #   Keep the runs of finished chunks, outputs are only written once every run is in
+            finished = set(_run_name(directory=directory, lane=lane, index=index) for lane, index in manifest.chunks()) # type: Set[str]
+            os.makedirs(os.path.join(directory, _SPILL_DIRECTORY), exist_ok=True)
+            for name in os.listdir(os.path.join(directory, _SPILL_DIRECTORY)): # type: str
+                if os.path.join(directory, _SPILL_DIRECTORY, name) not in finished:
+                    os.remove(os.path.join(directory, _SPILL_DIRECTORY, name))
+        elif output_format == 'bam':
+            for output in output_files: # type: str
+                if not os.path.getsize(output):
+                    with open(output, 'wb') as ofile:
+                        ofile.write(bam.header())
+        streams = dict() # type: Dict[str, sinks.Sink]
+    if log_name and stream:
+        #   Nothing is resumed when streaming, so start the log afresh
+        with open(log_name, 'wb'):
+            pass
+    assignment_log = assignments.AssignmentLog( # type: Optional[assignments.AssignmentLog]
+        filename=log_name,
+        categories=matcher.categories,
+        lanes=tuple(lane.forward for lane in lanes)
+    ) if log_name else None
+    todo = tuple(block for block in blocks if block not in manifest) # type: Tuple[chunks.Chunk]
+    if len(blocks) or not any(streamed):
+        logging.info("Demultiplexing %s of %s blocks from %s lanes", len(todo), len(blocks), streamed.count(False))
+    #   Offsets into lanes planned as they're read are in the uncompressed streams
+    virtual = tuple( # type: Tuple[Tuple[bool, bool]]
+        (chunks.virtual_offsets(filename=lane.forward), chunks.virtual_offsets(filename=lane.reverse)) if not streamed[index] else (False, False)
+        for index, lane in enumerate(lanes)
+    )
+    readers = { # type: Dict[int, chunks.BlockStream]
+        index: chunks.BlockStream(
+            forward=lane.forward,
+            reverse=lane.reverse,
+            num_reads=block_reads,
+            lane=index,
+            interleaved=lane.interleaved,
+            window=pair_window if _paired(lane=lane) else 0
+        )
+        for index, lane in enumerate(lanes)
+        if streamed[index]
+    }
+    for index in readers: # type: int
+        for filename in filter(None, (lanes[index].forward, lanes[index].reverse)): # type: str
+            if not chunks.random_access(filename=filename):
+                logging.warning("%s is gzipped but not BGZF, so its lane is read here, in order, rather than by workers; compress it with bgzip to read it in parallel", filename)
+    #   Mates may be out of step across the edges of a chunk, so workers can look into the blocks either side
+    planned = { # type: Dict[Tuple[int, int], chunks.Chunk]
+        (block.lane, block.index): block for block in blocks if pair_window and _paired(lane=lanes[block.lane])
+    }
+    #   Lanes planned as they're read are measured in bytes on disk
+    tracker = progress.Progress( # type: progress.Progress
+        total_bytes=sum(progress.chunk_bytes(chunk=block, virtual=virtual[block.lane][0], reverse_virtual=virtual[block.lane][1]) for block in todo)
+        + sum(reader.size for reader in readers.values()),
+        interval=progress_interval,
+        status_file=status_file
+    )
+    feeds = {index: _feed(reader=reader, manifest=manifest, tracker=tracker) for index, reader in readers.items()} # type: Dict[int, Callable[[], Optional[chunks.Chunk]]]
+    #   The first block of each lane planned as it's read stands in for the rest when sizing chunks
+    firsts = tuple(filter(None, (feed() for feed in feeds.values()))) # type: Tuple[chunks.Chunk]
+    buffer_size = _COPY_BUFFER # type: int
+    max_blocks = None # type: Optional[int]
+    if governor:
+        buffer_size = governor.buffer_size(requested=buffer_size)
+        merge_buffer = governor.buffer_size(requested=merge_buffer)
+        max_blocks = governor.max_blocks(blocks=todo + firsts, virtual=virtual)
+        logging.debug("Grouping at most %s blocks per chunk and copying %s KiB at a time", max_blocks, buffer_size // 1024)
+    work = scheduler.Scheduler( # type: scheduler.Scheduler
+        blocks=todo + firsts,
+        workers=executor.workers,
+        adaptive=not num_reads,
+        max_blocks=max_blocks,
+        feeds={index: feed for index, feed in feeds.items() if any(first.lane == index for first in firsts)}
+    )
+    #   UMIs aren't checkpointed, so after a resume they only cover this run's chunks
+    umis = collections.Counter() # type: Counter
+    cache_counts = collections.Counter() # type: Counter
+    demultiplex_start = time.time() # type: float
+    tracker.start()
     try:
-        #_run_command_("rm -f /home/jcabraham/python-projects/Barcode_Partitioning/test.cases/*x*")
-        sample_file = '/home/jcabraham/python-projects/Barcode_Partitioning/new.sample_sheet.txt'
-        barcode_file = '/home/jcabraham/python-projects/Barcode_Partitioning/new_barcodes_csv.txt'
-        samples = extract_barcodes(sample_file, barcode_file)
-        logger.debug(json.dumps(samples))
-
-        num_lines = 20000
-        forward_fastq = "/home/jcabraham/python-projects/Barcode_Partitioning/test.cases/little1.R1.fastq"
-        reverse_fastq = ''
-
-        parallelize(
-            sample_dict=samples,
-            num_lines=num_lines,
-            forward_fastq=forward_fastq
-        #    reverse_fastq=reverse_fastq
+        while True:
+            #   Hand out work as workers free up rather than all at once, holding back near the memory budget
+            #   and while a streamed output is behind; only chunks already in flight then spill
+            if streams and not executor.pending:
+                sinks.wait_for_room(sinks=streams.values())
+            while (
+                    executor.pending < work.depth
+                    and (governor is None or governor.allow(pending=executor.pending))
+                    and not (executor.pending and any(sink.backlogged for sink in streams.values()))
+            ):
+                chunk = work.next_chunk() # type: Optional[chunks.Chunk]
+                if chunk is None:
+                    break
+                data = readers[chunk.lane].take(chunk=chunk) if chunk.lane in readers else None # type: Optional[Tuple[bytes, Optional[bytes]]]
+                edges = readers[chunk.lane].edges(chunk=chunk) if chunk.lane in readers else None # type: Optional[Tuple[Optional[Tuple[bytes, Optional[bytes]]], Optional[Tuple[bytes, Optional[bytes]]]]]
+                neighbours = (
+                    planned.get((chunk.lane, chunk.index - 1)), planned.get((chunk.lane, chunk.index + chunk.blocks))
+                ) if planned else None # type: Optional[Tuple[Optional[chunks.Chunk], Optional[chunks.Chunk]]]
+                executor.submit(
+                    demultiplex_chunk,
+                    chunk=chunk,
+                    lane=lanes[chunk.lane],
+                    directory=directory,
+                    bare_plus=bare_plus,
+                    stream=stream,
+                    output_format=output_format,
+                    pair_window=pair_window,
+                    skip_unpaired=skip_unpaired,
+                    spill_runs=spill_runs,
+                    log_assignments=log_assignments,
+                    data=data,
+                    neighbours=neighbours,
+                    edges=edges
+                )
+            if not executor.pending:
+                break
+            #   Reduce partial outputs and counts centrally, in whatever order chunks finish
+            result = executor.next_result() # type: ChunkResult
+            work.record(chunk=result.chunk, seconds=result.seconds)
+            tracker.update(
+                size=readers[result.chunk.lane].finish(chunk=result.chunk) if result.chunk.lane in readers
+                else progress.chunk_bytes(chunk=result.chunk, virtual=virtual[result.chunk.lane][0], reverse_virtual=virtual[result.chunk.lane][1]),
+                counts=result.counts,
+                cache=result.cache
+            )
+            umis.update(result.umis)
+            cache_counts.update(result.cache)
+            lane = lanes[result.chunk.lane] # type: Lane
+            if assignment_log:
+                #   Blocks all hold the same number of reads, so a chunk's first read follows from its first block;
+                #   the columns carry where each read sits from there, as pairing may leave reads out
+                assignment_log.append(lane=result.chunk.lane, first=result.chunk.index * block_reads, columns=result.assignments)
+            if stream:
+                _stream(result=result, outputs=lane_outputs[result.chunk.lane], streams=streams)
+                manifest.commit(chunk=result.chunk, outputs=(), counts=result.counts, stages=result.filtered, distances=result.distances)
+                continue
+            if spill_runs:
+                manifest.commit(chunk=result.chunk, outputs=log_files, counts=result.counts, stages=result.filtered, distances=result.distances)
+                continue
+            parts = output_names(matcher=matcher, directory=result.directory, forward=lane.forward, paired=_paired(lane=lane), output_format=output_format) # type: Dict[str, Tuple[str, Optional[str]]]
+            _collect(result=result, parts=parts, outputs=lane_outputs[result.chunk.lane], buffer_size=buffer_size)
+            manifest.commit(chunk=result.chunk, outputs=output_files + log_files, counts=result.counts, stages=result.filtered, distances=result.distances)
+    except BaseException:
+        tracker.stop(finished=False)
+        for sink in streams.values(): # type: sinks.Sink
+            sink.terminate()
+        raise
+    finally:
+        for reader in readers.values(): # type: chunks.BlockStream
+            reader.close()
+    tracker.stop()
+    if spill_runs:
+        _merge_runs(
+            manifest=manifest,
+            matcher=matcher,
+            lane_outputs=lane_outputs,
+            directory=directory,
+            merge=merge,
+            max_open_files=max_open_files,
+            buffer_size=merge_buffer,
+            bam_output=output_format == 'bam'
         )
-
-    except:
-        print(sys.exc_info())
-        logger.error(sys.exc_info())
-
-
-if __name__ == "__main__":
-    # execute only if run as a script
-    main()
+    else:
+        #   Fold the journal of chunk commits back into the manifest
+        manifest.save()
+    #   BAM outputs end with an empty block; it's left out of the checkpoint so resuming drops it
+    if not spill_runs and output_format == 'bam':
+        for sink in streams.values(): # type: sinks.Sink
+            sink.write(bam.EOF)
+        if not stream:
+            for output in output_files: # type: str
+                with open(output, 'ab') as ofile:
+                    ofile.write(bam.EOF)
+    #   Wait for every sink to drain so downstream commands see the whole output
+    for sink in streams.values(): # type: sinks.Sink
+        sink.close()
+    if not stream:
+        shutil.rmtree(os.path.join(directory, _PARTS_DIRECTORY), ignore_errors=True)
+    logging.debug("Demultiplexing took %s seconds", round(time.time() - demultiplex_start, 3))
+    logging.info(
+        "Ran %s chunks on %s workers at %s%% worker utilization",
+        work.handed_out,
+        executor.workers,
+        round(100 * work.utilization, 1)
+    )
+    if cache_counts:
+        logging.info(
+            "Match cache: %s%% of %s lookups hit, %s evicted",
+            round(100 * cache.hit_rate(counts=cache_counts), 1),
+            cache_counts['hits'] + cache_counts['misses'],
+            cache_counts['evictions']
+        )
+    if assignment_log:
+        logging.info("Logged where every read was assigned in %s", assignment_log.filename)
+    if governor:
+        logging.info(
+            "Memory: peaked at %s of %s MiB, held back chunks %s times",
+            governor.peak // 2 ** 20,
+            governor.budget // 2 ** 20,
+            governor.throttled
+        )
+    for stage, count in manifest.stages().items(): # type: str, int
+        logging.info("Quality stage %s: %s reads", stage, count)
+    for category, count in manifest.counts().items(): # type: str, int
+        logging.info("%s: %s reads", category, count)
+    if stats_formats:
+        #   Imported here as plotting needs matplotlib, which is optional
+        from barcseek import stats
+        if resume and umis:
+            logging.warning("UMI counts only cover chunks demultiplexed since resuming")
+        stats.write_report(
+            counts=manifest.counts(),
+            samples=matcher.samples,
+            distances=manifest.distances(),
+            umis=umis,
+            directory=directory,
+            formats=stats_formats
+        )
+    return lane_outputs
@@ -9,9 +9,13 @@ if not (sys.version_info.major == 3 and sys.version_info.minor >= 5):
 
 #   Load standard modules
 import os
+import logging
 import itertools
-from copy import deepcopy
-from typing import Optional, Union, Tuple, List, Dict
+import threading
+import collections
+from collections import Counter
+from copy import copy, deepcopy
+from typing import Any, Optional, Union, Tuple, List, Dict, Iterable, Sequence
 
 #   Load custom modules
 import barcseek.fastq as fastq
@@ -37,6 +41,26 @@ IUPAC_CODES = { # type: Dict[str, str]
     'V': 'ACG'
 }
 
+AMBIGUOUS = 'ambiguous' # type: str
+UNDETERMINED = 'undetermined' # type: str
+
+VERIFIERS = ('regex', 'myers') # type: Tuple[str]
+#   Write pairs to separate files, to one interleaved FASTQ file, or to one unaligned BAM file
+OUTPUT_FORMATS = ('fastq', 'interleaved', 'bam') # type: Tuple[str]
+#   Match barcodes as written, or detect each slot's orientation from a sample of reads
+ORIENTATIONS = ('given', 'auto') # type: Tuple[str]
+
+#   The result of matching a read against every sample
+#   'sample' is either a sample name, AMBIGUOUS, or UNDETERMINED
+#   'read' is the trimmed read for assigned reads, otherwise the untouched read
+#   'distance' is the total edit distance of the barcodes, None if undetermined
+Assignment = collections.namedtuple('Assignment', ('sample', 'read', 'distance'))
+
+#   The results of matching a batch of reads, one entry per read in each column
+#   'cuts' holds the spans of each read's buffers to trim, empty unless assigned
+#   'umis' holds each read's UMI, None unless assigned to a sample with one
+Assignments = collections.namedtuple('Assignments', ('samples', 'distances', 'cuts', 'umis'))
+
 def fix_iupac(barcode: str) -> str:
     """Remove IUPAC codes from the barcode sequence, 'N's will remain
     barcode [str]   The barcode sequence to remove IUPAC codes from
@@ -57,7 +81,7 @@ def barcode_to_regex(barcode: str, error_rate: Optional[int]=None):
     umi_lengths = tuple(map(len, umi)) # type: Tuple[int]
     filtered_barcode = filter(None, barcode.upper().split('N')) # type: filter
     for index, subpattern in enumerate(filtered_barcode): # type: int, str
-        barcode_pattern = '(' + subpattern + ')' # type: str
+        barcode_pattern = '(' + fix_iupac(barcode=subpattern) + ')' # type: str
         if error_rate:
             barcode_pattern += '{e<=' + str(error_rate) + '}'
         pattern += barcode_pattern
@@ -69,17 +93,38 @@ def barcode_to_regex(barcode: str, error_rate: Optional[int]=None):
             if error_rate:
                 umi_pattern += '{e<=' + str(error_rate) + '}'
             pattern += umi_pattern
-    find_barcode = regex.compile(r'%s' % pattern, regex.ENHANCEMATCH)
+    #   Take the match with the fewest edits anywhere in the sequence, not the first one found
+    find_barcode = regex.compile(r'%s' % pattern, regex.BESTMATCH)
     return find_barcode
 
 
-def match_barcode(read: fastq.Read, barcodes: Union[Tuple[str], List[str]], error_rate: Optional[int]=None) -> Optional[fastq.Read]:
+def match_barcode(
+        read: fastq.Read,
+        barcodes: Union[Tuple[str], List[str]],
+        error_rate: Optional[int]=None,
+        verifier: str='regex'
+) -> Optional[fastq.Read]:
     """Match a read to a specific pair of barcodes
     read [fastq.Read]                           A read object to try matching with this set of barcodes
     barcodes [Collection[str, Optional[str]]]:  A tuple or list of one or two barcode sequences
     error_rate [int]=None                       The error rate
+    verifier [str]='regex'                      Find barcodes with 'regex' patterns or 'myers' bit-vectors
     """
-    barcodes = filter(None, barcodes) # type: Iterable[str]
+    barcodes = tuple(filter(None, barcodes)) # type: Tuple[str]
+    if verifier == 'myers':
+        #   Imported here as the verifier needs IUPAC_CODES from this module
+        from barcseek.myers import compile_barcode
+        patterns = tuple(compile_barcode(barcode=barcode) for barcode in barcodes) # type: Tuple
+        if len(patterns) not in (1, 2):
+            raise ValueError("There only be one or two barcodes")
+        alignments = list() # type: List
+        for index, pattern in enumerate(patterns): # type: int, myers.Pattern
+            sequence = read.reverse if index % 2 else read.forward # type: Optional[str]
+            alignment = pattern.locate(sequence=sequence, max_distance=error_rate or 0) if sequence else None
+            if alignment is None:
+                return None
+            alignments.append(alignment)
+        return _trim_alignments(read=read, patterns=patterns, alignments=alignments)
     regexes = tuple(map(lambda tup: barcode_to_regex(*tup), zip(barcodes, itertools.repeat(error_rate)))) # type: Tuple
     matches = list() # type: List
     if len(regexes) == 1:
@@ -94,19 +139,786 @@ def match_barcode(read: fastq.Read, barcodes: Union[Tuple[str], List[str]], erro
     else:
         raise ValueError("There only be one or two barcodes")
     try:
-        trimmed = deepcopy(read) # type: fastq.Read
-        for index, reg in enumerate(regexes): # type: int, _regex.Pattern
-            reverse = bool(index % 2) # type: bool
-            for i in range(reg.groups): # type: int
-                if i % 2 != 0:
-                    continue
-                start, end = matches[index].span(i + 1) # type: int, int
-                trimmed.trim(start=start, end=end, reverse=reverse)
+        trimmed = _trim_read(read=read, regexes=regexes, matches=matches) # type: fastq.Read
     except AttributeError:
         return None
     return trimmed
 
 
+def _regex_cuts(regexes: Tuple, matches: List) -> Tuple[Tuple[Tuple[int, int]]]:
+    """Find the spans of barcode groups in regex matches, one tuple of spans per pattern"""
+    cuts = list() # type: List[Tuple[Tuple[int, int]]]
+    for reg, match in zip(regexes, matches): # type: _regex.Pattern, _regex.Match
+        #   Barcode groups are every other group
+        cuts.append(tuple(match.span(i + 1) for i in range(0, reg.groups, 2)))
+    return tuple(cuts)
+
+
+def _alignment_cuts(patterns: Tuple, alignments: List) -> Tuple[Tuple[Tuple[int, int]]]:
+    """Find the spans of barcode segments in bit-vector alignments, one tuple of spans per barcode"""
+    cuts = list() # type: List[Tuple[Tuple[int, int]]]
+    for pattern, alignment in zip(patterns, alignments): # type: myers.Pattern, myers.Alignment
+        #   UMIs stay in the read; only segments between them are cut
+        cuts.append(tuple((alignment.positions[start], alignment.positions[end]) for start, end in pattern.segments()))
+    return tuple(cuts)
+
+
+def _cut_read(read: fastq.Read, cuts: Tuple[Tuple[Tuple[int, int]]]) -> fastq.Read:
+    """Trim spans out of a copy of a read
+    read [fastq.Read]                           The read to trim
+    cuts [Tuple[Tuple[Tuple[int, int]]]]:       Spans to trim from each sequence, forward first then reverse
+    """
+    trimmed = deepcopy(read) # type: fastq.Read
+    for index, spans in enumerate(cuts): # type: int, Tuple[Tuple[int, int]]
+        reverse = bool(index % 2) # type: bool
+        sequence = trimmed.reverse if reverse else trimmed.forward # type: str
+        #   Rebuild each sequence once from the spans between barcodes
+        trimmed.keep(intervals=fastq.keep_intervals(start=0, end=len(sequence), cuts=spans), reverse=reverse)
+    return trimmed
+
+
+def _trim_read(read: fastq.Read, regexes: Tuple, matches: List) -> fastq.Read:
+    """Trim barcode groups out of a copy of a read
+    read [fastq.Read]   The read to trim
+    regexes [Tuple]     Compiled barcode patterns, forward first then reverse
+    matches [List]      Matches for each pattern in 'regexes'
+    """
+    return _cut_read(read=read, cuts=_regex_cuts(regexes=regexes, matches=matches))
+
+
+def _trim_alignments(read: fastq.Read, patterns: Tuple, alignments: List) -> fastq.Read:
+    """Trim barcode segments out of a copy of a read using bit-vector alignments
+    read [fastq.Read]   The read to trim
+    patterns [Tuple]    Compiled barcodes, forward first then reverse
+    alignments [List]   Alignments for each barcode in 'patterns'
+    """
+    return _cut_read(read=read, cuts=_alignment_cuts(patterns=patterns, alignments=alignments))
+
+
+def _umi_layout(barcode: str) -> Tuple[Tuple[int, bool, int]]:
+    """Where each run of 'N's sits in a barcode
+    Returns the index of the barcode segment each UMI is anchored to, whether the UMI
+    comes after (True) or before (False) that segment, and the UMI's length
+    """
+    layout = list() # type: List[Tuple[int, bool, int]]
+    segment = -1 # type: int
+    for run in regex.finditer(r'N+|[^N]+', barcode.upper()): # type: _regex.Match
+        if run.group().startswith('N'):
+            layout.append((segment, True, len(run.group())) if segment >= 0 else (0, False, len(run.group())))
+        else:
+            segment += 1
+    return tuple(layout)
+
+
+def _extract_umi(texts: Tuple[str, Optional[str]], layouts: Tuple, cuts: Tuple[Tuple[Tuple[int, int]]]) -> str:
+    """Pull the UMI bases of an assigned read out of its sequences, using the spans of its barcode segments"""
+    umi = list() # type: List[str]
+    for index, (layout, spans) in enumerate(zip(layouts, cuts)): # type: int, Tuple[Tuple[int, bool, int]], Tuple[Tuple[int, int]]
+        text = texts[index % 2] # type: str
+        for segment, after, length in layout: # type: int, bool, int
+            if after:
+                umi.append(text[spans[segment][1]:spans[segment][1] + length])
+            else:
+                umi.append(text[max(spans[segment][0] - length, 0):spans[segment][0]])
+    return '+'.join(umi)
+
+
+class Matcher(object):
+
+    """Assign reads to a single sample
+    Patterns for every sample are compiled once per allowed edit distance. Samples are
+    tried with exact patterns first, then with increasingly fuzzy patterns, until no
+    fuzzier pattern could beat the best hit so far. Each pattern scores its best match
+    in the read rather than its first, the hit with the lowest total edit distance
+    wins, and ties are reported as ambiguous rather than written to several samples.
+    With the 'myers' verifier, anything not matched exactly is aligned once per sample
+    with bit-vectors, which find the lowest edit distance directly rather than one
+    fuzzy level at a time; distances then count over a whole barcode, UMIs included,
+    rather than per segment, so a barcode with UMIs may be assigned with 'regex'
+    when its edits are spread over segments and left undetermined with 'myers'
+    """
+
+    def __init__(
+            self,
+            samples: Dict[str, Tuple[str, Optional[str]]],
+            error_rate: Optional[int]=None,
+            prefilter: bool=False,
+            verifier: str='regex',
+            quality: Optional['barcseek.quality.QualityFilter']=None,
+            index: bool=False,
+            orientation: str='given',
+            window: Optional[int]=None,
+            cache: int=0,
+            structures: Optional[Sequence[Optional[str]]]=None
+    ) -> None:
+        """
+    samples [Dict[str, Tuple[str, Optional[str]]]]: A dictionary where the key is the sample ID and
+                                                    the value is a tuple of one or two barcode sequences
+    error_rate [int]=None                           The error rate
+    prefilter [bool]=False                          Find candidate samples with a seed prefilter before
+                                                    running any patterns; worthwhile for many samples
+                                                    or barcodes at varying positions
+    verifier [str]='regex'                          Find fuzzy matches with 'regex' patterns or
+                                                    'myers' bit-vectors
+    quality [quality.QualityFilter]=None            Trim and filter reads by quality before matching;
+                                                    reads that fail are undetermined
+    index [bool]=False                              Look barcodes up in a sorted whitelist index rather
+                                                    than trying every sample; for many thousands of
+                                                    plain, fixed-length barcodes with at most one mismatch
+    orientation [str]='given'                       Match barcodes only as written ('given'), or also compile
+                                                    them reverse complemented so 'detect' can pick the
+                                                    orientation of each slot from a sample of reads ('auto')
+    window [int]=None                               Only search the first 'window' bases of each read for barcodes
+    cache [int]=0                                   Spend up to this many bytes caching results by searched sequence,
+                                                    so repeated barcode windows skip the search; best with 'window'
+    structures [Sequence[Optional[str]]]=None       Read structures such as '8B10M8B+T' for the forward and reverse
+                                                    reads; barcodes are sliced out where the structures put them
+                                                    rather than searched for, and every non-template segment is trimmed
+    """
+        if verifier not in VERIFIERS:
+            raise ValueError("'verifier' must be one of '%s'" % "', '".join(VERIFIERS))
+        if orientation not in ORIENTATIONS:
+            raise ValueError("'orientation' must be one of '%s'" % "', '".join(ORIENTATIONS))
+        self._samples = tuple(samples.keys()) # type: Tuple[str]
+        self._barcodes = {sample: tuple(barcodes) for sample, barcodes in samples.items()} # type: Dict[str, Tuple[str, Optional[str]]]
+        self._error = error_rate or 0 # type: int
+        self._verifier = verifier # type: str
+        for sample, barcodes in self._barcodes.items(): # type: str, Tuple[str, Optional[str]]
+            if not 0 < len(tuple(filter(None, barcodes))) <= 2:
+                raise ValueError("Sample %s must have one or two barcodes" % sample)
+        if structures and window:
+            raise ValueError("Read structures already say where barcodes are; cannot also use a search window")
+        self._structures = tuple(structures) if structures else None # type: Optional[Tuple[Optional[str]]]
+        #   Compile every orientation up front; only the locked one is ever searched
+        slots = max(len(tuple(filter(None, barcodes))) for barcodes in self._barcodes.values()) # type: int
+        if orientation == 'auto':
+            combinations = tuple(flips + (False,) * (2 - slots) for flips in itertools.product((False, True), repeat=slots)) # type: Tuple[Tuple[bool, bool]]
+        else:
+            combinations = ((False, False),) # type: Tuple[Tuple[bool, bool]]
+        if index and not self._structures:
+            #   Flipping a slot only reverse complements its index, so samples are paired up with barcodes once
+            #   and each slot is indexed at most twice, whichever orientations use it
+            indexes, table = self._build_indexes(flipped=orientation == 'auto') # type: Optional[Tuple[Tuple[BarcodeIndex]]], Optional[SampleTable]
+        else:
+            indexes, table = None, None
+        self._orientations = { # type: Dict[Tuple[bool, bool], Dict[str, Any]]
+            flips: self._compile(flips=flips, prefilter=prefilter, indexes=indexes, table=table)
+            for flips in combinations
+        }
+        self._flips = None # type: Optional[Tuple[bool, bool]]
+        self._window = window # type: Optional[int]
+        if cache:
+            from barcseek.cache import MatchCache
+            self._cache = MatchCache(budget=cache) # type: Optional[MatchCache]
+        else:
+            self._cache = None # type: Optional[MatchCache]
+        #   Each thread running tasks gets a cache of its own, see 'task'
+        self._thread_caches = dict() # type: Dict[int, MatchCache]
+        self.lock(flips=(False, False))
+        self._quality = quality # type: Optional[quality.QualityFilter]
+        self.reads = 0 # type: int
+        self.evaluations = 0 # type: int
+        #   Reads stopped or trimmed at each quality stage
+        self.filtered = Counter() # type: Counter
+        #   Assigned reads per sample and edit distance, and per sample and UMI
+        self.distances = Counter() # type: Counter
+        self.umis = Counter() # type: Counter
+
+    def _orient(self, flips: Tuple[bool, bool]) -> Dict[str, Tuple[str, Optional[str]]]:
+        """The sample barcodes with the slots in 'flips' reverse complemented"""
+        from barcseek.barcodes import reverse_complement
+        return {
+            sample: tuple(
+                reverse_complement(barcode=barcode) if barcode and flip else barcode
+                for barcode, flip in zip(barcodes, flips + (False,) * (len(barcodes) - len(flips)))
+            )
+            for sample, barcodes in self._barcodes.items()
+        }
+
+    def _compile(
+            self,
+            flips: Tuple[bool, bool],
+            prefilter: bool,
+            indexes: Optional[Tuple[Tuple['barcseek.index.BarcodeIndex']]]=None,
+            table: Optional['barcseek.index.SampleTable']=None
+    ) -> Dict[str, Any]:
+        """Build everything used to search for one orientation of the barcodes"""
+        compiled = {'levels': tuple(), 'indexes': None, 'pairs': None, 'prefilters': None, 'patterns': None, 'plan': None} # type: Dict[str, Any]
+        if indexes is not None:
+            #   Indexed barcodes are only ever A, C, G, or T, so they hold no UMIs
+            compiled['indexes'] = tuple(slot[flip] for slot, flip in zip(indexes, flips))
+            compiled['pairs'] = table
+            compiled['umis'] = dict()
+            return compiled
+        samples = self._orient(flips=flips) # type: Dict[str, Tuple[str, Optional[str]]]
+        if self._structures:
+            #   Imported here as read structures need barcode_to_regex from this module
+            from barcseek.layout import ExtractionPlan
+            compiled['plan'] = ExtractionPlan(structures=self._structures, samples=samples, error_rate=self._error)
+            compiled['umis'] = dict()
+            return compiled
+        compiled['umis'] = {
+            sample: tuple(_umi_layout(barcode=barcode) for barcode in filter(None, barcodes))
+            for sample, barcodes in samples.items()
+            if any('N' in barcode.upper() for barcode in filter(None, barcodes))
+        }
+        #   Bit-vectors handle every fuzzy distance at once, so only exact patterns are needed
+        levels = range(self._error + 1) if self._verifier == 'regex' else range(1) # type: range
+        compiled['levels'] = tuple(
+            tuple(
+                (sample, tuple(barcode_to_regex(barcode=bc, error_rate=distance) for bc in filter(None, barcodes)))
+                for sample, barcodes in samples.items()
+            ) for distance in levels
+        )
+        #   Imported here as the prefilter and verifier need IUPAC_CODES from this module
+        if prefilter:
+            from barcseek.prefilter import Prefilter
+            compiled['prefilters'] = tuple(Prefilter(samples=samples, distance=distance) for distance in range(self._error + 1))
+        if self._verifier == 'myers' and self._error:
+            from barcseek.myers import compile_barcode
+            compiled['patterns'] = {
+                sample: tuple(compile_barcode(barcode=bc) for bc in filter(None, barcodes))
+                for sample, barcodes in samples.items()
+            }
+        return compiled
+
+    def lock(self, flips: Tuple[bool, bool]) -> None:
+        """Search barcodes in one orientation from now on
+        flips [Tuple[bool, bool]]   Whether the forward and reverse barcodes are reverse complemented
+        """
+        flips = tuple(flips) # type: Tuple[bool, bool]
+        if flips not in self._orientations:
+            raise ValueError("Orientation %s was not compiled; use orientation='auto'" % (flips,))
+        compiled = self._orientations[flips] # type: Dict[str, Any]
+        self._levels = compiled['levels'] # type: Tuple[Tuple[Tuple[str, Tuple]]]
+        self._indexes = compiled['indexes'] # type: Optional[Tuple[BarcodeIndex]]
+        self._pairs = compiled['pairs'] # type: Optional[SampleTable]
+        self._prefilters = compiled['prefilters'] # type: Optional[Tuple[Prefilter]]
+        self._patterns = compiled['patterns'] # type: Optional[Dict[str, Tuple[myers.Pattern]]]
+        self._umi_layouts = compiled['umis'] # type: Dict[str, Tuple[Tuple[Tuple[int, bool, int]]]]
+        self._plan = compiled['plan'] # type: Optional[ExtractionPlan]
+        self._flips = flips
+        #   Cached results only hold for the orientation they were found in
+        if self._cache is not None:
+            self._cache.clear()
+        for thread_cache in self._thread_caches.values(): # type: MatchCache
+            thread_cache.clear()
+
+    def task(self) -> 'Matcher':
+        """A shallow copy of this matcher for one task, with counters of its own
+        Compiled patterns are shared, counters start from zero, and the match cache
+        is one kept for the calling thread, so tasks running at once in the threads
+        of one worker neither race on counts nor corrupt the cache
+        """
+        task = copy(self) # type: Matcher
+        task.reads = 0
+        task.evaluations = 0
+        task.filtered = Counter()
+        task.distances = Counter()
+        task.umis = Counter()
+        if self._cache is not None:
+            from barcseek.cache import MatchCache
+            #   Only this thread ever uses its cache, and setdefault is atomic
+            task._cache = self._thread_caches.setdefault(threading.get_ident(), MatchCache(budget=self._cache.budget))
+        return task
+
+    def rates(self, batch: 'barcseek.batch.ReadBatch') -> Dict[Tuple[bool, bool], float]:
+        """Fraction of a batch assigned to a sample in every compiled orientation
+        Counters are left as they were and the quality stage is skipped, so a
+        sample of reads can be checked without counting towards the run
+        batch [batch.ReadBatch]     A sample of reads
+        """
+        flips, quality = self._flips, self._quality # type: Tuple[bool, bool], Optional[quality.QualityFilter]
+        reads, evaluations = self.reads, self.evaluations # type: int, int
+        distances, umis = self.distances, self.umis # type: Counter, Counter
+        rates = dict() # type: Dict[Tuple[bool, bool], float]
+        cache = self._cache # type: Optional[MatchCache]
+        self._quality, self._cache = None, None
+        self.distances, self.umis = Counter(), Counter()
+        try:
+            for orientation in self._orientations: # type: Tuple[bool, bool]
+                self.lock(flips=orientation)
+                samples = self.match_batch(batch=batch).samples # type: List[str]
+                assigned = sum(1 for sample in samples if sample not in (AMBIGUOUS, UNDETERMINED)) # type: int
+                rates[orientation] = assigned / len(batch) if len(batch) else 0.0
+        finally:
+            self._quality, self._cache = quality, cache
+            self.reads, self.evaluations = reads, evaluations
+            self.distances, self.umis = distances, umis
+            self.lock(flips=flips)
+        return rates
+
+    def detect(self, batch: 'barcseek.batch.ReadBatch') -> Tuple[bool, bool]:
+        """Lock in the orientation that assigns the most reads of a sample
+        Orientations not chosen are dropped, so they cost nothing afterwards
+        and aren't shipped to workers; ties go to the barcodes as written
+        batch [batch.ReadBatch]     A sample of reads
+        """
+        rates = self.rates(batch=batch) # type: Dict[Tuple[bool, bool], float]
+        best = max(rates, key=lambda flips: (rates[flips], -sum(flips))) # type: Tuple[bool, bool]
+        for flips, rate in rates.items(): # type: Tuple[bool, bool], float
+            logging.debug("Orientation %s assigns %s%% of the sample", self._describe(flips=flips), round(100 * rate, 1))
+        logging.info("Matching barcodes %s", self._describe(flips=best))
+        self._orientations = {best: self._orientations[best]}
+        self.lock(flips=best)
+        return best
+
+    @staticmethod
+    def _describe(flips: Tuple[bool, bool]) -> str:
+        return ', '.join(
+            '%s %s' % (slot, 'reverse complemented' if flip else 'as given')
+            for slot, flip in zip(('forward', 'reverse'), flips)
+        )
+
+    def _build_indexes(self, flipped: bool) -> Tuple[Tuple[Tuple['barcseek.index.BarcodeIndex']], 'barcseek.index.SampleTable']:
+        """Index the distinct barcodes in each slot, and map each combination of them to its sample
+        Each slot gets its index as given and, if 'flipped', reverse complemented
+        """
+        from barcseek.index import BarcodeIndex, SampleTable, distinct
+        rows = tuple(tuple(filter(None, barcodes)) for barcodes in self._barcodes.values()) # type: Tuple[Tuple[str, ...]]
+        if len(set(map(len, rows))) > 1:
+            raise ValueError("Every sample must have the same number of barcodes to use an index")
+        whitelists, positions = zip(*( # type: Tuple[List[str]], Tuple[numpy.ndarray]
+            distinct(barcodes='\n'.join(column).upper().split('\n'))
+            for column in zip(*rows)
+        ))
+        table = SampleTable(positions=positions, sizes=tuple(map(len, whitelists)), names=self._samples) # type: SampleTable
+        indexes = tuple(BarcodeIndex(barcodes=whitelist) for whitelist in whitelists) # type: Tuple[BarcodeIndex]
+        logging.debug(
+            "Indexed %s barcodes in %s bytes, and %s samples in %s bytes",
+            sum(len(index) for index in indexes),
+            sum(index.nbytes for index in indexes),
+            len(table),
+            table.nbytes
+        )
+        return tuple((index, index.reverse_complement() if flipped else None) for index in indexes), table
+
+    def _lookup(self, sequences: Tuple) -> Tuple[str, Optional[int], Tuple]:
+        """Find the sample for a read by looking its barcodes up in the index"""
+        from barcseek.index import AMBIGUOUS as AMBIGUOUS_ID, MISSING as MISSING_ID
+        found = list() # type: List[Dict[int, int]]
+        distance = 0 # type: int
+        for slot, index in enumerate(self._indexes): # type: int, BarcodeIndex
+            target = sequences[slot] # type: Optional[Tuple[str, int, int]]
+            if not target or target[1] == target[2]:
+                return UNDETERMINED, None, ()
+            text, start, end = target # type: str, int, int
+            self.evaluations += 1
+            mismatches, ids = index.scan(sequence=text[start:end], mismatches=min(self._error, 1)) # type: Optional[int], Dict[int, int]
+            if mismatches is None:
+                return UNDETERMINED, None, ()
+            distance += mismatches
+            found.append(ids)
+        hits = dict() # type: Dict[str, Tuple[Tuple[int, int], ...]]
+        for combination in itertools.product(*(ids.items() for ids in found)): # type: Tuple[Tuple[int, int], ...]
+            number = self._pairs.find(ids=tuple(id_ for id_, _ in combination)) # type: int
+            if number != MISSING_ID:
+                hits.setdefault(self._samples[number], combination)
+        if len(hits) > 1 or (not hits and any(AMBIGUOUS_ID in ids for ids in found)):
+            return AMBIGUOUS, distance, ()
+        if not hits:
+            return UNDETERMINED, None, ()
+        sample, combination = hits.popitem() # type: str, Tuple[Tuple[int, int], ...]
+        cuts = tuple( # type: Tuple[Tuple[Tuple[int, int]]]
+            ((target[1] + position, target[1] + position + index.length),)
+            for (_, position), target, index in zip(combination, sequences, self._indexes)
+        )
+        return sample, distance, cuts
+
+    def _search(self, sequences: Tuple, regexes: Tuple, windows: Optional[Tuple]=None) -> Optional[List]:
+        matches = list() # type: List
+        for index, reg in enumerate(regexes): # type: int, _regex.Pattern
+            target = sequences[index % 2] # type: Optional[Tuple[str, int, int]]
+            if not target or target[1] == target[2]:
+                return None
+            text, start, end = target # type: str, int, int
+            self.evaluations += 1
+            if windows and windows[index]:
+                match = reg.search(text, start + windows[index][0], min(start + windows[index][1], end))
+            else:
+                match = reg.search(text, start, end)
+            if match is None:
+                return None
+            matches.append(match)
+        return matches
+
+    def _locate(self, sequences: Tuple, patterns: Tuple, windows: Optional[Tuple]=None) -> Optional[List]:
+        alignments = list() # type: List
+        for index, pattern in enumerate(patterns): # type: int, myers.Pattern
+            target = sequences[index % 2] # type: Optional[Tuple[str, int, int]]
+            if not target or target[1] == target[2]:
+                return None
+            text, start, end = target # type: str, int, int
+            self.evaluations += 1
+            if windows and windows[index]:
+                pos, endpos = start + windows[index][0], min(start + windows[index][1], end) # type: int, int
+            else:
+                pos, endpos = start, end
+            alignment = pattern.locate(sequence=text, max_distance=self._error, pos=pos, endpos=endpos) # type: Optional[myers.Alignment]
+            if alignment is None:
+                return None
+            alignments.append(alignment)
+        return alignments
+
+    def _candidates(self, sequences: Tuple, index: int) -> Optional[Dict[str, Tuple]]:
+        if self._prefilters:
+            return self._prefilters[index].candidates(sequences=tuple(
+                target[0][target[1]:target[2]] if target else None for target in sequences
+            ))
+        return None
+
+    def _align(self, sequences: Tuple) -> Tuple[str, Optional[int], Tuple]:
+        """Find the best sample for a read with bit-vector alignments"""
+        best = None # type: Optional[Tuple[str, List]]
+        best_distance = None # type: Optional[int]
+        tied = False # type: bool
+        candidates = self._candidates(sequences=sequences, index=self._error) # type: Optional[Dict[str, Tuple]]
+        for sample in self._samples: # type: str
+            if candidates is None:
+                windows = None # type: Optional[Tuple]
+            elif sample in candidates:
+                windows = candidates[sample] # type: Optional[Tuple]
+            else:
+                continue
+            alignments = self._locate(sequences=sequences, patterns=self._patterns[sample], windows=windows) # type: Optional[List]
+            if alignments is None:
+                continue
+            distance = sum(alignment.distance for alignment in alignments) # type: int
+            if best_distance is None or distance < best_distance:
+                best, best_distance, tied = (sample, alignments), distance, False
+            elif distance == best_distance:
+                tied = True
+        if best is None:
+            return UNDETERMINED, None, ()
+        if tied:
+            return AMBIGUOUS, best_distance, ()
+        sample, alignments = best
+        return sample, best_distance, _alignment_cuts(patterns=self._patterns[sample], alignments=alignments)
+
+    def _assign(self, sequences: Tuple) -> Tuple[str, Optional[int], Tuple]:
+        """Find the best sample for a read's sequences
+        Returns the sample, the edit distance, and the spans to cut from each sequence
+        sequences [Tuple]   A (text, start, end) span for the forward and, if paired, reverse sequence
+        """
+        if self._plan:
+            self.evaluations += 1
+            return self._plan.assign(sequences=sequences)
+        if self._indexes:
+            return self._lookup(sequences=sequences)
+        #   The best hit for each sample so far: its total distance, patterns, and matches
+        scores = dict() # type: Dict[str, Tuple[int, Tuple, List]]
+        for index, level in enumerate(self._levels): # type: int, Tuple[Tuple[str, Tuple]]
+            #   Samples first found at this level have a barcode with at least this many edits
+            if scores and index > min(score[0] for score in scores.values()):
+                break
+            candidates = self._candidates(sequences=sequences, index=index) # type: Optional[Dict[str, Tuple]]
+            if candidates is not None and not candidates:
+                continue
+            for sample, regexes in level: # type: str, Tuple
+                if candidates is None:
+                    windows = None # type: Optional[Tuple]
+                elif sample in candidates:
+                    windows = candidates[sample] # type: Optional[Tuple]
+                else:
+                    continue
+                matches = self._search(sequences=sequences, regexes=regexes, windows=windows) # type: Optional[List]
+                if matches is None:
+                    continue
+                distance = sum(sum(m.fuzzy_counts) for m in matches) # type: int
+                if sample not in scores or distance < scores[sample][0]:
+                    scores[sample] = (distance, regexes, matches)
+        if scores:
+            best_distance = min(score[0] for score in scores.values()) # type: int
+            best = [sample for sample, score in scores.items() if score[0] == best_distance] # type: List[str]
+            if len(best) > 1:
+                return AMBIGUOUS, best_distance, ()
+            _, regexes, matches = scores[best[0]]
+            return best[0], best_distance, _regex_cuts(regexes=regexes, matches=matches)
+        if self._patterns:
+            return self._align(sequences=sequences)
+        return UNDETERMINED, None, ()
+
+    def _match(self, sequences: Tuple) -> Tuple[str, Optional[int], Tuple]:
+        """Find the best sample for a read's sequences within the search window, using the cache if there is one"""
+        if self._window:
+            sequences = tuple(
+                (target[0], target[1], min(target[2], target[1] + self._window)) if target else None
+                for target in sequences
+            )
+        if self._cache is None:
+            return self._assign(sequences=sequences)
+        key = tuple(target[0][target[1]:target[2]] if target else '' for target in sequences) # type: Tuple[str, ...]
+        starts = tuple(target[1] if target else 0 for target in sequences) # type: Tuple[int, ...]
+        cached = self._cache.get(key=key) # type: Optional[Tuple[str, Optional[int], Tuple]]
+        if cached is not None:
+            sample, distance, spans = cached # type: str, Optional[int], Tuple
+            #   Results are stored relative to each searched sequence
+            return sample, distance, tuple(
+                tuple((start + starts[index % 2], end + starts[index % 2]) for start, end in cuts)
+                for index, cuts in enumerate(spans)
+            )
+        sample, distance, spans = self._assign(sequences=sequences) # type: str, Optional[int], Tuple
+        self._cache.put(key=key, value=(sample, distance, tuple(
+            tuple((start - starts[index % 2], end - starts[index % 2]) for start, end in cuts)
+            for index, cuts in enumerate(spans)
+        )))
+        return sample, distance, spans
+
+    def match(self, read: fastq.Read) -> Assignment:
+        """Find the best sample for a read
+        read [fastq.Read]   A read object to assign to a sample
+        """
+        if self._quality:
+            #   Quality filtering works on batches, so run a batch of one
+            from barcseek.batch import ReadBatch
+            reads = ReadBatch.from_reads(reads=(read,)) # type: ReadBatch
+            assignments = self.match_batch(batch=reads) # type: Assignments
+            sample, distance, cuts = assignments.samples[0], assignments.distances[0], assignments.cuts[0] # type: str, Optional[int], Tuple
+            read = reads.read(index=0)
+            #   Cuts are offsets into the batch's buffers; make them relative to each sequence
+            starts = tuple(records.spans[0][0] for records in filter(None, (reads.forward, reads.reverse))) # type: Tuple[int]
+            cuts = tuple(tuple((start - base, end - base) for start, end in spans) for spans, base in zip(cuts, starts))
+        else:
+            self.reads += 1
+            sequences = ( # type: Tuple[Tuple[str, int, int], Optional[Tuple[str, int, int]]]
+                (read.forward, 0, len(read.forward)),
+                (read.reverse, 0, len(read.reverse)) if read.paired else None
+            )
+            sample, distance, cuts = self._match(sequences=sequences) # type: str, Optional[int], Tuple
+        if cuts:
+            read = _cut_read(read=read, cuts=cuts)
+        return Assignment(sample=sample, read=read, distance=distance)
+
+    def match_batch(self, batch: 'barcseek.batch.ReadBatch') -> Assignments:
+        """Find the best sample for every read in a batch
+        Cuts are spans of the batch's buffers rather than trimmed copies of reads;
+        with a quality filter, reads are trimmed in place first
+        batch [batch.ReadBatch]     The reads to assign
+        """
+        if self._quality:
+            passed, counts = self._quality.apply(reads=batch) # type: numpy.ndarray, Counter
+            self.filtered.update(counts)
+            passed = passed.tolist() # type: List[bool]
+        else:
+            passed = None # type: Optional[List[bool]]
+        forward_text = batch.forward.text # type: str
+        forward_starts, forward_ends = batch.forward.spans # type: List[int], List[int]
+        if batch.paired:
+            reverse_text = batch.reverse.text # type: Optional[str]
+            reverse_starts, reverse_ends = batch.reverse.spans # type: List[int], List[int]
+        else:
+            reverse_text = None
+        samples = list() # type: List[str]
+        distances = list() # type: List[Optional[int]]
+        cuts = list() # type: List[Tuple]
+        umis = list() # type: List[Optional[str]]
+        for index in range(len(batch)): # type: int
+            #   Reads that fail the quality stage skip matching entirely
+            if passed is not None and not passed[index]:
+                samples.append(UNDETERMINED)
+                distances.append(None)
+                cuts.append(())
+                umis.append(None)
+                continue
+            sequences = ( # type: Tuple[Tuple[str, int, int], Optional[Tuple[str, int, int]]]
+                (forward_text, forward_starts[index], forward_ends[index]),
+                (reverse_text, reverse_starts[index], reverse_ends[index]) if reverse_text is not None else None
+            )
+            sample, distance, spans = self._match(sequences=sequences) # type: str, Optional[int], Tuple
+            samples.append(sample)
+            distances.append(distance)
+            cuts.append(spans)
+            umi = None # type: Optional[str]
+            if spans:
+                self.distances[(sample, distance)] += 1
+                if sample in self._umi_layouts:
+                    umi = _extract_umi(texts=(forward_text, reverse_text), layouts=self._umi_layouts[sample], cuts=spans)
+                elif self._plan and self._plan.molecular:
+                    umi = self._plan.umi(texts=(forward_text, reverse_text), cuts=spans)
+                if umi is not None:
+                    self.umis[(sample, umi)] += 1
+            umis.append(umi)
+        self.reads += len(batch)
+        return Assignments(samples=samples, distances=distances, cuts=cuts, umis=umis)
+
+    def _sample_names(self) -> Tuple[str]:
+        return self._samples
+
+    def _categories(self) -> Tuple[str]:
+        return self._samples + (AMBIGUOUS, UNDETERMINED)
+
+    def _settings(self) -> Dict[str, Any]:
+        return {
+            'samples': self._barcodes,
+            'error_rate': self._error,
+            'verifier': self._verifier,
+            'quality': self._quality.settings if self._quality else None,
+            'index': bool(self._indexes),
+            'orientation': list(self._flips),
+            'window': self._window,
+            'structures': list(self._structures) if self._structures else None
+        }
+
+    def _evaluations_per_read(self) -> float:
+        return self.evaluations / self.reads if self.reads else 0.0
+
+    def _orientation(self) -> Tuple[bool, bool]:
+        return self._flips
+
+    def _cache_counts(self) -> Counter:
+        return self._cache.counts() if self._cache is not None else Counter()
+
+    samples = property(fget=_sample_names, doc='Sample names')
+    categories = property(fget=_categories, doc='Sample names plus the ambiguous and undetermined categories')
+    settings = property(fget=_settings, doc='Everything that changes how reads are assigned')
+    evaluations_per_read = property(fget=_evaluations_per_read, doc='Average number of pattern evaluations per read')
+    orientation = property(fget=_orientation, doc='Whether the forward and reverse barcodes are searched reverse complemented')
+    cache_counts = property(fget=_cache_counts, doc='Hits, misses, and evictions of the match cache, empty without one')
+
+
+def output_names(
+        categories: Iterable[str],
+        directory: str,
+        basename: str,
+        paired: bool=False,
+        joined: bool=False
+) -> Dict[str, Tuple[str, Optional[str]]]:
+    """Create forward and reverse output names for each category
+    categories [Iterable[str]]  Sample names and other categories to name outputs for
+    directory [str]             Directory to place outputs in
+    basename [str]              Name of the input file, used as a suffix
+    paired [bool]=False         Create reverse output names too?
+    joined [bool]=False         Write both reads of a pair to one output instead
+    """
+    outputs = dict() # type: Dict[str, Tuple[str, Optional[str]]]
+    for category in categories: # type: str
+        if joined:
+            outputs[category] = (os.path.join(directory, category + '_' + basename), None)
+            continue
+        output_name = os.path.join(directory, category + '_fwd_' + basename) # type: str
+        if paired:
+            reverse_name = os.path.join(directory, category + '_rev_' + basename) # type: Optional[str]
+        else:
+            reverse_name = None
+        outputs[category] = (output_name, reverse_name)
+    return outputs
+
+
+def partition_reads(
+        matcher: Matcher,
+        reads: Iterable[fastq.Read],
+        outputs: Dict[str, Tuple[str, Optional[str]]]
+) -> Counter:
+    """Write reads to the output files for their samples
+    matcher [Matcher]                               The matcher used to assign reads
+    reads [Iterable[fastq.Read]]                    The reads to assign
+    outputs [Dict[str, Tuple[str, Optional[str]]]]: A dictionary where the key is a category from
+                                                    'matcher.categories' and the value is a tuple
+                                                    of forward and optional reverse output names
+    """
+    counts = Counter() # type: Counter
+    handles = dict() # type: Dict[str, Tuple[_io.TextIOWrapper, Optional[_io.TextIOWrapper]]]
+    try:
+        for category, (output_name, reverse_name) in outputs.items(): # type: str, (str, Optional[str])
+            handles[category] = (open(output_name, 'w'), open(reverse_name, 'w') if reverse_name else None)
+        #   Assign each read to at most one sample
+        for read in reads: # type: fastq.Read
+            assignment = matcher.match(read=read) # type: Assignment
+            counts[assignment.sample] += 1
+            ofile, rfile = handles[assignment.sample] # type: _io.TextIOWrapper, Optional[_io.TextIOWrapper]
+            ofile.write(assignment.read.fastq)
+            ofile.write('\n')
+            if rfile and assignment.read.paired:
+                rfile.write(assignment.read.reverse_fastq)
+                rfile.write('\n')
+    finally:
+        for ofile, rfile in handles.values(): # type: _io.TextIOWrapper, Optional[_io.TextIOWrapper]
+            ofile.close()
+            if rfile:
+                rfile.close()
+    return counts
+
+
+def render_batch(
+        matcher: Matcher,
+        batch: 'barcseek.batch.ReadBatch',
+        bare_plus: bool=False,
+        output_format: str=OUTPUT_FORMATS[0],
+        assignments: Optional[Assignments]=None
+) -> Tuple[Counter, Dict[str, Tuple[bytes, Optional[bytes]]]]:
+    """Assign a batch of reads and render them, one buffer per category
+    Reads are rendered straight from the batch's bytes; returns the number of reads
+    in each category along with forward and, if paired, reverse buffers for each category.
+    Interleaved and BAM outputs hold both reads of a pair in the forward buffer
+    matcher [Matcher]           The matcher used to assign reads
+    batch [batch.ReadBatch]     The reads to assign
+    bare_plus [bool]=False      Write a bare '+' line rather than repeating the read ID
+    output_format [str]='fastq' Render reads as 'fastq', 'interleaved' FASTQ, or 'bam'; BAM
+                                buffers are BGZF-compressed records without a header
+    assignments [Assignments]   The batch's assignments if already matched; if None, match it here
+    """
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError("'output_format' must be one of %s" % ', '.join(OUTPUT_FORMATS))
+    if assignments is None:
+        assignments = matcher.match_batch(batch=batch) # type: Assignments
+    buffers = collections.defaultdict(bytearray) # type: Dict[str, bytearray]
+    reverse_buffers = collections.defaultdict(bytearray) # type: Dict[str, bytearray]
+    forward, reverse = batch.forward, batch.reverse # type: batch.Records, Optional[batch.Records]
+    joined = output_format != OUTPUT_FORMATS[0] # type: bool
+    if reverse is not None:
+        reverse_starts, reverse_ends = reverse.spans # type: List[int], List[int]
+    for index, (sample, cuts) in enumerate(zip(assignments.samples, assignments.cuts)): # type: int, (str, Tuple)
+        forward.render(buffer=buffers[sample], index=index, cuts=cuts[0] if cuts else (), bare_plus=bare_plus)
+        if reverse is None:
+            continue
+        #   Joined outputs keep every pair together; otherwise reads with an empty reverse sequence are treated as unpaired
+        if joined:
+            reverse.render(buffer=buffers[sample], index=index, cuts=cuts[1] if len(cuts) > 1 else (), bare_plus=bare_plus)
+        elif reverse_starts[index] != reverse_ends[index]:
+            reverse.render(buffer=reverse_buffers[sample], index=index, cuts=cuts[1] if len(cuts) > 1 else (), bare_plus=bare_plus)
+    rendered = dict() # type: Dict[str, Tuple[bytes, Optional[bytes]]]
+    for category in matcher.categories: # type: str
+        data = bytes(buffers.get(category, b'')) # type: bytes
+        if output_format == 'bam':
+            from barcseek import bam
+            data = bam.compress(data=bam.encode(data=data, paired=reverse is not None))
+        if reverse is None or joined:
+            rendered[category] = (data, None)
+        else:
+            rendered[category] = (data, bytes(reverse_buffers.get(category, b'')))
+    return Counter(assignments.samples), rendered
+
+
+def partition_batch(
+        matcher: Matcher,
+        batch: 'barcseek.batch.ReadBatch',
+        outputs: Dict[str, Tuple[str, Optional[str]]],
+        bare_plus: bool=False,
+        output_format: str=OUTPUT_FORMATS[0],
+        assignments: Optional[Assignments]=None
+) -> Counter:
+    """Write a batch of reads to the output files for their samples
+    Each output is written once rather than once per read
+    matcher [Matcher]                               The matcher used to assign reads
+    batch [batch.ReadBatch]                         The reads to assign
+    outputs [Dict[str, Tuple[str, Optional[str]]]]: A dictionary where the key is a category from
+                                                    'matcher.categories' and the value is a tuple
+                                                    of forward and optional reverse output names
+    bare_plus [bool]=False                          Write a bare '+' line rather than repeating the read ID
+    output_format [str]='fastq'                     Write 'fastq', 'interleaved' FASTQ, or 'bam' records
+    assignments [Assignments]=None                  The batch's assignments if already matched
+    """
+    counts, rendered = render_batch(matcher=matcher, batch=batch, bare_plus=bare_plus, output_format=output_format, assignments=assignments) # type: Counter, Dict[str, Tuple[bytes, Optional[bytes]]]
+    for category, (output_name, reverse_name) in outputs.items(): # type: str, (str, Optional[str])
+        data, reverse_data = rendered[category] # type: bytes, Optional[bytes]
+        with open(output_name, 'wb') as ofile:
+            ofile.write(data)
+        if reverse_name:
+            with open(reverse_name, 'wb') as rfile:
+                rfile.write(reverse_data or b'')
+    return counts
+
+
 def partition(
         barcodes: Dict[str, List[str]],
         filename: str,
@@ -126,36 +938,10 @@ def partition(
         reads = utilities.load_fastq(fastq_file=filename, pair=reverse) # type: Tuple[utilities.Read]
     except FileNotFoundError as error:
         sys.exit("Cannot find " + error.filename)
+    matcher = Matcher(samples=barcodes, error_rate=error_rate) # type: Matcher
     output_directory = os.path.dirname(filename) # type: str
-    output_list = list() # type: List[Tuple[str, Optional[str]]]
-    basename = os.path.basename(filename)
-    for sample_name, barcode_list in barcodes.items(): # type: str, List[str]
-        #   Create output names for forward and reverse files
-        # output_name = output_directory + '/' + sample_name + '_fwd.fastq' # type: str
-        output_name = output_directory + '/' + sample_name + '_fwd_' + basename # type: str
-        if reverse:
-            reverse_name = output_name.replace('fwd', 'rev') # type: str
-            rfile = open(reverse_name, 'w') # type: _io.TextIOWrapper
-        else:
-            reverse_name = None
-        output_list.append((output_name, reverse_name))
-        #   Zip the arguments together for the map
-        args = zip( # type: sip
-            reads,
-            itertools.repeat(barcode_list),
-            itertools.repeat(error_rate)
-        )
-        #   Run the partitioning for each read for this barcode
-        results = map(lambda tup: match_barcode(*tup), args) # type: map
-        with open(output_name, 'w') as ofile: # type: _io.TextIOWrapper
-            for read in filter(None, results): # type: fastq.Read
-                ofile.write(read.fastq)
-                ofile.write('\n')
-                ofile.flush()
-                if reverse:
-                    rfile.write(read.reverse_fastq)
-                    rfile.write('\n')
-                    rfile.flush()
-        if reverse:
-            rfile.close()
-    return output_list
+    basename = os.path.basename(filename) # type: str
+    outputs = output_names(categories=matcher.categories, directory=output_directory, basename=basename, paired=bool(reverse)) # type: Dict[str, Tuple[str, Optional[str]]]
+    partition_reads(matcher=matcher, reads=reads, outputs=outputs)
+    logging.debug("Evaluated %s patterns per read", round(matcher.evaluations_per_read, 3))
+    return list(outputs.values())
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+
+"""Multi-pattern seed prefilter for finding candidate samples"""
+
+import sys
+if not (sys.version_info.major == 3 and sys.version_info.minor >= 5):
+    sys.exit("Please use Python 3.5 or higher for this module: " + __name__)
+
+
+#   Load standard modules
+import itertools
+import collections
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+#   Load custom modules
+from barcseek.partition import IUPAC_CODES
+
+_MAX_EXPANSIONS = 64 # type: int
+
+#   Where a seed came from: which sample, which barcode (0 forward, 1 reverse), and which segment of that barcode
+Source = collections.namedtuple('Source', ('sample', 'slot', 'segment'))
+
+
+def split_pieces(segment: str, pieces: int) -> Tuple[Tuple[int, str]]:
+    """Split a segment into 'pieces' nearly equal, non-overlapping pieces
+    With at most 'pieces - 1' edits, at least one piece must occur exactly
+    Returns the offset of each piece in the segment along with the piece
+    segment [str]   The barcode segment to split
+    pieces [int]    How many pieces to split into
+    """
+    if pieces < 1 or len(segment) < pieces:
+        return tuple()
+    size, extra = divmod(len(segment), pieces) # type: int, int
+    result = list() # type: List[Tuple[int, str]]
+    start = 0 # type: int
+    for index in range(pieces): # type: int
+        end = start + size + (1 if index < extra else 0) # type: int
+        result.append((start, segment[start:end]))
+        start = end
+    return tuple(result)
+
+
+def expand_piece(piece: str) -> Tuple[str]:
+    """Expand IUPAC codes in a piece into every concrete sequence, empty if there are too many"""
+    options = tuple(IUPAC_CODES.get(base, base) for base in piece) # type: Tuple[str]
+    count = 1 # type: int
+    for option in options: # type: str
+        count *= len(option)
+    if count > _MAX_EXPANSIONS:
+        return tuple()
+    return tuple(''.join(bases) for bases in itertools.product(*options))
+
+
+class AhoCorasick(object):
+
+    """An Aho-Corasick automaton for finding many seeds in one pass over a sequence"""
+
+    def __init__(self) -> None:
+        self._goto = [dict()] # type: List[Dict[str, int]]
+        self._fail = [0] # type: List[int]
+        self._output = [list()] # type: List[List[Tuple[int, object]]]
+        self._built = False # type: bool
+
+    def add(self, word: str, value: object) -> None:
+        """Add a word, reporting 'value' wherever it's found"""
+        if self._built:
+            raise ValueError("Cannot add words after the automaton has been built")
+        node = 0 # type: int
+        for char in word: # type: str
+            following = self._goto[node].get(char) # type: Optional[int]
+            if following is None:
+                following = len(self._goto)
+                self._goto.append(dict())
+                self._fail.append(0)
+                self._output.append(list())
+                self._goto[node][char] = following
+            node = following
+        self._output[node].append((len(word), value))
+
+    def build(self) -> None:
+        """Compute failure links, must be called before searching"""
+        queue = collections.deque(self._goto[0].values()) # type: collections.deque
+        while queue:
+            node = queue.popleft() # type: int
+            for char, following in self._goto[node].items(): # type: str, int
+                queue.append(following)
+                fail = self._fail[node] # type: int
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[following] = self._goto[fail].get(char, 0)
+                self._output[following].extend(self._output[self._fail[following]])
+        self._built = True
+
+    def search(self, sequence: str) -> Iterable[Tuple[int, int, object]]:
+        """Find every word in a sequence, yielding (start, end, value)"""
+        if not self._built:
+            self.build()
+        goto, fail, output = self._goto, self._fail, self._output # type: List[Dict[str, int]], List[int], List[List[Tuple[int, object]]]
+        node = 0 # type: int
+        for position, char in enumerate(sequence): # type: int, str
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            for length, value in output[node]: # type: int, object
+                yield position + 1 - length, position + 1, value
+
+
+class Prefilter(object):
+
+    """Find candidate samples for a read with pigeonhole seeds
+    Every non-UMI segment of every barcode is split into 'distance + 1' pieces, so
+    any occurrence with at most 'distance' edits contains one piece exactly. One
+    Aho-Corasick scan per sequence finds every piece; a sample is a candidate only
+    if every segment of each of its barcodes has a seed. Candidates come back with
+    a window around their seeds that is wide enough to hold any match
+    """
+
+    def __init__(self, samples: Dict[str, Tuple[str, Optional[str]]], distance: int) -> None:
+        """
+    samples [Dict[str, Tuple[str, Optional[str]]]]: A dictionary where the key is the sample ID and
+                                                    the value is a tuple of one or two barcode sequences
+    distance [int]                                  The number of edits allowed per segment
+    """
+        self._automata = (AhoCorasick(), AhoCorasick()) # type: Tuple[AhoCorasick, AhoCorasick]
+        self._required = dict() # type: Dict[str, Tuple[Set[Tuple[int, int]], ...]]
+        self._slack = dict() # type: Dict[Tuple[str, int], int]
+        self._unfiltered = list() # type: List[str]
+        for sample, barcodes in samples.items(): # type: str, Tuple[str, Optional[str]]
+            seeds = list() # type: List[Tuple[str, Source]]
+            required = list() # type: List[Set[Tuple[int, int]]]
+            for slot, barcode in enumerate(filter(None, barcodes)): # type: int, str
+                barcode = barcode.upper()
+                segments = tuple(filter(None, barcode.split('N'))) # type: Tuple[str]
+                #   A match can start this far before, or end this far after, any of its seeds
+                self._slack[(sample, slot)] = len(barcode) + distance * (2 * barcode.count('N') + len(segments)) + 1
+                for index, segment in enumerate(segments): # type: int, str
+                    pieces = split_pieces(segment=segment, pieces=distance + 1) # type: Tuple[Tuple[int, str]]
+                    expansions = tuple(expand_piece(piece=piece) for _, piece in pieces) # type: Tuple[Tuple[str]]
+                    #   Segments too short to split, or too degenerate to expand, can't be seeded
+                    if not pieces or not all(expansions):
+                        seeds = None
+                        break
+                    source = Source(sample=sample, slot=slot, segment=index) # type: Source
+                    seeds.extend((word, source) for word in itertools.chain.from_iterable(expansions))
+                if seeds is None:
+                    break
+                required.append(set((slot, index) for index in range(len(segments))))
+            if seeds is None:
+                self._unfiltered.append(sample)
+                continue
+            for word, source in seeds: # type: str, Source
+                self._automata[source.slot].add(word=word, value=source)
+            self._required[sample] = tuple(required)
+        for automaton in self._automata: # type: AhoCorasick
+            automaton.build()
+
+    def candidates(self, sequences: Tuple[Optional[str], Optional[str]]) -> Dict[str, Tuple[Optional[Tuple[int, int]], ...]]:
+        """Find candidate samples for a read
+        Returns a dictionary of sample names to a (start, end) search window for each
+        barcode; samples that can't be seeded are always candidates with no window
+        sequences [Tuple[Optional[str], Optional[str]]]     The forward and reverse sequences of a read
+        """
+        found = collections.defaultdict(set) # type: Dict[str, Set[Tuple[int, int]]]
+        spans = dict() # type: Dict[Tuple[str, int], List[int]]
+        for slot, sequence in enumerate(sequences): # type: int, Optional[str]
+            if not sequence:
+                continue
+            for start, end, source in self._automata[slot].search(sequence=sequence): # type: int, int, Source
+                found[source.sample].add((source.slot, source.segment))
+                span = spans.setdefault((source.sample, source.slot), [start, end]) # type: List[int]
+                span[0] = min(span[0], start)
+                span[1] = max(span[1], end)
+        candidates = dict() # type: Dict[str, Tuple[Optional[Tuple[int, int]], ...]]
+        for sample, hits in found.items(): # type: str, Set[Tuple[int, int]]
+            required = self._required[sample] # type: Tuple[Set[Tuple[int, int]], ...]
+            if all(keys <= hits for keys in required):
+                windows = list() # type: List[Tuple[int, int]]
+                for slot in range(len(required)): # type: int
+                    start, end = spans[(sample, slot)] # type: int, int
+                    slack = self._slack[(sample, slot)] # type: int
+                    windows.append((max(start - slack, 0), end + slack))
+                candidates[sample] = tuple(windows)
+        for sample in self._unfiltered: # type: str
+            candidates[sample] = (None, None)
+        return candidates
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+
+"""Report progress and throughput while a run is going"""
+
+import sys
+if not (sys.version_info.major == 3 and sys.version_info.minor >= 5):
+    sys.exit("Please use Python 3.5 or higher for this module: " + __name__)
+
+
+#   Load standard modules
+import json
+import time
+import logging
+import threading
+from collections import Counter
+from typing import Any, Dict, Optional
+
+#   Load custom modules
+import barcseek.chunks as chunks
+import barcseek.partition as partition
+
+INTERVAL = 30.0 # type: float
+
+
+def chunk_bytes(chunk: chunks.Chunk, virtual: bool=False, reverse_virtual: bool=False) -> int:
+    """How many bytes of input a chunk covers
+    chunk [chunks.Chunk]            The chunk to measure
+    virtual [bool]=False            Are the chunk's forward offsets BGZF virtual offsets? If so, count compressed bytes
+    reverse_virtual [bool]=False    Are the chunk's reverse offsets BGZF virtual offsets?
+    """
+    shift = 16 if virtual else 0 # type: int
+    size = (chunk.forward[1] >> shift) - (chunk.forward[0] >> shift) # type: int
+    if chunk.reverse:
+        shift = 16 if reverse_virtual else 0
+        size += (chunk.reverse[1] >> shift) - (chunk.reverse[0] >> shift)
+    return size
+
+
+class Progress(object):
+
+    """Track finished chunks and report throughput at a fixed interval
+    Workers already count reads per category for every chunk; those counts are
+    added up here as results come back, so nothing is added to the per-read
+    work. A background thread reports every 'interval' seconds whether or not a
+    chunk has finished since, so a slow run keeps reporting and a hung run
+    shows no movement
+    """
+
+    def __init__(self, total_bytes: int, interval: float=INTERVAL, status_file: Optional[str]=None) -> None:
+        """
+    total_bytes [int]           Bytes of input left to demultiplex
+    interval [float]=30.0       Seconds between reports; if 0, only report at the end
+    status_file [str]=None      Also append each report as one JSON line to this file
+    """
+        self._total = total_bytes # type: int
+        self._interval = interval # type: float
+        self._status_file = status_file # type: Optional[str]
+        self._lock = threading.Lock() # type: threading.Lock
+        self._done = 0 # type: int
+        self._chunks = 0 # type: int
+        self._counts = Counter() # type: Counter
+        self._cache = Counter() # type: Counter
+        self._start = time.time() # type: float
+        self._stop = threading.Event() # type: threading.Event
+        self._thread = None # type: Optional[threading.Thread]
+        if self._status_file:
+            #   Start a fresh status file for every run
+            open(self._status_file, 'w').close()
+
+    def __enter__(self) -> 'Progress':
+        self.start()
+        return self
+
+    def __exit__(self, error_type: Any, *args) -> None:
+        self.stop(finished=error_type is None)
+
+    def _run(self) -> None:
+        while not self._stop.wait(self._interval):
+            self.report()
+
+    def start(self) -> None:
+        """Start reporting in the background"""
+        self._start = time.time()
+        if self._interval > 0:
+            self._thread = threading.Thread(target=self._run, name='progress', daemon=True)
+            self._thread.start()
+
+    def stop(self, finished: bool=True) -> None:
+        """Stop reporting in the background and make a final report"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.report(finished=finished)
+
+    def update(self, size: int, counts: Dict[str, int], cache: Optional[Dict[str, int]]=None) -> None:
+        """Add a finished chunk
+        size [int]                      Bytes of input the chunk covered
+        counts [Dict[str, int]]         Reads the chunk wrote to each category
+        cache [Dict[str, int]]=None     Match cache hits and misses for the chunk
+        """
+        with self._lock:
+            self._done += size
+            self._chunks += 1
+            self._counts.update(counts)
+            self._cache.update(cache or {})
+
+    def skip(self, size: int) -> None:
+        """Take input done by an earlier run out of the total, for inputs only sized as they're read"""
+        with self._lock:
+            self._total -= size
+
+    def status(self) -> Dict[str, Any]:
+        """Progress so far"""
+        with self._lock:
+            done, chunks_done, counts, cache = self._done, self._chunks, self._counts.copy(), self._cache.copy() # type: int, int, Counter, Counter
+        elapsed = time.time() - self._start # type: float
+        reads = sum(counts.values()) # type: int
+        assigned = reads - counts[partition.AMBIGUOUS] - counts[partition.UNDETERMINED] # type: int
+        rate = done / elapsed if elapsed > 0 else 0.0 # type: float
+        return {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'elapsed': round(elapsed, 3),
+            'chunks': chunks_done,
+            'bytes': done,
+            'total_bytes': self._total,
+            'fraction': round(done / self._total, 4) if self._total else 1.0,
+            'reads': reads,
+            'reads_per_second': round(reads / elapsed, 1) if elapsed > 0 else 0.0,
+            'eta': round((self._total - done) / rate, 1) if rate > 0 else None,
+            'match_rate': round(assigned / reads, 4) if reads else None,
+            'cache_hit_rate': round(cache['hits'] / (cache['hits'] + cache['misses']), 4) if cache['hits'] + cache['misses'] else None
+        }
+
+    def report(self, finished: bool=False) -> Dict[str, Any]:
+        """Log progress so far and append it to the status file"""
+        status = self.status() # type: Dict[str, Any]
+        status['finished'] = finished
+        logging.info(
+            "Progress: %s%% of input (%s of %s bytes), %s reads at %s reads/s, %s matched, ETA %s",
+            round(100 * status['fraction'], 1),
+            status['bytes'],
+            status['total_bytes'],
+            status['reads'],
+            status['reads_per_second'],
+            '%s%%' % round(100 * status['match_rate'], 1) if status['match_rate'] is not None else 'none',
+            '%ss' % status['eta'] if status['eta'] is not None else 'unknown'
+        )
+        if self._status_file:
+            with open(self._status_file, 'a') as sfile:
+                sfile.write(json.dumps(status) + '\n')
+        return status
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+
+"""Quality filtering and trimming for batches of reads"""
+
+import sys
+if not (sys.version_info.major == 3 and sys.version_info.minor >= 5):
+    sys.exit("Please use Python 3.5 or higher for this module: " + __name__)
+
+
+#   Load standard modules
+from collections import Counter
+from typing import Any, Dict, Optional, Tuple
+
+#   Load custom modules
+import barcseek.batch as batch
+
+#   Load installed modules
+try:
+    import numpy
+except ImportError as error:
+    sys.exit("Please install " + error.name)
+
+
+PHRED_OFFSETS = (33, 64) # type: Tuple[int]
+
+#   Reasons a read can fail the quality stage, in the order they're checked
+TOO_SHORT = 'too_short' # type: str
+LOW_MEAN = 'low_mean_quality' # type: str
+LOW_BASE = 'low_base_quality' # type: str
+#   Counts for reads that pass through
+TAIL_TRIMMED = 'tail_trimmed' # type: str
+PASSED = 'passed' # type: str
+
+
+def _segments(size: int, starts: numpy.ndarray, ends: numpy.ndarray) -> numpy.ndarray:
+    """Mark every position of a buffer that falls within one of several non-overlapping spans"""
+    marks = numpy.zeros(size + 1, dtype=numpy.int32) # type: numpy.ndarray
+    numpy.add.at(marks, starts, 1)
+    numpy.add.at(marks, ends, -1)
+    return numpy.cumsum(marks[:-1]) > 0
+
+
+def _reduce(function: numpy.ufunc, values: numpy.ndarray, lengths: numpy.ndarray, empty: int) -> numpy.ndarray:
+    """Reduce consecutive runs of 'values' with 'function', giving 'empty' for empty runs"""
+    result = numpy.full(len(lengths), empty, dtype=numpy.int64) # type: numpy.ndarray
+    if not len(values):
+        return result
+    offsets = numpy.concatenate(([0], numpy.cumsum(lengths)[:-1])) # type: numpy.ndarray
+    filled = lengths > 0 # type: numpy.ndarray
+    result[filled] = function.reduceat(values, offsets[filled])
+    return result
+
+
+class QualityFilter(object):
+
+    """Trim low-quality tails and turn away low-quality reads before matching
+    Every step works on whole batches at once: quality scores are read straight
+    from a batch's bytes as arrays, tails are trimmed by moving the end offsets of
+    each read, and per-read statistics come from segmented reductions rather than
+    a loop over reads. Reads that fail are sent to undetermined without any
+    barcode matching
+    """
+
+    def __init__(
+            self,
+            window: Optional[int]=None,
+            min_mean: Optional[float]=None,
+            min_base: Optional[int]=None,
+            tail_quality: Optional[int]=None,
+            min_length: int=1,
+            offset: int=PHRED_OFFSETS[0]
+    ) -> None:
+        """
+    window [int]=None           Only check the first 'window' bases of each read, where barcodes are;
+                                if None, check the whole read
+    min_mean [float]=None       Lowest mean quality allowed in the window
+    min_base [int]=None         Lowest quality allowed for any base in the window
+    tail_quality [int]=None     Trim bases below this quality from the end of every read
+    min_length [int]=1          Shortest read allowed after trimming
+    offset [int]=33             Phred offset of the quality scores
+    """
+        if offset not in PHRED_OFFSETS:
+            raise ValueError("'offset' must be one of %s" % ', '.join(map(str, PHRED_OFFSETS)))
+        self._window = window # type: Optional[int]
+        self._min_mean = min_mean # type: Optional[float]
+        self._min_base = min_base # type: Optional[int]
+        self._tail = tail_quality # type: Optional[int]
+        self._min_length = min_length # type: int
+        self._offset = offset # type: int
+
+    def _trim_tails(self, records: batch.Records) -> numpy.ndarray:
+        """Move the end of every read back to its last base at or above the tail quality"""
+        raw = numpy.frombuffer(records.data, dtype=numpy.uint8) # type: numpy.ndarray
+        starts, ends = records.qualities # type: numpy.ndarray, numpy.ndarray
+        good = numpy.flatnonzero( # type: numpy.ndarray
+            _segments(size=len(raw), starts=starts, ends=ends) & (raw >= self._tail + self._offset)
+        )
+        #   The last good base before the end of each read, if it's within the read
+        last = numpy.searchsorted(good, ends) - 1 # type: numpy.ndarray
+        found = last >= 0 # type: numpy.ndarray
+        last_good = numpy.where(found, good[numpy.maximum(last, 0)] if len(good) else 0, -1) # type: numpy.ndarray
+        lengths = numpy.where(found & (last_good >= starts), last_good + 1 - starts, 0) # type: numpy.ndarray
+        trimmed = lengths < ends - starts # type: numpy.ndarray
+        records.truncate(lengths=lengths)
+        return trimmed
+
+    def _check(self, records: batch.Records) -> numpy.ndarray:
+        """Find why each read fails, as an index into the reasons or -1 if it passes"""
+        raw = numpy.frombuffer(records.data, dtype=numpy.uint8) # type: numpy.ndarray
+        starts, ends = records.qualities # type: numpy.ndarray, numpy.ndarray
+        lengths = ends - starts # type: numpy.ndarray
+        if self._window:
+            lengths = numpy.minimum(lengths, self._window)
+        reasons = numpy.full(len(records), -1, dtype=numpy.int8) # type: numpy.ndarray
+        if self._min_mean is not None or self._min_base is not None:
+            scores = raw[_segments(size=len(raw), starts=starts, ends=starts + lengths)].astype(numpy.int64) - self._offset # type: numpy.ndarray
+            if self._min_base is not None:
+                lowest = _reduce(function=numpy.minimum, values=scores, lengths=lengths, empty=0) # type: numpy.ndarray
+                reasons[lowest < self._min_base] = 2
+            if self._min_mean is not None:
+                totals = _reduce(function=numpy.add, values=scores, lengths=lengths, empty=0) # type: numpy.ndarray
+                reasons[totals < self._min_mean * lengths] = 1
+        reasons[ends - starts < max(self._min_length, 1)] = 0
+        return reasons
+
+    def apply(self, reads: batch.ReadBatch) -> Tuple[numpy.ndarray, Counter]:
+        """Trim and filter a batch of reads in place
+        Returns which reads passed and how many reads were stopped or trimmed at each stage
+        reads [batch.ReadBatch]     The batch to filter
+        """
+        counts = Counter() # type: Counter
+        reasons = numpy.full(len(reads), -1, dtype=numpy.int8) # type: numpy.ndarray
+        trimmed = numpy.zeros(len(reads), dtype=bool) # type: numpy.ndarray
+        for records in filter(None, (reads.forward, reads.reverse)): # type: batch.Records
+            if self._tail is not None:
+                trimmed |= self._trim_tails(records=records)
+            found = self._check(records=records) # type: numpy.ndarray
+            #   Keep the first reason found, checking forward reads first
+            reasons = numpy.where(reasons < 0, found, reasons)
+        passed = reasons < 0 # type: numpy.ndarray
+        for index, reason in enumerate((TOO_SHORT, LOW_MEAN, LOW_BASE)): # type: int, str
+            count = int(numpy.count_nonzero(reasons == index)) # type: int
+            if count:
+                counts[reason] = count
+        counts[TAIL_TRIMMED] = int(numpy.count_nonzero(trimmed & passed))
+        counts[PASSED] = int(numpy.count_nonzero(passed))
+        return passed, counts
+
+    def _settings(self) -> Dict[str, Any]:
+        return {
+            'window': self._window,
+            'min_mean': self._min_mean,
+            'min_base': self._min_base,
+            'tail_quality': self._tail,
+            'min_length': self._min_length,
+            'offset': self._offset
+        }
+
+    settings = property(fget=_settings, doc='Everything that changes which reads pass or how they are trimmed')
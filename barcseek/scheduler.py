@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+
+"""Hand out chunks of work on demand"""
+
+import sys
+if not (sys.version_info.major == 3 and sys.version_info.minor >= 5):
+    sys.exit("Please use Python 3.5 or higher for this module: " + __name__)
+
+
+#   Load standard modules
+import math
+import time
+import logging
+import collections
+from typing import Callable, Dict, List, Optional, Sequence
+
+#   Load custom modules
+import barcseek.chunks as chunks
+
+_TARGET_SECONDS = 2.0 # type: float
+_SMOOTHING = 0.3 # type: float
+
+
+class Scheduler(object):
+
+    """Group blocks into chunks as workers ask for them
+    The first chunk for each worker is a single block to measure throughput. After
+    that, chunks are sized so each one takes about 'target' seconds, but never more
+    than an even share of what is left, so batches shrink near the end of the file
+    and no worker is left with a long tail. Consecutive blocks are always grouped
+    together so a chunk is still one byte range, and lanes take turns so they are
+    all worked on at once. Lanes that can only be planned as they're read are fed a
+    chunk's worth of blocks at a time; chunks only shrink towards the end once every
+    lane has been planned
+    """
+
+    def __init__(
+            self,
+            blocks: Sequence[chunks.Chunk],
+            workers: int,
+            adaptive: bool=True,
+            target: float=_TARGET_SECONDS,
+            max_blocks: Optional[int]=None,
+            feeds: Optional[Dict[int, Callable[[], Optional[chunks.Chunk]]]]=None
+    ) -> None:
+        """
+    blocks [Sequence[chunks.Chunk]]     Single blocks left to do, in file order for each lane
+    workers [int]                       Number of workers taking chunks
+    adaptive [bool]=True                Size chunks from throughput; if False, every chunk is one block
+    target [float]=2.0                  Seconds of work to aim for in each chunk
+    max_blocks [int]=None               Most blocks to group into one chunk, such as to fit a memory budget
+    feeds [Dict[int, Callable]]=None    For lanes planned as they're read, a function giving the lane's next
+                                        block after those in 'blocks', None once there are no more
+    """
+        self._lanes = collections.OrderedDict() # type: collections.OrderedDict[int, collections.deque]
+        for block in blocks: # type: chunks.Chunk
+            self._lanes.setdefault(block.lane, collections.deque()).append(block)
+        self._feeds = dict(feeds or {}) # type: Dict[int, Callable[[], Optional[chunks.Chunk]]]
+        for lane in self._feeds: # type: int
+            self._lanes.setdefault(lane, collections.deque())
+        self._remaining = len(blocks) # type: int
+        self._workers = max(workers, 1) # type: int
+        self._adaptive = adaptive # type: bool
+        self._target = target # type: float
+        self._max_blocks = max_blocks # type: Optional[int]
+        self._rate = None # type: Optional[float]
+        self._start = time.time() # type: float
+        self._busy = 0.0 # type: float
+        self._chunks = 0 # type: int
+
+    def __len__(self) -> int:
+        return self._remaining
+
+    def _depth(self) -> int:
+        #   Keep one chunk queued behind every running chunk
+        return 2 * self._workers
+
+    def _size(self) -> int:
+        if not self._adaptive or self._rate is None:
+            return 1
+        size = int(self._rate * self._target) # type: int
+        #   How much is left isn't known until every lane is planned
+        share = math.ceil(self._remaining / self._workers) if not self._feeds else size # type: int
+        if self._max_blocks:
+            share = min(share, self._max_blocks)
+        return max(min(size, share), 1)
+
+    def next_chunk(self) -> Optional[chunks.Chunk]:
+        """Get the next chunk of work, None if there's nothing left"""
+        size = self._size() # type: int
+        while self._lanes:
+            #   Take the next lane in turn, moving it to the back of the line
+            lane, blocks = self._lanes.popitem(last=False) # type: int, collections.deque
+            self._fill(lane=lane, blocks=blocks, size=size)
+            if blocks:
+                break
+        else:
+            return None
+        pieces = [blocks.popleft()] # type: List[chunks.Chunk]
+        #   Only group blocks that follow each other in the file
+        while len(pieces) < size and blocks and blocks[0].index == pieces[-1].index + 1:
+            pieces.append(blocks.popleft())
+        if blocks or lane in self._feeds:
+            self._lanes[lane] = blocks
+        self._remaining -= len(pieces)
+        self._chunks += 1
+        return chunks.merge_chunks(pieces=pieces)
+
+    def _fill(self, lane: int, blocks: collections.deque, size: int) -> None:
+        """Read enough of a lane planned as it's read for a chunk of 'size' blocks"""
+        feed = self._feeds.get(lane) # type: Optional[Callable[[], Optional[chunks.Chunk]]]
+        while feed is not None and len(blocks) < size:
+            block = feed() # type: Optional[chunks.Chunk]
+            if block is None:
+                del self._feeds[lane]
+                break
+            blocks.append(block)
+            self._remaining += 1
+
+    def record(self, chunk: chunks.Chunk, seconds: float) -> None:
+        """Record how long a chunk took to update the throughput estimate
+        chunk [chunks.Chunk]    The finished chunk
+        seconds [float]         How long a worker spent on it
+        """
+        self._busy += seconds
+        rate = chunk.blocks / max(seconds, 1e-6) # type: float
+        if self._rate is None:
+            self._rate = rate
+        else:
+            self._rate = _SMOOTHING * rate + (1 - _SMOOTHING) * self._rate
+        logging.debug("Chunk %s of %s blocks took %s seconds", chunk.index, chunk.blocks, round(seconds, 3))
+
+    def _utilization(self) -> float:
+        elapsed = time.time() - self._start # type: float
+        if elapsed <= 0:
+            return 0.0
+        return min(self._busy / (elapsed * self._workers), 1.0)
+
+    def _handed_out(self) -> int:
+        return self._chunks
+
+    depth = property(fget=_depth, doc='How many chunks to keep handed out at once')
+    utilization = property(fget=_utilization, doc='Fraction of worker time spent on chunks so far')
+    handed_out = property(fget=_handed_out, doc='Number of chunks handed out')
@@ -0,0 +1,271 @@
+#!/usr/bin/env python3
+
+"""Stream outputs into named pipes or commands"""
+
+import sys
+if not (sys.version_info.major == 3 and sys.version_info.minor >= 5):
+    sys.exit("Please use Python 3.5 or higher for this module: " + __name__)
+
+
+#   Load standard modules
+import os
+import time
+import queue
+import shlex
+import stat
+import logging
+import tempfile
+import threading
+import subprocess
+from typing import Dict, Iterable, Optional, Tuple
+
+_QUEUE_DEPTH = 8 # type: int
+#   Most bytes one sink may spill to disk before the run stops
+MAX_SPILL = 256 * 1024 * 1024 # type: int
+#   Most spilled bytes to read back at a time
+_SPILL_READ = 4 * 1024 * 1024 # type: int
+#   Seconds between checks on sinks that are behind
+_WAIT_INTERVAL = 0.05 # type: float
+
+
+class Sink(object):
+
+    """Write to one output from a background thread
+    Writes go onto a bounded queue drained by the sink's own thread. A sink whose
+    queue is full is 'backlogged', and callers should stop producing data for it
+    (see 'wait_for_room'); anything written to it anyway is spilled to a temporary
+    file and read back in order as the reader catches up, so a write never blocks.
+    Spills are capped, and going over the cap is an error rather than quietly
+    filling the disk. Errors in the thread are raised on the next write or on close
+    """
+
+    def __init__(self, name: str, depth: int=_QUEUE_DEPTH, max_spill: int=MAX_SPILL) -> None:
+        """
+    name [str]              The output this sink stands in for
+    depth [int]=8           How many writes to hold in memory before spilling to disk
+    max_spill [int]=256 MiB Most bytes to have spilled at once
+    """
+        self._name = name # type: str
+        self._queue = queue.Queue(maxsize=depth) # type: queue.Queue
+        self._max_spill = max_spill # type: int
+        #   Spilled bytes are written at '_spilled' and read back from '_unspilled', both guarded by '_lock'
+        self._lock = threading.Lock() # type: threading.Lock
+        self._spill = None
+        self._spilled = 0 # type: int
+        self._unspilled = 0 # type: int
+        self._spill_total = 0 # type: int
+        self._error = None # type: Optional[BaseException]
+        self._thread = threading.Thread(target=self._drain, name='sink:' + name, daemon=True) # type: threading.Thread
+        self._started = False # type: bool
+        self._closed = False # type: bool
+
+    def __repr__(self) -> str:
+        return self._name
+
+    def _open(self):
+        """Open the underlying binary stream, called from the sink's thread"""
+        raise NotImplementedError
+
+    def _finish(self) -> None:
+        """Clean up after the stream is closed, called from the sink's thread"""
+        pass
+
+    def _unspill(self, queued: bool=True) -> Optional[bytes]:
+        """Read back the next piece of spilled data, called from the sink's thread with the lock held
+        Spilled data follows everything queued, so none is read back while the queue still holds writes
+        """
+        if self._spilled == self._unspilled or (queued and not self._queue.empty()):
+            return None
+        self._spill.seek(self._unspilled)
+        data = self._spill.read(min(self._spilled - self._unspilled, _SPILL_READ)) # type: bytes
+        self._unspilled += len(data)
+        if self._unspilled == self._spilled:
+            #   Caught up, so start the file over
+            self._spill.seek(0)
+            self._spill.truncate()
+            self._spilled = self._unspilled = 0
+        return data
+
+    def _drain(self) -> None:
+        try:
+            handle = self._open()
+            try:
+                while True:
+                    with self._lock:
+                        data = self._unspill() # type: Optional[bytes]
+                    if data is None:
+                        data = self._queue.get()
+                    if data is None:
+                        #   Nothing is queued once a spill starts, so whatever is spilled is all that's left
+                        while True:
+                            with self._lock:
+                                data = self._unspill(queued=False)
+                            if data is None:
+                                break
+                            handle.write(data)
+                        break
+                    handle.write(data)
+            finally:
+                handle.close()
+            self._finish()
+        except BaseException as error:
+            self._error = error
+            #   Keep emptying the queue so writers don't block forever
+            while self._queue.get() is not None:
+                pass
+
+    def _check(self) -> None:
+        if self._error is not None:
+            raise IOError("Cannot write to %s: %s" % (self._name, self._error))
+
+    def write(self, data: bytes) -> None:
+        """Queue data for the sink, spilling it to disk if the queue is full"""
+        self._check()
+        if not data:
+            return
+        if not self._started:
+            self._thread.start()
+            self._started = True
+        with self._lock:
+            #   Once anything is spilled, everything after it is too, to keep it in order
+            if self._spilled == self._unspilled:
+                try:
+                    self._queue.put_nowait(data)
+                    return
+                except queue.Full:
+                    pass
+            if self._spilled - self._unspilled + len(data) > self._max_spill:
+                raise IOError("%s has fallen more than %s MiB behind; is anything reading it?" % (self._name, self._max_spill // 2 ** 20))
+            if self._spill is None:
+                logging.warning("%s isn't keeping up, spilling what's written to it to disk until it catches up", self._name)
+                self._spill = tempfile.TemporaryFile(prefix='barcseek_sink_')
+            self._spill.seek(self._spilled)
+            self._spill.write(data)
+            self._spilled += len(data)
+            self._spill_total += len(data)
+
+    def close(self) -> None:
+        """Wait for everything queued to be written and close the sink"""
+        if self._closed:
+            return
+        self._closed = True
+        if not self._started:
+            self._thread.start()
+            self._started = True
+        self._queue.put(None)
+        self._thread.join()
+        if self._spill is not None:
+            self._spill.close()
+        self._check()
+
+    def terminate(self) -> None:
+        """Stop the sink without waiting for a reader"""
+        self._closed = True
+
+    def _get_spilled(self) -> int:
+        return self._spill_total
+
+    def _is_backlogged(self) -> bool:
+        return self._queue.full() or self._spilled != self._unspilled
+
+    def _has_failed(self) -> bool:
+        return self._error is not None
+
+    spilled = property(fget=_get_spilled, doc='Total bytes spilled to disk while the reader fell behind')
+    backlogged = property(fget=_is_backlogged, doc='Is the queue full, so that more writes would spill?')
+    failed = property(fget=_has_failed, doc="Has the sink's thread stopped on an error?")
+
+
+class FifoSink(Sink):
+
+    """Write to a named pipe, creating it if needed
+    Opening a named pipe waits for a reader, so nothing is written until
+    whatever is downstream opens it
+    """
+
+    def __init__(self, name: str, depth: int=_QUEUE_DEPTH, max_spill: int=MAX_SPILL) -> None:
+        super(FifoSink, self).__init__(name=name, depth=depth, max_spill=max_spill)
+        if os.path.exists(name):
+            if not stat.S_ISFIFO(os.stat(name).st_mode):
+                raise ValueError(logging.error("%s already exists and is not a named pipe", name))
+        else:
+            os.mkfifo(name)
+
+    def _open(self):
+        return open(self._name, 'wb')
+
+
+class CommandSink(Sink):
+
+    """Pipe an output into a command's standard input"""
+
+    def __init__(self, name: str, command: str, depth: int=_QUEUE_DEPTH, max_spill: int=MAX_SPILL) -> None:
+        """
+    name [str]              The output this sink stands in for
+    command [str]           A shell command to run
+    depth [int]=8           How many writes to hold in memory before spilling to disk
+    max_spill [int]=256 MiB Most bytes to have spilled at once
+    """
+        super(CommandSink, self).__init__(name=name, depth=depth, max_spill=max_spill)
+        self._command = command # type: str
+        logging.debug("Streaming %s into '%s'", name, command)
+        self._process = subprocess.Popen(command, shell=True, stdin=subprocess.PIPE) # type: subprocess.Popen
+
+    def _open(self):
+        return self._process.stdin
+
+    def _finish(self) -> None:
+        code = self._process.wait() # type: int
+        if code:
+            raise subprocess.CalledProcessError(returncode=code, cmd=self._command)
+
+    def terminate(self) -> None:
+        super(CommandSink, self).terminate()
+        self._process.kill()
+
+
+def format_command(template: str, output: str, category: str, read: str) -> str:
+    """Fill in a command template for one output
+    '{output}' is replaced by the quoted output name, '{sample}' by the category, and '{read}' by 'fwd' or 'rev'
+    """
+    return template.format(output=shlex.quote(output), sample=shlex.quote(category), read=read)
+
+
+def wait_for_room(sinks: Iterable[Sink]) -> None:
+    """Wait until no sink is backlogged, so new data won't spill
+    A sink whose thread has failed stops counting, its error is raised on the next write
+    """
+    sinks = tuple(sinks) # type: Tuple[Sink]
+    waited = False # type: bool
+    while any(sink.backlogged and not sink.failed for sink in sinks):
+        if not waited:
+            logging.debug("Waiting for %s to catch up", ', '.join(repr(sink) for sink in sinks if sink.backlogged))
+            waited = True
+        time.sleep(_WAIT_INTERVAL)
+
+
+def open_sinks(
+        outputs: Iterable[Dict[str, tuple]],
+        command: Optional[str]=None,
+        fifo: bool=False,
+        max_spill: int=MAX_SPILL
+) -> Dict[str, Sink]:
+    """Create one sink for every output name
+    outputs [Iterable[Dict[str, tuple]]]    Output names for each lane, keyed by category
+    command [str]=None                      Command template to pipe each output into
+    fifo [bool]=False                       Create named pipes at each output name instead
+    max_spill [int]=256 MiB                 Most bytes each sink may have spilled to disk at once
+    """
+    if bool(command) == bool(fifo):
+        raise ValueError("Must stream to either commands or named pipes")
+    sinks = dict() # type: Dict[str, Sink]
+    for lane_outputs in outputs: # type: Dict[str, tuple]
+        for category, names in lane_outputs.items(): # type: str, tuple
+            for read, name in zip(('fwd', 'rev'), names): # type: str, Optional[str]
+                if not name or name in sinks:
+                    continue
+                if command:
+                    sinks[name] = CommandSink(name=name, command=format_command(template=command, output=name, category=category, read=read), max_spill=max_spill)
+                else:
+                    sinks[name] = FifoSink(name=name, max_spill=max_spill)
+    return sinks
@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+
+"""Spill runs: one file per chunk holding every sample's reads, merged into outputs at the end"""
+
+import sys
+if not (sys.version_info.major == 3 and sys.version_info.minor >= 5):
+    sys.exit("Please use Python 3.5 or higher for this module: " + __name__)
+
+
+#   Load standard modules
+import os
+import struct
+import logging
+from typing import Dict, List, Optional, Sequence, Tuple
+
+#   Load installed modules
+try:
+    import numpy
+except ImportError as error:
+    sys.exit("Please install " + error.name)
+
+
+RUN_SUFFIX = '.run' # type: str
+#   Leave room for logs, the manifest, and anything else the run has open
+_RESERVED_FILES = 32 # type: int
+_DEFAULT_OPEN_FILES = 1024 # type: int
+#   Number of categories, bytes of read data, and bytes of forward reads in a run, written after its lengths
+_FOOTER = struct.Struct('<QQQ') # type: struct.Struct
+#   How many categories' lengths to read at a time
+_LENGTH_BLOCK = 4096 # type: int
+
+
+def open_file_limit() -> int:
+    """How many spill runs can be open at once, from this process's file descriptor limit"""
+    try:
+        import resource
+        soft, _ = resource.getrlimit(resource.RLIMIT_NOFILE) # type: int, int
+        if soft == resource.RLIM_INFINITY:
+            soft = _DEFAULT_OPEN_FILES
+    except (ImportError, ValueError, OSError):
+        soft = _DEFAULT_OPEN_FILES
+    return max(soft - _RESERVED_FILES, 3)
+
+
+def write_run(filename: str, categories: Sequence[str], rendered: Dict[str, Tuple[bytes, Optional[bytes]]]) -> int:
+    """Write one chunk's rendered reads as a spill run, returns its size in bytes
+    A run holds every category's forward reads in category order, then every category's
+    reverse reads, then how long each section is; it's written under a temporary name and
+    moved into place, so a run either exists in full or not at all
+    filename [str]                                      Where to write the run
+    categories [Sequence[str]]                          Every category, in the order outputs are merged
+    rendered [Dict[str, Tuple[bytes, Optional[bytes]]]] Forward and optional reverse reads for each category
+    """
+    lengths = numpy.zeros((len(categories), 2), dtype='<u8') # type: numpy.ndarray
+    temp = filename + '.tmp' # type: str
+    with open(temp, 'wb') as rfile:
+        for column in (0, 1): # type: int
+            for row, category in enumerate(categories): # type: int, str
+                data = rendered.get(category, (b'', None))[column] or b'' # type: bytes
+                rfile.write(data)
+                lengths[row, column] = len(data)
+        size = int(lengths.sum()) # type: int
+        rfile.write(lengths.tobytes())
+        rfile.write(_FOOTER.pack(len(categories), size, int(lengths[:, 0].sum())))
+        rfile.flush()
+        os.fsync(rfile.fileno())
+    os.replace(temp, filename)
+    return size
+
+
+class Run(object):
+
+    """An open spill run, read one category at a time in category order
+    Section lengths are read a block at a time as categories go by, so a run
+    over 100,000 samples holds one file open and a few pages of memory
+    """
+
+    def __init__(self, filename: str, categories: int) -> None:
+        """
+    filename [str]      The spill run
+    categories [int]    How many categories the run should hold
+    """
+        self._filename = filename # type: str
+        self._file = open(filename, 'rb')
+        self._file.seek(-_FOOTER.size, os.SEEK_END)
+        count, size, forward = _FOOTER.unpack(self._file.read(_FOOTER.size)) # type: int, int, int
+        if count != categories:
+            self._file.close()
+            raise ValueError(logging.error("Spill run %s holds %s categories rather than %s", filename, count, categories))
+        self._index = size # type: int
+        self._count = count # type: int
+        self._block = (-1, None) # type: Tuple[int, Optional[numpy.ndarray]]
+        #   Where the next forward and reverse sections start
+        self._cursors = [0, forward] # type: List[int]
+
+    def _length(self, row: int, column: int) -> int:
+        block, lengths = self._block # type: int, Optional[numpy.ndarray]
+        if row // _LENGTH_BLOCK != block:
+            block = row // _LENGTH_BLOCK
+            self._file.seek(self._index + block * _LENGTH_BLOCK * 16)
+            rows = min(_LENGTH_BLOCK, self._count - block * _LENGTH_BLOCK) # type: int
+            lengths = numpy.frombuffer(self._file.read(rows * 16), dtype='<u8').reshape(rows, 2)
+            self._block = (block, lengths)
+        return int(lengths[row % _LENGTH_BLOCK, column])
+
+    def copy(self, row: int, column: int, ofile, buffer_size: int) -> int:
+        """Copy one category's forward (column 0) or reverse (column 1) reads onto the end of an open file
+        Categories must be copied in order for each column; returns the bytes copied
+        """
+        remaining = self._length(row=row, column=column) # type: int
+        copied = remaining # type: int
+        self._file.seek(self._cursors[column])
+        while remaining:
+            block = self._file.read(min(remaining, buffer_size)) # type: bytes
+            if not block:
+                raise ValueError(logging.error("Spill run %s is truncated", self._filename))
+            ofile.write(block)
+            remaining -= len(block)
+        self._cursors[column] += copied
+        return copied
+
+    def skip(self, row: int, column: int) -> None:
+        """Move past one category's reads without copying them"""
+        self._cursors[column] += self._length(row=row, column=column)
+
+    def close(self) -> None:
+        self._file.close()
+
+
+def _combine(runs: Sequence[str], filename: str, categories: int, buffer_size: int) -> None:
+    """Merge several runs into one, keeping their order within every category"""
+    opened = [Run(filename=run, categories=categories) for run in runs] # type: List[Run]
+    lengths = numpy.zeros((categories, 2), dtype='<u8') # type: numpy.ndarray
+    temp = filename + '.tmp' # type: str
+    try:
+        with open(temp, 'wb') as rfile:
+            for column in (0, 1): # type: int
+                for row in range(categories): # type: int
+                    lengths[row, column] = sum(run.copy(row=row, column=column, ofile=rfile, buffer_size=buffer_size) for run in opened)
+            rfile.write(lengths.tobytes())
+            rfile.write(_FOOTER.pack(categories, int(lengths.sum()), int(lengths[:, 0].sum())))
+    finally:
+        for run in opened: # type: Run
+            run.close()
+    os.replace(temp, filename)
+
+
+def merge(
+        runs: Sequence[str],
+        categories: Sequence[str],
+        outputs: Dict[str, Tuple[str, Optional[str]]],
+        max_open_files: Optional[int]=None,
+        buffer_size: int=16 * 1024 * 1024,
+        header: bytes=b'',
+        trailer: bytes=b''
+) -> None:
+    """Write final outputs from spill runs, one output at a time
+    Runs are read side by side like the sorted runs of an external sort: each
+    output gets its category's section from every run in turn. If there are more
+    runs than files allowed open, neighbouring runs are first combined in passes
+    runs [Sequence[str]]                            Spill runs, in the order their reads should be written
+    categories [Sequence[str]]                      Every category, in the order the runs were written with
+    outputs [Dict[str, Tuple[str, Optional[str]]]]  Forward and optional reverse output names for each category
+    max_open_files [int]=None                       Most runs to have open at once; if None, from the system limit
+    buffer_size [int]=16 MiB                        Most bytes to copy at a time
+    header [bytes]=b''                              Written at the start of every output
+    trailer [bytes]=b''                             Written at the end of every output
+    """
+    width = max((max_open_files or open_file_limit()) - 1, 2) # type: int
+    runs = list(runs) # type: List[str]
+    passes = 0 # type: int
+    while len(runs) > width:
+        passes += 1
+        combined = list() # type: List[str]
+        for start in range(0, len(runs), width): # type: int
+            group = runs[start:start + width] # type: List[str]
+            if len(group) == 1:
+                combined.extend(group)
+                continue
+            name = '%s.pass%d.%06d%s' % (os.path.splitext(group[0])[0], passes, start, RUN_SUFFIX) # type: str
+            _combine(runs=group, filename=name, categories=len(categories), buffer_size=buffer_size)
+            for run in group: # type: str
+                os.remove(run)
+            combined.append(name)
+        logging.debug("Combined spill runs into %s in pass %s", len(combined), passes)
+        runs = combined
+    opened = [Run(filename=run, categories=len(categories)) for run in runs] # type: List[Run]
+    try:
+        for column in (0, 1): # type: int
+            for row, category in enumerate(categories): # type: int, str
+                output = outputs[category][column] # type: Optional[str]
+                if not output:
+                    for run in opened: # type: Run
+                        run.skip(row=row, column=column)
+                    continue
+                with open(output, 'wb') as ofile:
+                    ofile.write(header)
+                    for run in opened: # type: Run
+                        run.copy(row=row, column=column, ofile=ofile, buffer_size=buffer_size)
+                    ofile.write(trailer)
+    finally:
+        for run in opened: # type: Run
+            run.close()
@@ -9,42 +9,203 @@ if not (sys.version_info.major == 3 and sys.version_info.minor >= 5):
 
 #   Load standard modules
 import os
-from typing import Optional, List
+import time
+import logging
+from collections import Counter
+from typing import Dict, List, Optional, Sequence, Tuple
+
+#   Load custom modules
+from barcseek.partition import AMBIGUOUS, UNDETERMINED
 
 #   Load installed modules
 try:
     import numpy as np
+    import matplotlib
+    #   Render without a display so reports work on headless nodes
+    matplotlib.use('Agg')
     import matplotlib.pyplot as plt
 except ImportError as error:
     sys.exit("Please install " + error.name)
 
 
-def stats_barc(output_files: List[str], output_directory: Optional[str]=None) -> None:
+PLOT_FORMATS = ('pdf', 'png', 'svg') # type: Tuple[str]
+#   Past this many categories, axis labels are dropped and the tables carry the names
+_MAX_LABELS = 100 # type: int
+#   Largest figure side in inches, so thousands of samples still fit the renderer's limits
+_MAX_INCHES = 40.0 # type: float
+
+
+def umi_histograms(umis: Dict[Tuple[str, str], int]) -> Dict[str, Counter]:
+    """For each sample, count how many UMIs were seen once, twice, and so on
+    umis [Dict[Tuple[str, str], int]]   Number of reads for each (sample, UMI)
+    """
+    histograms = dict() # type: Dict[str, Counter]
+    for (sample, _), reads in umis.items(): # type: (str, str), int
+        histograms.setdefault(sample, Counter())[reads] += 1
+    return histograms
+
+
+def write_tables(
+        counts: Dict[str, int],
+        samples: Sequence[str],
+        distances: Dict[Tuple[str, int], int],
+        umis: Dict[Tuple[str, str], int],
+        directory: str
+) -> Tuple[str]:
+    """Write tab-delimited summaries of a run, returns the tables written
+    counts [Dict[str, int]]                 Number of reads written to each category
+    samples [Sequence[str]]                 Sample names, in sample sheet order
+    distances [Dict[Tuple[str, int], int]]  Number of reads assigned to each (sample, edit distance)
+    umis [Dict[Tuple[str, str], int]]       Number of reads for each (sample, UMI)
+    directory [str]                         Where to write the tables
     """
-    This function generates basic stats on demultiplexed datasets.
-    Currently, it takes all output files as argument in the form of a list,
-    counts the number of fastq lines per file and
-    outputs a pdf file with a barplot of reads/demultiplexed dataset. The output directory
-    for this pdf file is an optional argument with default set to the directory containing
-    the fastq files.
+    total = sum(counts.values()) # type: int
+    distance_totals = Counter() # type: Counter
+    for (sample, distance), reads in distances.items(): # type: (str, int), int
+        distance_totals[sample] += distance * reads
+    distinct = Counter(sample for sample, _ in umis) # type: Counter
+    summary = os.path.join(directory, 'summary.tsv') # type: str
+    with open(summary, 'w') as sfile:
+        sfile.write('category\treads\tfraction\tmean_distance\tumis\n')
+        for category in tuple(samples) + (AMBIGUOUS, UNDETERMINED): # type: str
+            reads = counts.get(category, 0) # type: int
+            sfile.write('%s\t%s\t%s\t%s\t%s\n' % (
+                category,
+                reads,
+                round(reads / total, 6) if total else 0,
+                round(distance_totals[category] / reads, 4) if reads and category in samples else 'NA',
+                distinct[category] if category in samples else 'NA'
+            ))
+    tables = [summary] # type: List[str]
+    distance_table = os.path.join(directory, 'distances.tsv') # type: str
+    with open(distance_table, 'w') as dfile:
+        dfile.write('sample\tdistance\treads\n')
+        for (sample, distance), reads in sorted(distances.items()): # type: (str, int), int
+            dfile.write('%s\t%s\t%s\n' % (sample, distance, reads))
+    tables.append(distance_table)
+    if umis:
+        umi_table = os.path.join(directory, 'umis.tsv') # type: str
+        with open(umi_table, 'w') as ufile:
+            ufile.write('sample\treads_per_umi\tumis\n')
+            for sample, histogram in sorted(umi_histograms(umis=umis).items()): # type: str, Counter
+                for reads, count in sorted(histogram.items()): # type: int, int
+                    ufile.write('%s\t%s\t%s\n' % (sample, reads, count))
+        tables.append(umi_table)
+    return tuple(tables)
+
+
+def _figure(rows: int):
+    """A figure tall enough to give every row some room, within renderer limits"""
+    height = min(max(4.0, 0.2 * rows + 1.5), _MAX_INCHES) # type: float
+    return plt.figure(figsize=(8, height))
+
+
+def _label_rows(axes, names: Sequence[str], invert: bool=True) -> None:
+    if len(names) <= _MAX_LABELS:
+        axes.set_yticks(np.arange(len(names)))
+        axes.set_yticklabels(names, fontsize='small')
+    else:
+        axes.set_yticks(())
+        axes.set_ylabel('%s categories, see summary.tsv' % len(names))
+    #   Keep the first row on top; 'imshow' already does
+    if invert:
+        axes.invert_yaxis()
+
+
+def _save(figure, basename: str, directory: str, formats: Sequence[str]) -> List[str]:
+    written = list() # type: List[str]
+    for plot_format in formats: # type: str
+        filename = os.path.join(directory, '%s.%s' % (basename, plot_format)) # type: str
+        figure.savefig(filename, bbox_inches='tight')
+        written.append(filename)
+    plt.close(figure)
+    return written
+
+
+def plot_counts(counts: Dict[str, int], categories: Sequence[str], directory: str, formats: Sequence[str]=PLOT_FORMATS[:1]) -> List[str]:
+    """Bar chart of reads per category, returns the files written"""
+    figure = _figure(rows=len(categories))
+    axes = figure.add_subplot(1, 1, 1)
+    axes.barh(np.arange(len(categories)), [counts.get(category, 0) for category in categories], align='center', alpha=0.5)
+    _label_rows(axes=axes, names=categories)
+    axes.set_xlabel('number of reads')
+    axes.set_title('dataset names')
+    return _save(figure=figure, basename='demultiplexedResults', directory=directory, formats=formats)
+
+
+def plot_distances(distances: Dict[Tuple[str, int], int], samples: Sequence[str], directory: str, formats: Sequence[str]=PLOT_FORMATS[:1]) -> List[str]:
+    """Stacked bars of the fraction of each sample's reads at each edit distance, returns the files written"""
+    levels = sorted(set(distance for _, distance in distances)) # type: List[int]
+    matrix = np.zeros((len(samples), len(levels))) # type: np.ndarray
+    rows = {sample: row for row, sample in enumerate(samples)} # type: Dict[str, int]
+    for (sample, distance), reads in distances.items(): # type: (str, int), int
+        if sample in rows:
+            matrix[rows[sample], levels.index(distance)] = reads
+    totals = matrix.sum(axis=1, keepdims=True) # type: np.ndarray
+    matrix = np.divide(matrix, totals, out=np.zeros_like(matrix), where=totals > 0)
+    figure = _figure(rows=len(samples))
+    axes = figure.add_subplot(1, 1, 1)
+    left = np.zeros(len(samples)) # type: np.ndarray
+    #   One call per distance rather than per sample keeps thousands of samples cheap to draw
+    for column, distance in enumerate(levels): # type: int, int
+        axes.barh(np.arange(len(samples)), matrix[:, column], left=left, align='center', label='%s' % distance)
+        left += matrix[:, column]
+    _label_rows(axes=axes, names=samples)
+    axes.set_xlabel('fraction of assigned reads')
+    axes.set_title('edit distance per sample')
+    if levels:
+        axes.legend(title='distance', loc='lower left', bbox_to_anchor=(1.01, 0), fontsize='small')
+    return _save(figure=figure, basename='distanceHistograms', directory=directory, formats=formats)
+
+
+def plot_umis(umis: Dict[Tuple[str, str], int], samples: Sequence[str], directory: str, formats: Sequence[str]=PLOT_FORMATS[:1]) -> List[str]:
+    """Heatmap of how many times each sample's UMIs were seen, in powers of two, returns the files written"""
+    histograms = umi_histograms(umis=umis) # type: Dict[str, Counter]
+    named = [sample for sample in samples if sample in histograms] # type: List[str]
+    most = max(max(histogram) for histogram in histograms.values()) # type: int
+    bins = int(np.log2(most)) + 1 # type: int
+    matrix = np.zeros((len(named), bins)) # type: np.ndarray
+    for row, sample in enumerate(named): # type: int, str
+        for reads, count in histograms[sample].items(): # type: int, int
+            matrix[row, int(np.log2(reads))] += count
+    totals = matrix.sum(axis=1, keepdims=True) # type: np.ndarray
+    matrix = np.divide(matrix, totals, out=np.zeros_like(matrix), where=totals > 0)
+    figure = _figure(rows=len(named))
+    axes = figure.add_subplot(1, 1, 1)
+    image = axes.imshow(matrix, aspect='auto', interpolation='nearest', cmap='viridis')
+    axes.set_xticks(np.arange(bins))
+    axes.set_xticklabels(['%s-%s' % (2 ** column, 2 ** (column + 1) - 1) for column in range(bins)], rotation=45, fontsize='small')
+    _label_rows(axes=axes, names=named, invert=False)
+    axes.set_xlabel('reads per UMI')
+    axes.set_title('UMI counts per sample')
+    figure.colorbar(image, ax=axes, label='fraction of UMIs')
+    return _save(figure=figure, basename='umiHistograms', directory=directory, formats=formats)
+
+
+def write_report(
+        counts: Dict[str, int],
+        samples: Sequence[str],
+        distances: Dict[Tuple[str, int], int],
+        umis: Optional[Dict[Tuple[str, str], int]]=None,
+        directory: str=os.getcwd(),
+        formats: Sequence[str]=PLOT_FORMATS[:1]
+) -> None:
+    """Write summary tables and plots for a run from the counts gathered while demultiplexing
+    Nothing is reread from the outputs, so this takes the same time however large they are
+    counts [Dict[str, int]]                         Number of reads written to each category
+    samples [Sequence[str]]                         Sample names, in sample sheet order
+    distances [Dict[Tuple[str, int], int]]          Number of reads assigned to each (sample, edit distance)
+    umis [Dict[Tuple[str, str], int]]=None          Number of reads for each (sample, UMI)
+    directory [str]=os.getcwd()                     Where to write tables and plots
+    formats [Sequence[str]]=('pdf',)                Plot formats to write, from 'pdf', 'png', and 'svg'
     """
-    if not output_directory:
-        output_directory = os.path.dirname(output_files[0]) # type: str
-    file_names = tuple(os.path.basename(file) for file in output_files) # type: List[str]
-    output_size = [] # type: List[int]
-    for i in range(len(output_files)):
-        counts = sum(1 for line in open(output_files[i])) # type: int
-        output_size.append(counts)
-    divisor = 4 # type: int
-    outputs = (s / divisor for s in output_size) # type: generator
-    num_files = len(file_names) # type: int
-    ind = np.arange(num_files)
-    final_plot = plt.figure()
-    plt.bar(ind, outputs, align='center', alpha=0.5)
-    plt.xticks(ind, file_names, rotation=45)
-    plt.ylabel('number of reads')
-    plt.title('dataset names')
-    plt.show()
-    if output_directory[-1] != '/':
-        output_directory += '/'
-    final_plot.savefig(output_directory + "demultiplexedResults.pdf", bbox_inches='tight')
+    report_start = time.time() # type: float
+    umis = umis or dict() # type: Dict[Tuple[str, str], int]
+    written = list(write_tables(counts=counts, samples=samples, distances=distances, umis=umis, directory=directory)) # type: List[str]
+    samples = tuple(samples) # type: Tuple[str]
+    written.extend(plot_counts(counts=counts, categories=samples + (AMBIGUOUS, UNDETERMINED), directory=directory, formats=formats))
+    written.extend(plot_distances(distances=distances, samples=samples, directory=directory, formats=formats))
+    if umis:
+        written.extend(plot_umis(umis=umis, samples=samples, directory=directory, formats=formats))
+    logging.info("Wrote %s stats files to %s", len(written), directory)
+    logging.debug("Stats took %s seconds", round(time.time() - report_start, 3))
@@ -9,10 +9,12 @@ if not (sys.version_info.major == 3 and sys.version_info.minor >= 5):
 
 #   Load standard modules
 import os
+import glob
 import gzip
 import time
 import logging
-from typing import Iterable, Tuple, Dict, Any, Optional
+import itertools
+from typing import Iterable, Iterator, Tuple, Dict, Any, List, Optional
 
 #   Load custom modules
 import barcseek.fastq as fastq
@@ -75,74 +77,139 @@ class ColoredFormatter(logging.Formatter):
 
 
 def unpack(collection: Iterable[Any]) -> Tuple[Any]:
-    """Unpack a series of nested lists, sets, or tuples"""
+    """Unpack a series of nested lists, sets, or tuples
+    Walks the nesting with a stack of iterators rather than recursing, so deep or
+    wide collections don't hit the recursion limit or build intermediate tuples
+    """
     result = [] # type: List
-    for item in collection: # type: Any
-        if hasattr(item, '__iter__') and not isinstance(item, str):
-            result.extend(unpack(collection=item))
-        else:
+    stack = [iter(collection)] # type: List[Iterator]
+    while stack:
+        for item in stack[-1]: # type: Any
+            if hasattr(item, '__iter__') and not isinstance(item, str):
+                stack.append(iter(item))
+                break
             result.append(item)
+        else:
+            stack.pop()
     return tuple(result)
 
 
-def load_fastq(fastq_file: str, pair: Optional[str]=None) -> Tuple[fastq.Read]:
-    """Load a FASTQ file"""
-    logging.info("Reading in FASTQ file %s", fastq_file)
-    read_start = time.time() # type: float
-    reads = {} # type: Dict[str, fastq.Read]
+def expand_paths(patterns: Iterable[str]) -> Tuple[str]:
+    """Expand glob patterns into a sorted list of files, keeping the order of the patterns"""
+    paths = [] # type: List[str]
+    for pattern in patterns: # type: str
+        matches = sorted(glob.glob(pattern)) # type: List[str]
+        if not matches:
+            raise SystemExit(logging.critical("Cannot find any files matching %s", pattern))
+        paths.extend(matches)
+    return tuple(paths)
+
+
+def find_lanes(forward: Iterable[str], reverse: Optional[Iterable[str]]=None) -> Tuple[Tuple[str, Optional[str]]]:
+    """Pair up forward and reverse FASTQ files for each lane
+    forward [Iterable[str]]         Forward FASTQ files or glob patterns
+    reverse [Iterable[str]]=None    Optional reverse FASTQ files or glob patterns, in the same order
+    """
+    forward_files = expand_paths(patterns=forward) # type: Tuple[str]
+    if not reverse:
+        return tuple((ffile, None) for ffile in forward_files)
+    reverse_files = expand_paths(patterns=reverse) # type: Tuple[str]
+    if len(forward_files) != len(reverse_files):
+        raise SystemExit(logging.critical("Found %s forward FASTQ files but %s reverse FASTQ files", len(forward_files), len(reverse_files)))
+    return tuple(zip(forward_files, reverse_files))
+
+
+def _records(fastq_file: str) -> Iterator[Tuple[str, str, str]]:
     if os.path.splitext(fastq_file)[-1] == '.gz':
         my_open = gzip.open # type: function
     else:
         my_open = open # type: function
     with my_open(fastq_file, 'rt') as ffile:
-        for read in FastqGeneralIterator(ffile): # type: Tuple[str, str, str]
-            name, seq, qual = read # type: str, str, str
-            reads[name] = fastq.Read(read_id=name, seq=seq, qual=qual)
-    logging.debug("Reading in FASTQ file %s took %s seconds", fastq_file, round(time.time() - read_start, 3))
+        yield from FastqGeneralIterator(ffile)
+
+
+def iter_fastq(
+        fastq_file: str,
+        pair: Optional[str]=None,
+        interleaved: bool=False,
+        window: int=0,
+        skip_unpaired: bool=False
+) -> Iterator[fastq.Read]:
+    """Stream reads from a FASTQ file, pairing them as they're read
+    Pairs are matched in lockstep by normalized read ID, so only the reorder
+    window is ever held rather than every read
+    fastq_file [str]            Forward or single FASTQ file
+    pair [str]=None             Optional reverse FASTQ file
+    interleaved [bool]=False    Are both reads of each pair in 'fastq_file'?
+    window [int]=0              How far out of order a read may be from its mate
+    skip_unpaired [bool]=False  Skip reads without a mate rather than raising an error
+    """
     if pair:
-        logging.info("Reading in reverse FASTQ file %s", pair)
-        reverse_start = time.time() # type: float
-        if os.path.splitext(pair)[-1] == '.gz':
-            my_open = gzip.open # type: function
-        else:
-            my_open = open # type: function
-        with my_open(pair, 'rt') as rfile:
-            for rread in FastqGeneralIterator(rfile): # type: Tuple[str, str, str]
-                rname, rseq, rqual = rread # type: str, str, str
-                try:
-                    reads[rname].add_reverse(seq=rseq, qual=rqual)
-                except KeyError:
-                    logging.error("Reverse read %s doesn't match any reads in the forward FASTQ file", rname)
-        logging.debug("Reading in reverse FASTQ file took %s seconds", round(time.time() - reverse_start, 3))
-    return tuple(reads.values())
+        forward, reverse = _records(fastq_file=fastq_file), _records(fastq_file=pair) # type: Iterator[Tuple[str, str, str]], Iterator[Tuple[str, str, str]]
+    elif interleaved:
+        #   Both halves come from one file; taking them in turn keeps 'tee' from buffering more than a record
+        firsts, seconds = itertools.tee(_records(fastq_file=fastq_file))
+        forward, reverse = itertools.islice(firsts, 0, None, 2), itertools.islice(seconds, 1, None, 2)
+    else:
+        for name, seq, qual in _records(fastq_file=fastq_file): # type: str, str, str
+            yield fastq.Read(read_id=name, seq=seq, qual=qual)
+        return
+    sync = fastq.PairSync(window=window, skip_unpaired=skip_unpaired) # type: fastq.PairSync
+    for (name, seq, qual), (_, rseq, rqual) in sync.pair( # type: (str, str, str), (str, str, str)
+            forward=((record[0], record) for record in forward),
+            reverse=((record[0], record) for record in reverse)
+    ):
+        yield fastq.Read(read_id=name, seq=seq, qual=qual, rev=rseq, rev_qual=rqual)
+    if sync.unpaired:
+        logging.warning("Skipped %s reads without a mate in %s", sync.unpaired, fastq_file)
+
+
+def load_fastq(fastq_file: str, pair: Optional[str]=None, interleaved: bool=False, window: int=0, skip_unpaired: bool=False) -> Tuple[fastq.Read]:
+    """Load a FASTQ file"""
+    logging.info("Reading in FASTQ file %s", fastq_file)
+    read_start = time.time() # type: float
+    reads = tuple(iter_fastq(fastq_file=fastq_file, pair=pair, interleaved=interleaved, window=window, skip_unpaired=skip_unpaired)) # type: Tuple[fastq.Read]
+    logging.debug("Reading in FASTQ file %s took %s seconds", fastq_file, round(time.time() - read_start, 3))
+    return reads
 
 
 def load_sample_sheet(sheet_file: str) -> Dict[str, Tuple[str, Optional[str]]]:
     """Load in the sample sheet"""
     logging.info("Reading in sample sheet %s", sheet_file)
     sheet_start = time.time() # type: float
-    sample_sheet = dict()
+    #   Split the whole sheet at once; per-line reads are most of the cost for huge sheets
     with open(sheet_file, 'r') as sfile:
-        for line in sfile:
-            if line.startswith('#'):
-                continue
-            line = line.strip().split()
-            sample_sheet[line[0]] = tuple(line[1:])
+        rows = [line.split() for line in sfile.read().splitlines() if line.strip() and not line.startswith('#')] # type: List[List[str]]
+    sample_sheet = {row[0]: tuple(row[1:]) for row in rows} # type: Dict[str, Tuple[str, Optional[str]]]
+    if len(sample_sheet) < len(rows):
+        logging.warning("%s samples are listed more than once in %s, the last listing of each is used", len(rows) - len(sample_sheet), sheet_file)
     logging.debug("Reading in the sample sheet took %s seconds", round(time.time() - sheet_start, 3))
     return sample_sheet
 
 
+def load_read_structures(sheet_file: str) -> Tuple[str]:
+    """Find read structures declared in a sample sheet
+    A '#read_structure' line gives one structure per barcode column, such as
+    '#read_structure    8B10M8B+T    8B+T'; returns an empty tuple if there's none
+    """
+    with open(sheet_file, 'r') as sfile:
+        for line in sfile: # type: str
+            if line.startswith('#read_structure'):
+                return tuple(line.strip().split()[1:])
+    return tuple()
+
+
 def match_barcodes(sample_sheet: Dict[str, Tuple[str, Optional[str]]], barcodes_dictionary: Dict[str, str]) -> Dict[str, Tuple[str, Optional[str]]]:
     """Create full barcode sequences for each sample in the sample sheet"""
     logging.info("Matching barcodes for %s samples", len(sample_sheet))
     match_start = time.time() # type: float
-    bc_lookup = lambda i: barcodes_dictionary.get(i, i) # type: function
-    sample_barcodes = dict() # type: Dict[str, Tuple[str, Optional[str]]]
-    for sample, barcodes_list in sample_sheet.items(): # type: str, Tuple[str, Optional[str]]
-        if len(barcodes_list) > 2:
-            raise SystemExit(logging.error("Each sample can have at most two barcodes sets associated with it, sample %s has %s", sample, len(barcodes_list)))
-        barcodes_list = map(lambda i: i.split(','), barcodes_list) # type: Iterable[List[str], List[str]]
-        barcodes_filled = tuple(','.join(map(bc_lookup, barcodes)) for barcodes in barcodes_list) # type: Tuple[str]
-        sample_barcodes[sample] = barcodes_filled
+    oversized = [sample for sample, barcodes_list in sample_sheet.items() if len(barcodes_list) > 2] # type: List[str]
+    if oversized:
+        raise SystemExit(logging.error("Each sample can have at most two barcodes sets associated with it, sample %s has %s", oversized[0], len(sample_sheet[oversized[0]])))
+    bc_lookup = barcodes_dictionary.get # type: function
+    sample_barcodes = { # type: Dict[str, Tuple[str, Optional[str]]]
+        sample: tuple(','.join([bc_lookup(i, i) for i in barcodes.split(',')]) for barcodes in barcodes_list)
+        for sample, barcodes_list in sample_sheet.items()
+    }
     logging.debug("Matching barcodes took %s seconds", round(time.time() - match_start, 3))
     return sample_barcodes
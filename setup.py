@@ -57,9 +57,16 @@ PYTHON_REQUIRES = '>=3.5' # type: str
 #   Dependencies
 INSTALL_REQUIRES = [ # type: List[str]
     'regex',
-    'biopython'
+    'biopython',
+    'numpy'
 ]
 
+#   Optional dependencies
+EXTRAS_REQUIRE = { # type: Dict[str, List[str]]
+    'dask': ['dask[distributed]'],
+    'stats': ['matplotlib']
+}
+
 #   Packages
 PACKAGE_DIR = 'barcseek'
 PACKAGES = [ # type: List[str]
@@ -90,6 +97,7 @@ setup(
     python_requires=PYTHON_REQUIRES,
     classifiers=CLASSIFIERS,
     install_requires=INSTALL_REQUIRES,
+    extras_require=EXTRAS_REQUIRE,
     packages=PACKAGES,
     entry_points=ENTRY_POINTS,
     cmdclass=CMD_CLASS
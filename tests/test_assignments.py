@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+
+"""Tests for the columnar assignment log"""
+
+import os
+from typing import Dict, List, Tuple
+
+import barcseek.parallel as parallel
+import barcseek.partition as partition
+import barcseek.assignments as assignments
+
+_SAMPLES = {'S1': ('AGACTC', 'CATGAG'), 'S2': ('TTGCAG', 'GTCACA')}
+
+
+def _write_fastqs(directory: str, num_reads: int) -> Tuple[str, str]:
+    """Paired reads alternating between samples, where every tenth reverse read belongs to no
+    forward read and some reverse reads are swapped with their neighbours"""
+    forward, reverse = os.path.join(directory, 'R1.fastq'), os.path.join(directory, 'R2.fastq') # type: str, str
+    samples = sorted(_SAMPLES) # type: List[str]
+    records = list() # type: List[Tuple[str, str]]
+    for number in range(num_reads): # type: int
+        first, second = _SAMPLES[samples[number % 2]] # type: str, str
+        records.append(('@read%s\n%s\n+\n%s\n' % (number, first + 'T' * 20, 'I' * 26), '@read%s\n%s\n+\n%s\n' % (number, second + 'T' * 20, 'I' * 26)))
+    reverse_records = [pair[1] if number % 10 != 3 else pair[1].replace('@read', '@stray') for number, pair in enumerate(records)] # type: List[str]
+    for start in range(0, len(reverse_records) - 1, 9): # type: int
+        reverse_records[start], reverse_records[start + 1] = reverse_records[start + 1], reverse_records[start]
+    with open(forward, 'w') as ffile, open(reverse, 'w') as rfile:
+        ffile.write(''.join(pair[0] for pair in records))
+        rfile.write(''.join(reverse_records))
+    return forward, reverse
+
+
+def test_log_indexes_reads_left_out_by_pairing(tmp_path):
+    forward, reverse = _write_fastqs(directory=str(tmp_path), num_reads=100)
+    directory = str(tmp_path / 'out') # type: str
+    parallel.parallelize(
+        matcher=partition.Matcher(samples=_SAMPLES, error_rate=0),
+        lanes=(parallel.Lane(forward=forward, reverse=reverse, interleaved=False),),
+        directory=directory,
+        num_reads=20,
+        pair_window=2,
+        skip_unpaired=True,
+        progress_interval=0,
+        log_assignments=True
+    )
+    reader = assignments.AssignmentReader(filename=os.path.join(directory, assignments.LOG_NAME))
+    columns = reader.read(columns=('index', 'sample'))
+    found = {int(index): reader.categories[sample] for index, sample in zip(columns['index'], columns['sample'])} # type: Dict[int, str]
+    assert len(found) == len(columns['index'])
+    assert found == {number: sorted(_SAMPLES)[number % 2] for number in range(100) if number % 10 != 3}
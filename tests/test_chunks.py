@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+
+"""Tests for planning and reading chunks of FASTQ files"""
+
+import os
+import gzip
+from typing import List, Optional, Tuple
+
+import pytest
+
+import barcseek.chunks as chunks
+import barcseek.parallel as parallel
+import barcseek.partition as partition
+import barcseek.scheduler as scheduler
+import barcseek.assignments as assignments
+
+
+def _write_fastqs(directory: str, num_reads: int=230) -> Tuple[str, str]:
+    """Gzipped pairs, the last forward record without a trailing newline"""
+    names = (os.path.join(directory, 'R1.fastq.gz'), os.path.join(directory, 'R2.fastq.gz')) # type: Tuple[str, str]
+    for name, base in zip(names, 'AC'): # type: str, str
+        records = ['@read%s\n%s\n+\n%s' % (number, base * (number % 7 + 1), 'I' * (number % 7 + 1)) for number in range(num_reads)] # type: List[str]
+        with gzip.open(name, 'wt') as handle:
+            handle.write('\n'.join(records) + ('' if base == 'A' else '\n'))
+    return names
+
+
+def test_streamed_blocks_match_the_plan(tmp_path):
+    forward, reverse = _write_fastqs(directory=str(tmp_path))
+    stream = chunks.BlockStream(forward=forward, reverse=reverse, num_reads=50)
+    work = scheduler.Scheduler(blocks=(), workers=1, adaptive=False, feeds={0: stream.next_block})
+    found = list() # type: List[chunks.Chunk]
+    data = [b'', b''] # type: List[bytes]
+    size = 0 # type: int
+    while True:
+        chunk = work.next_chunk() # type: Optional[chunks.Chunk]
+        if chunk is None:
+            break
+        found.append(chunk)
+        for position, piece in enumerate(stream.take(chunk=chunk)): # type: int, bytes
+            data[position] += piece
+        size += stream.finish(chunk=chunk)
+    stream.close()
+    assert found == list(chunks.plan_chunks(forward=forward, reverse=reverse, num_reads=50))
+    for name, piece in zip((forward, reverse), data): # type: str, bytes
+        with gzip.open(name, 'rb') as handle:
+            assert handle.read() == piece
+    assert size == stream.size == os.path.getsize(forward) + os.path.getsize(reverse)
+
+
+@pytest.mark.parametrize('suffix', ('.fastq', '.fastq.gz'))
+def test_mates_pair_across_block_edges(tmp_path, suffix):
+    samples = {'S1': ('AGACTC', 'CATGAG')}
+    names = (str(tmp_path / ('R1' + suffix)), str(tmp_path / ('R2' + suffix))) # type: Tuple[str, str]
+    for name, barcode in zip(names, samples['S1']): # type: str, str
+        records = ['@read%s\n%s\n+\n%s\n' % (number, barcode + 'T' * 20, 'I' * 26) for number in range(100)] # type: List[str]
+        if barcode == samples['S1'][1]:
+            #   Both mates of reads 49 and 50 cross the edge between the first two blocks
+            records[49], records[50] = records[50], records[49]
+        with (gzip.open(name, 'wt') if suffix.endswith('.gz') else open(name, 'w')) as handle:
+            handle.write(''.join(records))
+    directory = str(tmp_path / 'out') # type: str
+    parallel.parallelize(
+        matcher=partition.Matcher(samples=samples, error_rate=0),
+        lanes=(parallel.Lane(forward=names[0], reverse=names[1], interleaved=False),),
+        directory=directory,
+        num_reads=50,
+        pair_window=1,
+        progress_interval=0,
+        log_assignments=True
+    )
+    reader = assignments.AssignmentReader(filename=os.path.join(directory, assignments.LOG_NAME))
+    assert sorted(int(index) for index in reader.read(columns=('index',))['index']) == list(range(100))
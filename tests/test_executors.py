@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+
+"""Tests for running chunks on each executor"""
+
+import os
+import random
+from typing import Any, Dict, List, Tuple
+
+import pytest
+
+import barcseek.chunks as chunks
+import barcseek.parallel as parallel
+import barcseek.executors as executors
+import barcseek.partition as partition
+
+_SAMPLES = {'S1': ('AGACTCNNNN', 'CATGAG'), 'S2': ('TTGCAGNNNN', 'GTCACA'), 'S3': ('CCATGA', 'ACGTTG')}
+
+
+def _mutate(barcode: str, rng: random.Random) -> str:
+    bases = list(barcode.replace('N', 'A')) # type: List[str]
+    if rng.random() < 0.3:
+        bases[rng.randrange(len(bases))] = rng.choice('ACGT')
+    return ''.join(bases)
+
+
+def _write_fastqs(directory: str, num_reads: int=400) -> Tuple[str, str]:
+    rng = random.Random(11)
+    forward, reverse = os.path.join(directory, 'R1.fastq'), os.path.join(directory, 'R2.fastq') # type: str, str
+    samples = sorted(_SAMPLES.values()) # type: List[Tuple[str, str]]
+    with open(forward, 'w') as ffile, open(reverse, 'w') as rfile:
+        for number in range(num_reads): # type: int
+            first, second = rng.choice(samples) # type: str, str
+            if number % 7 == 0:
+                first, second = 'G' * len(first), 'G' * len(second)
+            seqs = [
+                ''.join(rng.choice('ACGT') for _ in range(rng.randint(0, 3))) + _mutate(barcode=barcode, rng=rng) + ''.join(rng.choice('ACGT') for _ in range(40))
+                for barcode in (first, second)
+            ] # type: List[str]
+            for handle, seq in zip((ffile, rfile), seqs):
+                handle.write('@read%s\n%s\n+\n%s\n' % (number, seq, 'I' * len(seq)))
+    return forward, reverse
+
+
+def _matcher(cache: int=0) -> partition.Matcher:
+    return partition.Matcher(samples=_SAMPLES, error_rate=1, window=12, cache=cache)
+
+
+def _outputs(directory: str) -> Dict[str, List[bytes]]:
+    """Every record of every output; chunks are appended as they finish, so records are sorted"""
+    contents = dict() # type: Dict[str, List[bytes]]
+    for name in sorted(os.listdir(directory)): # type: str
+        path = os.path.join(directory, name) # type: str
+        if os.path.isfile(path) and name.endswith('.fastq'):
+            with open(path, 'rb') as ofile:
+                lines = ofile.read().splitlines() # type: List[bytes]
+            contents[name] = sorted(b'\n'.join(lines[start:start + 4]) for start in range(0, len(lines), 4))
+    return contents
+
+
+def _counters(executor: executors.Executor, lane: parallel.Lane, directory: str) -> Dict[Tuple[int, int], Tuple[Any, ...]]:
+    with executor:
+        for chunk in chunks.plan_chunks(forward=lane.forward, reverse=lane.reverse, num_reads=50): # type: chunks.Chunk
+            executor.submit(parallel.demultiplex_chunk, chunk=chunk, lane=lane, directory=directory)
+        results = dict() # type: Dict[Tuple[int, int], Tuple[Any, ...]]
+        while executor.pending:
+            result = executor.next_result() # type: parallel.ChunkResult
+            results[(result.chunk.lane, result.chunk.index)] = (result.counts, result.evaluations, result.filtered, result.distances, result.umis)
+    return results
+
+
+def _executor(name: str, matcher: partition.Matcher, address: str) -> executors.Executor:
+    if name == 'dask':
+        return executors.DaskExecutor(matcher=matcher, address=address)
+    return executors.create(name=name, matcher=matcher, workers=2)
+
+
+def test_executors_agree(tmp_path):
+    distributed = pytest.importorskip('distributed')
+    forward, reverse = _write_fastqs(directory=str(tmp_path))
+    lane = parallel.Lane(forward=forward, reverse=reverse, interleaved=False)
+    outputs = dict() # type: Dict[str, Dict[str, List[bytes]]]
+    counters = dict() # type: Dict[str, Dict[Tuple[int, int], Tuple[Any, ...]]]
+    #   Threads in one process share the scattered matcher, which is where counting races would show
+    with distributed.LocalCluster(n_workers=1, threads_per_worker=4, processes=False) as cluster:
+        for name in executors.EXECUTORS: # type: str
+            matcher = _matcher(cache=1 << 20) # type: partition.Matcher
+            directory = str(tmp_path / name) # type: str
+            with _executor(name=name, matcher=matcher, address=cluster.scheduler_address) as executor: # type: executors.Executor
+                parallel.parallelize(matcher=matcher, lanes=(lane,), directory=directory, num_reads=50, executor=executor, progress_interval=0)
+            outputs[name] = _outputs(directory=directory)
+            #   Cache hits skip evaluations, and which thread ran what decides the hits, so count without a cache
+            executor = _executor(name=name, matcher=_matcher(), address=cluster.scheduler_address)
+            counters[name] = _counters(executor=executor, lane=lane, directory=str(tmp_path / ('counts_' + name)))
+    assert outputs['serial']
+    assert len(counters['serial']) == 8
+    assert sum(sum(counts[4].values()) for counts in counters['serial'].values())
+    for name in ('process', 'dask'): # type: str
+        assert outputs[name] == outputs['serial'], name
+        assert counters[name] == counters['serial'], name
@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+
+"""Tests for the sorted barcode whitelist index"""
+
+import random
+from typing import Tuple
+
+import numpy
+import pytest
+
+import barcseek.index as index
+
+
+def test_only_corrected_windows_are_remembered():
+    whitelist = index.BarcodeIndex(barcodes=('ACGTACGT', 'TTTTGGGG'))
+    rng = random.Random(2)
+    sequence = ''.join(rng.choice('ACGT') for _ in range(2000)) + 'ACGTACGA' # type: str
+    keys, _ = index.pack_kmers(sequence=sequence, length=whitelist.length) # type: numpy.ndarray, numpy.ndarray
+    first = whitelist.correct(keys=keys) # type: numpy.ndarray
+    assert first[-1] == 0
+    assert len(whitelist._corrections) == numpy.count_nonzero(first != index.MISSING)
+    assert numpy.array_equal(whitelist.correct(keys=keys), first)
+
+
+def test_reverse_complemented_index_keeps_whitelist_positions():
+    barcodes = ('ACGTACGA', 'TTTTGGGC', 'GATTACAA') # type: Tuple[str, ...]
+    flipped = index.BarcodeIndex(barcodes=barcodes).reverse_complement() # type: index.BarcodeIndex
+    for position, barcode in enumerate(barcodes): # type: int, str
+        assert flipped.lookup(barcode=barcode[::-1].translate(str.maketrans('ACGT', 'TGCA'))) == position
+    assert flipped.lookup(barcode=barcodes[0]) == index.MISSING
+
+
+def test_sample_table_finds_combinations():
+    whitelists, positions = zip(*(index.distinct(barcodes=column) for column in (('AAA', 'CCC', 'AAA'), ('GGG', 'GGG', 'TTT'))))
+    table = index.SampleTable(positions=positions, sizes=tuple(map(len, whitelists)), names=('S1', 'S2', 'S3'))
+    assert [table.find(ids=(whitelists[0].index(first), whitelists[1].index(second))) for first, second in (('AAA', 'GGG'), ('CCC', 'GGG'), ('AAA', 'TTT'))] == [0, 1, 2]
+    assert table.find(ids=(whitelists[0].index('CCC'), whitelists[1].index('TTT'))) == index.MISSING
+    assert table.find(ids=(index.AMBIGUOUS, 0)) == index.MISSING
+    with pytest.raises(ValueError, match='S1 and S3'):
+        index.SampleTable(positions=(numpy.array((0, 1, 0)),), sizes=(2,), names=('S1', 'S2', 'S3'))
@@ -0,0 +1,31 @@
+#!/usr/bin/env python3
+
+"""Tests for keeping a run within a memory budget"""
+
+import os
+import multiprocessing
+
+import pytest
+
+import barcseek.memory as memory
+
+
+def _wait(pipe) -> None:
+    pipe.recv()
+
+
+@pytest.mark.skipif(not os.path.exists('/proc/self/smaps_rollup'), reason='needs /proc/<pid>/smaps_rollup')
+def test_forked_workers_count_shared_pages_once():
+    ballast = bytearray(64 * 2 ** 20) # type: bytearray
+    ballast[::4096] = b'x' * len(ballast[::4096])
+    alone = memory.run_memory() # type: int
+    parent, child = multiprocessing.get_context('fork').Pipe()
+    worker = multiprocessing.get_context('fork').Process(target=_wait, args=(child,))
+    worker.start()
+    try:
+        #   Right after forking every page is shared, so the ballast isn't counted twice
+        assert memory.run_memory() < alone + len(ballast) // 2
+        assert memory.process_rss(pid=os.getpid()) + memory.process_rss(pid=worker.pid) > alone + len(ballast) // 2
+    finally:
+        parent.send(None)
+        worker.join()
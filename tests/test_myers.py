@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+
+"""Tests for bit-parallel barcode search against a plain dynamic-programming oracle"""
+
+import random
+from typing import Iterator, List, Tuple
+
+import barcseek.myers as myers
+import barcseek.partition as partition
+
+
+def _matches(code: str, base: str) -> bool:
+    return code == 'N' or base in partition.IUPAC_CODES.get(code, code)
+
+
+def _last_row(barcode: str, sequence: str, anywhere: bool) -> List[int]:
+    """Edit distances of the barcode to sequences ending at each position, starting anywhere or only at the start"""
+    previous = [0 if anywhere else column for column in range(len(sequence) + 1)] # type: List[int]
+    for row, code in enumerate(barcode, 1): # type: int, str
+        current = [row] # type: List[int]
+        for column, base in enumerate(sequence, 1): # type: int, str
+            current.append(min(previous[column - 1] + (not _matches(code=code, base=base)), previous[column] + 1, current[-1] + 1))
+        previous = current
+    return previous
+
+
+def _oracle(barcode: str, sequence: str) -> int:
+    """Lowest edit distance of the barcode anywhere in the sequence"""
+    return min(_last_row(barcode=barcode, sequence=sequence, anywhere=True))
+
+
+def _cases(seed: int, count: int, codes: str) -> Iterator[Tuple[str, str]]:
+    """Random barcodes and sequences, half of them holding a lightly mutated copy of the barcode"""
+    rng = random.Random(seed)
+    for _ in range(count):
+        barcode = ''.join(rng.choice(codes) for _ in range(rng.randint(1, 10))) # type: str
+        sequence = [rng.choice('ACGT') for _ in range(rng.randint(1, 25))] # type: List[str]
+        if rng.random() < 0.5 and len(sequence) > len(barcode):
+            start = rng.randrange(len(sequence) - len(barcode) + 1) # type: int
+            sequence[start:start + len(barcode)] = [rng.choice(partition.IUPAC_CODES.get(code, 'ACGT' if code == 'N' else code)) for code in barcode]
+            for _ in range(rng.randint(0, 3)):
+                sequence[rng.randrange(len(sequence))] = rng.choice('ACGT')
+        yield barcode, ''.join(sequence)
+
+
+def test_search_finds_the_oracle_distance():
+    for barcode, sequence in _cases(seed=3, count=1500, codes='ACGTACGTRYN'): # type: str, str
+        pattern = myers.compile_barcode(barcode=barcode) # type: myers.Pattern
+        distance, end = pattern.search(sequence=sequence)
+        assert distance == _oracle(barcode=barcode, sequence=sequence), (barcode, sequence)
+        assert _last_row(barcode=barcode, sequence=sequence[:end], anywhere=True)[-1] == distance, (barcode, sequence)
+        alignment = pattern.locate(sequence=sequence) # type: myers.Alignment
+        assert _last_row(barcode=barcode, sequence=sequence[alignment.start:alignment.end], anywhere=False)[-1] == distance, (barcode, sequence)
+        assert list(alignment.positions) == sorted(alignment.positions)
+
+
+def test_search_agrees_with_best_regex_match():
+    #   Without UMIs a barcode is one regex group, so both count edits over the whole barcode
+    for barcode, sequence in _cases(seed=4, count=1000, codes='ACGTACGTRY'): # type: str, str
+        distance = _oracle(barcode=barcode, sequence=sequence) # type: int
+        for error_rate in range(3): # type: int
+            match = partition.barcode_to_regex(barcode=barcode, error_rate=error_rate).search(sequence)
+            found = myers.compile_barcode(barcode=barcode).search(sequence=sequence, max_distance=error_rate)
+            assert bool(match) == bool(found) == (distance <= error_rate), (barcode, sequence, error_rate)
+            if match:
+                assert sum(match.fuzzy_counts) == found[0] == distance, (barcode, sequence, error_rate)
+
+
+def test_umi_barcodes_allow_edits_per_segment_only_with_regex():
+    #   One edit in each segment is two over the whole barcode: within one per segment, but not one in all
+    barcode, sequence = 'ACGTNNNNTGCA', 'TTACGAGGGGTGCTTT' # type: str, str
+    assert _oracle(barcode=barcode, sequence=sequence) == 2
+    assert partition.barcode_to_regex(barcode=barcode, error_rate=1).search(sequence)
+    assert myers.compile_barcode(barcode=barcode).search(sequence=sequence, max_distance=1) is None
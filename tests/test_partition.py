@@ -0,0 +1,34 @@
+#!/usr/bin/env python3
+
+"""Tests for assigning reads to samples"""
+
+import barcseek.fastq as fastq
+import barcseek.partition as partition
+
+
+def _read(forward: str, reverse: str) -> fastq.Read:
+    return fastq.Read(read_id='read', seq=forward, qual='I' * len(forward), rev=reverse, rev_qual='I' * len(reverse))
+
+
+def test_exact_occurrence_beats_earlier_fuzzy_one():
+    #   'AGATC' at offset 1 is AGACTC with one deletion; the exact copy comes much later
+    forward = 'TAGATCGG' + 'T' * 10 + 'GACTAGACTCAG' # type: str
+    read = _read(forward=forward, reverse='CATGTGTTT')
+    samples = {'S1': ('AGACTC', 'CATGAG'), 'S2': ('AGATCA', 'CATGAG')}
+    for verifier in partition.VERIFIERS: # type: str
+        matcher = partition.Matcher(samples=samples, error_rate=1, verifier=verifier) # type: partition.Matcher
+        assignment = matcher.match(read=read) # type: partition.Assignment
+        assert assignment.sample == 'S1', verifier
+        assert assignment.distance == 1, verifier
+        start = forward.rindex('AGACTC') # type: int
+        assert assignment.read.forward == forward[:start] + forward[start + 6:], verifier
+
+
+def test_fuzzier_level_can_tie_best_hit():
+    #   S1 needs one edit in each barcode; S2 needs two in its first barcode and none in its second
+    read = _read(forward='AGACTA' + 'T' * 20, reverse='CATGTG' + 'T' * 20)
+    samples = {'S1': ('AGACTC', 'CATGAG'), 'S2': ('AGTTTA', 'CATGTG')}
+    matcher = partition.Matcher(samples=samples, error_rate=2) # type: partition.Matcher
+    assignment = matcher.match(read=read) # type: partition.Assignment
+    assert assignment.sample == partition.AMBIGUOUS
+    assert assignment.distance == 2
@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+
+"""Tests for streaming outputs"""
+
+import io
+import threading
+
+import pytest
+
+import barcseek.sinks as sinks
+
+
+class _Stalled(io.BytesIO):
+
+    """A reader that takes nothing until it's let go"""
+
+    def __init__(self) -> None:
+        super(_Stalled, self).__init__()
+        self.ready = threading.Event() # type: threading.Event
+        self.contents = b'' # type: bytes
+
+    def write(self, data: bytes) -> int:
+        self.ready.wait()
+        return super(_Stalled, self).write(data)
+
+    def close(self) -> None:
+        self.contents = self.getvalue()
+        super(_Stalled, self).close()
+
+
+class _StalledSink(sinks.Sink):
+
+    def __init__(self, name: str, depth: int, max_spill: int=sinks.MAX_SPILL) -> None:
+        super(_StalledSink, self).__init__(name=name, depth=depth, max_spill=max_spill)
+        self.handle = _Stalled() # type: _Stalled
+
+    def _open(self):
+        return self.handle
+
+
+def test_slow_reader_spills_rather_than_blocking():
+    sink = _StalledSink(name='slow', depth=2)
+    pieces = [b'%05d\n' % number for number in range(1000)]
+    for piece in pieces: # type: bytes
+        sink.write(piece)
+    #   Every write returned while the reader took nothing
+    assert sink.spilled
+    sink.handle.ready.set()
+    sink.close()
+    assert sink.handle.contents == b''.join(pieces)
+
+
+def test_spilling_stops_at_the_limit():
+    sink = _StalledSink(name='unread', depth=2, max_spill=64)
+    with pytest.raises(IOError):
+        for number in range(100): # type: int
+            sink.write(b'%05d\n' % number)
+    sink.handle.ready.set()
+    sink.close()
+
+
+def test_waiting_for_room_ends_when_the_reader_catches_up():
+    sink = _StalledSink(name='slow', depth=2)
+    for number in range(10): # type: int
+        sink.write(b'%05d\n' % number)
+    assert sink.backlogged
+    threading.Timer(0.1, sink.handle.ready.set).start()
+    sinks.wait_for_room(sinks=(sink,))
+    assert not sink.backlogged
+    sink.close()